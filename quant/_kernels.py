@@ -0,0 +1,521 @@
+import numpy as np
+from numba import njit, prange
+
+@njit(cache=True)
+def macd_ema3(close, fast, slow, signal):
+    """
+    计算MACD的DIF、DEA和MACD柱（编译执行），口径与backtrader的MACD指标一致
+    - 快线、慢线EMA都以前period根收盘价的简单平均为初值
+    - DEA是DIF的EMA，以DIF有值后前signal个值的简单平均为初值
+    :param fast, slow, signal: 快线、慢线、信号线周期
+    :return: (DIF, DEA, MACD柱)，DIF前max(fast, slow)-1个为NaN，DEA和MACD柱再往后signal-1个为NaN
+    """
+    n = len(close)
+    dif = ema_sma_seed(close, fast) - ema_sma_seed(close, slow)
+    dea = np.full(n, np.nan)
+    start = max(fast, slow) - 1
+    if n > start:
+        dea[start:] = ema_sma_seed(dif[start:], signal)
+    return dif, dea, dif - dea
+
+@njit(cache=True)
+def atr_wilder(high, low, close, period):
+    """
+    单次遍历计算ATR（编译执行），口径与backtrader的ATR指标一致
+    - 真实波幅从第2根K线开始，首个ATR取period根真实波幅的简单平均，之后Wilder平滑
+    :return: ATR数组，前period根为NaN
+    """
+    n = len(close)
+    atr = np.full(n, np.nan)
+    value = 0.0
+    for t in range(1, n):
+        prev = close[t - 1]
+        tr = max(high[t], prev) - min(low[t], prev)
+        if t < period:
+            value += tr
+        elif t == period:
+            value = (value + tr) / period
+            atr[t] = value
+        else:
+            value += (tr - value) / period
+            atr[t] = value
+    return atr
+
+@njit(cache=True)
+def _fsum(values, start, stop, partials):
+    """
+    values[start:stop]的精确求和，算法与math.fsum相同（Shewchuk部分和，最后一步按正确舍入修正）
+    :param partials: 长度不小于stop-start的工作数组
+    """
+    n = 0
+    for k in range(start, stop):
+        x = values[k]
+        i = 0
+        for j in range(n):
+            y = partials[j]
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo != 0.0:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i] = x
+        n = i + 1
+
+    hi = 0.0
+    if n > 0:
+        n -= 1
+        hi = partials[n]
+        lo = 0.0
+        while n > 0:
+            x = hi
+            n -= 1
+            y = partials[n]
+            hi = x + y
+            lo = y - (hi - x)
+            if lo != 0.0:
+                break
+        # 剩余部分和与lo同号时，hi恰好处在两个浮点数中间，按math.fsum的规则修正舍入
+        if n > 0 and ((lo < 0.0 and partials[n - 1] < 0.0) or (lo > 0.0 and partials[n - 1] > 0.0)):
+            y = lo * 2.0
+            x = hi + y
+            if y == x - hi:
+                hi = x
+    return hi
+
+@njit(cache=True)
+def sma_fsum(values, period):
+    """
+    简单移动平均（编译执行），口径与backtrader的SMA一致：每个窗口用math.fsum的算法精确求和再除以周期
+    价格平台上均线严格等于收盘价，不会因为累加误差误触发均线比较
+    :return: 长度N的数组，前period-1个为NaN
+    """
+    n = len(values)
+    ma = np.full(n, np.nan)
+    partials = np.empty(period)
+    for t in range(period - 1, n):
+        ma[t] = _fsum(values, t - period + 1, t + 1, partials) / period
+    return ma
+
+@njit(cache=True)
+def ema_sma_seed(values, period):
+    """
+    指数移动平均（编译执行），口径与backtrader的EMA一致
+    - 前period个值的简单平均（与sma_fsum相同的精确求和）作为初值
+    - 之后按 上一值*(1-alpha) + 当前值*alpha 递推，alpha = 2 / (周期 + 1)
+    :return: 长度N的数组，前period-1个为NaN
+    """
+    n = len(values)
+    ema = np.full(n, np.nan)
+    if n < period:
+        return ema
+    alpha = 2.0 / (1.0 + period)
+    alpha1 = 1.0 - alpha
+    prev = _fsum(values, 0, period, np.empty(period)) / period
+    ema[period - 1] = prev
+    for t in range(period, n):
+        prev = prev * alpha1 + values[t] * alpha
+        ema[t] = prev
+    return ema
+
+@njit(cache=True)
+def crossover(fast, slow):
+    """
+    金叉/死叉信号（编译执行），口径与backtrader的CrossOver一致
+    - 两线之差为0时沿用上一个非零差值，差值由负转正为金叉、由正转负为死叉，两线相等的K线不算交叉
+    - 两线都有值之后的第2根K线起才可能产生信号
+    :return: (金叉, 死叉) 布尔数组
+    """
+    n = len(fast)
+    golden = np.zeros(n, np.bool_)
+    death = np.zeros(n, np.bool_)
+    started = False
+    nzd = 0.0  # 上一个非零差值
+    for t in range(n):
+        d = fast[t] - slow[t]
+        if np.isnan(d):
+            continue
+        if not started:
+            started = True
+            nzd = d
+            continue
+        golden[t] = nzd < 0.0 and fast[t] > slow[t]
+        death[t] = nzd > 0.0 and fast[t] < slow[t]
+        if d != 0.0:
+            nzd = d
+    return golden, death
+
+@njit(cache=True)
+def _add_value(total, pos, price, entry_price):
+    """
+    把一个持仓的市值累加到total，累加顺序与BackBroker.getvalue相同：
+    多头先加 市值-浮动盈亏 再加 浮动盈亏，空头直接加 数量*价格；多个持仓按顺序依次累加到同一个total
+    :param entry_price: 当前持仓的开仓成交价
+    """
+    value = pos * price
+    if value > 0.0:
+        pnl = pos * (price - entry_price)
+        total += value - pnl
+        return total + pnl
+    return total + value
+
+@njit(cache=True)
+def _fill(cash, pos, size, price, created_price, entry_price):
+    """
+    按backtrader默认broker的规则撮合一笔市价单
+    - 开多仓时，按下单时收盘价和成交价计算的剩余资金都不能为负，否则订单作废
+    - 做空卖出和平仓不检查资金
+    - 全部平仓时资金的计算顺序与BackBroker相同：加回 持仓数量*开仓价 + 盈亏，
+      而不是直接减去 数量*成交价，两者可能相差一个ulp，会影响之后按资金计算的买入数量是否恰好超出资金
+    :param entry_price: 当前持仓的开仓成交价，空仓时不使用
+    :return: (成交后资金, 成交后持仓, 是否成交)
+    """
+    if pos != 0.0 and pos + size == 0.0:
+        return cash + (pos * entry_price + pos * (price - entry_price)), 0.0, True
+    if pos == 0.0 and size > 0.0:
+        if cash - size * created_price < 0.0 or cash - size * price < 0.0:
+            return cash, pos, False
+    return cash - size * price, pos + size, True
+
+@njit(cache=True)
+def backtest_macd(open_, close, buy_mask, sell_mask, cash, pct):
+    """
+    MACD策略回测（编译执行），与MACDStrategy逻辑一致
+    - 信号出现后下一根K线开盘成交，空仓时按可用资金的pct比例买入
+    :return: (逐K线账户价值, 交易明细[开仓bar, 平仓bar(-1表示未平仓), 数量, 盈亏])
+    """
+    n = len(close)
+    equity = np.empty(n)
+    trades = np.empty((n, 4))
+    k = 0
+    pos = 0.0
+    entry_px = 0.0
+    pending = 0.0  # 待成交数量，正为买入、负为卖出
+    for t in range(n):
+        if pending != 0.0:
+            was_flat = pos == 0.0
+            cash, pos, filled = _fill(cash, pos, pending, open_[t], close[t - 1], entry_px)
+            if filled and was_flat:
+                entry_px = open_[t]
+                trades[k, 0] = t
+                trades[k, 1] = -1
+                trades[k, 2] = pos
+                trades[k, 3] = np.nan
+            elif filled:
+                trades[k, 1] = t
+                trades[k, 3] = -pending * (open_[t] - entry_px)
+                k += 1
+            pending = 0.0
+
+        equity[t] = cash + _add_value(0.0, pos, close[t], entry_px)
+        if pos == 0.0:
+            if buy_mask[t]:
+                pending = cash / close[t] * pct  # 与PercentSizer的计算顺序相同
+        elif sell_mask[t]:
+            pending = -pos
+    if pos != 0.0:
+        k += 1
+    return equity, trades[:k]
+
+@njit(cache=True)
+def backtest_mean_reversion(open_, close, z, threshold, trend, atr, cash,
+                            risk_pct, exit_z, max_drawdown):
+    """
+    均线回归策略回测（编译执行），与MeanReversionStrategy逻辑一致
+    - 指标未就绪（NaN）的K线只结算不交易
+    - 信号出现后下一根K线开盘成交
+    :return: (逐K线账户价值, 交易明细[开仓bar, 平仓bar(-1表示未平仓), 数量(负数为做空), 盈亏])
+    """
+    n = len(close)
+    equity = np.empty(n)
+    trades = np.empty((n, 4))
+    k = 0
+    pos = 0.0
+    entry_px = 0.0
+    stop_price = 0.0
+    pending = 0.0
+    max_value = cash
+    for t in range(n):
+        if pending != 0.0:
+            was_flat = pos == 0.0
+            cash, pos, filled = _fill(cash, pos, pending, open_[t], close[t - 1], entry_px)
+            if filled and was_flat:
+                entry_px = open_[t]
+                trades[k, 0] = t
+                trades[k, 1] = -1
+                trades[k, 2] = pos
+                trades[k, 3] = np.nan
+            elif filled:
+                trades[k, 1] = t
+                trades[k, 3] = -pending * (open_[t] - entry_px)
+                k += 1
+            pending = 0.0
+
+        value = cash + _add_value(0.0, pos, close[t], entry_px)
+        equity[t] = value
+        if np.isnan(z[t]) or np.isnan(trend[t]) or np.isnan(atr[t]):
+            continue
+
+        # 回撤风控
+        max_value = max(max_value, value)
+        if (max_value - value) / max_value > max_drawdown:
+            if pos != 0.0:
+                pending = -pos
+            continue
+
+        if pos == 0.0:
+            stop_range = atr[t] * 2
+            size = value * risk_pct / stop_range
+            if z[t] < -threshold[t]:
+                if close[t] > trend[t]:
+                    stop_price = close[t] - stop_range
+                    pending = size
+            elif z[t] > threshold[t]:
+                if close[t] < trend[t]:
+                    stop_price = close[t] + stop_range
+                    pending = -size
+        else:
+            if pos > 0.0:
+                if close[t] < stop_price:
+                    pending = -pos
+                    continue
+            elif close[t] > stop_price:
+                pending = -pos
+                continue
+            if -exit_z < z[t] < exit_z:
+                pending = -pos
+    if pos != 0.0:
+        k += 1
+    return equity, trades[:k]
+
+@njit(cache=True)
+def backtest_pair(open1, close1, open2, close2, z, cash, beta, z_entry, z_exit,
+                  stop_loss, take_profit):
+    """
+    配对交易回测（编译执行），与PairTradingStrategy逻辑一致
+    - 两条腿按下单顺序在下一根K线开盘依次成交
+    :return: (逐K线账户价值, 交易明细[开仓bar, 平仓bar(-1表示未平仓), 股票1数量(负数为做空), 两腿合计盈亏])
+    """
+    n = len(close1)
+    equity = np.empty(n)
+    trades = np.empty((n, 4))
+    k = 0
+    pos1 = 0.0
+    pos2 = 0.0
+    fill1 = 0.0  # 两条腿的开仓成交价
+    fill2 = 0.0
+    entry1 = 0.0  # 下单时的收盘价，用于计算持仓收益率
+    entry2 = 0.0
+    pending1 = 0.0
+    pending2 = 0.0
+    for t in range(n):
+        if pending1 != 0.0 or pending2 != 0.0:
+            was_flat = pos1 == 0.0
+            old1, old2 = pos1, pos2
+            cash, pos1, _ = _fill(cash, pos1, pending1, open1[t], close1[t - 1], fill1)
+            cash, pos2, _ = _fill(cash, pos2, pending2, open2[t], close2[t - 1], fill2)
+            # 各腿从空仓开仓时记录成交价（平仓时计算资金要用）
+            if old1 == 0.0 and pos1 != 0.0:
+                fill1 = open1[t]
+            if old2 == 0.0 and pos2 != 0.0:
+                fill2 = open2[t]
+            if was_flat and pos1 != 0.0:
+                trades[k, 0] = t
+                trades[k, 1] = -1
+                trades[k, 2] = pos1
+                trades[k, 3] = np.nan
+            elif not was_flat and pos1 == 0.0:
+                trades[k, 1] = t
+                trades[k, 3] = old1 * (open1[t] - fill1) + old2 * (open2[t] - fill2)
+                k += 1
+            pending1 = 0.0
+            pending2 = 0.0
+
+        value = cash + _add_value(_add_value(0.0, pos1, close1[t], fill1), pos2, close2[t], fill2)
+        equity[t] = value
+        zt = z[t]
+        if np.isnan(zt):
+            continue
+
+        if pos1 == 0.0:
+            if zt > z_entry or zt < -z_entry:
+                entry1, entry2 = close1[t], close2[t]
+                alloc = value * 0.4  # 使用40%资金
+                qty1 = alloc / close1[t]
+                qty2 = alloc * beta / close2[t]
+                if zt > z_entry:  # 做空spread
+                    pending1, pending2 = -qty1, qty2
+                else:  # 做多spread
+                    pending1, pending2 = qty1, -qty2
+        else:
+            if pos1 > 0.0:
+                profit_pct = close1[t] / entry1 - beta * (close2[t] / entry2)
+            else:
+                profit_pct = -(close1[t] / entry1) + beta * (close2[t] / entry2)
+            if -z_exit < zt < z_exit or profit_pct < -stop_loss or profit_pct > take_profit:
+                pending1, pending2 = -pos1, -pos2
+    if pos1 != 0.0:
+        k += 1
+    return equity, trades[:k]
+
+@njit(cache=True)
+def backtest_vegas(open_, low, close, ema_fast, ema_mid1, ema_mid2, ema_slow, atr, cash,
+                   risk_pct, atr_multiplier):
+    """
+    Vegas通道策略回测（编译执行），与VegasStrategy逻辑一致
+    - 指标未就绪（NaN）的K线只结算不交易
+    - 信号出现后下一根K线开盘成交，止损价以信号K线的收盘价为基准
+    :return: (逐K线账户价值, 交易明细[开仓bar, 平仓bar(-1表示未平仓), 数量, 盈亏])
+    """
+    n = len(close)
+    equity = np.empty(n)
+    trades = np.empty((n, 4))
+    k = 0
+    pos = 0.0
+    fill_px = 0.0
+    entry_price = 0.0  # 信号K线的收盘价
+    pending = 0.0
+    for t in range(n):
+        if pending != 0.0:
+            was_flat = pos == 0.0
+            cash, pos, filled = _fill(cash, pos, pending, open_[t], close[t - 1], fill_px)
+            if filled and was_flat:
+                fill_px = open_[t]
+                trades[k, 0] = t
+                trades[k, 1] = -1
+                trades[k, 2] = pos
+                trades[k, 3] = np.nan
+            elif filled:
+                trades[k, 1] = t
+                trades[k, 3] = -pending * (open_[t] - fill_px)
+                k += 1
+            pending = 0.0
+
+        value = cash + _add_value(0.0, pos, close[t], fill_px)
+        equity[t] = value
+        if (np.isnan(ema_fast[t]) or np.isnan(ema_mid1[t]) or np.isnan(ema_mid2[t]) or
+                np.isnan(ema_slow[t]) or np.isnan(atr[t])):
+            continue
+
+        if pos == 0.0:
+            # 大趋势向上，且快线刚向上突破中期通道
+            if (close[t] > ema_slow[t] and ema_fast[t] > ema_mid1[t] and ema_fast[t] > ema_mid2[t]
+                    and ema_fast[t - 1] <= ema_mid1[t - 1]):
+                stop_price = low[t] - atr_multiplier * atr[t]
+                entry_price = close[t]
+                pending = value * risk_pct / (close[t] - stop_price)
+        else:
+            # 触及ATR止损或快线跌破中期通道
+            if (close[t] < entry_price - atr_multiplier * atr[t] or
+                    (ema_fast[t] < ema_mid1[t] and ema_fast[t] < ema_mid2[t])):
+                pending = -pos
+    if pos != 0.0:
+        k += 1
+    return equity, trades[:k]
+
+@njit(cache=True)
+def backtest_ma5(open_, close, ma, up_pct, cash):
+    """
+    均线突破策略回测（编译执行），与yp2.MA5Strategy逻辑一致
+    - 均线未就绪（NaN）的K线只结算不交易
+    - 空仓时收盘价高于均线up_pct以上，用全部现金按收盘价计算的整数股买入；持仓时收盘价低于均线清仓
+    - 信号出现后下一根K线开盘成交
+    :return: (逐K线账户价值, 交易明细[开仓bar, 平仓bar(-1表示未平仓), 数量, 盈亏])
+    """
+    n = len(close)
+    equity = np.empty(n)
+    trades = np.empty((n, 4))
+    k = 0
+    pos = 0.0
+    entry_px = 0.0
+    pending = 0.0
+    for t in range(n):
+        if pending != 0.0:
+            was_flat = pos == 0.0
+            cash, pos, filled = _fill(cash, pos, pending, open_[t], close[t - 1], entry_px)
+            if filled and was_flat:
+                entry_px = open_[t]
+                trades[k, 0] = t
+                trades[k, 1] = -1
+                trades[k, 2] = pos
+                trades[k, 3] = np.nan
+            elif filled:
+                trades[k, 1] = t
+                trades[k, 3] = -pending * (open_[t] - entry_px)
+                k += 1
+            pending = 0.0
+
+        equity[t] = cash + _add_value(0.0, pos, close[t], entry_px)
+        if np.isnan(ma[t]):
+            continue
+        if pos == 0.0:
+            if close[t] > ma[t] * (1.0 + up_pct):
+                pending = np.floor(cash / close[t])  # 数量为0时不下单
+        elif close[t] < ma[t]:
+            pending = -pos
+    if pos != 0.0:
+        k += 1
+    return equity, trades[:k]
+
+@njit(cache=True)
+def _max_drawdown(equity):
+    """资金曲线的最大回撤（百分比），口径与backtrader的DrawDown分析器一致"""
+    peak = -np.inf
+    worst = 0.0
+    for value in equity:
+        if value > peak:
+            peak = value
+        drawdown = 100.0 * (peak - value) / peak
+        if drawdown > worst:
+            worst = drawdown
+    return worst
+
+@njit(parallel=True, cache=True)
+def sweep_ma5(open_, close, ma_grid, up_pcts, cash):
+    """
+    均线突破策略的参数网格回测（编译执行），每组参数调用一次backtest_ma5
+    - 所有参数组合展平后用prange分给多个线程，各线程共用同一份行情和均线数组
+    - 线程数由numba决定，默认CPU核数，可用NUMBA_NUM_THREADS环境变量调整
+    :param ma_grid: (均线周期数, N) 各周期的均线
+    :param up_pcts: 各突破比例
+    :return: (最终资金, 最大回撤百分比, 交易次数)，均为(均线周期数, 突破比例数)矩阵
+    """
+    n_ma = ma_grid.shape[0]
+    n_pct = len(up_pcts)
+    final = np.empty((n_ma, n_pct))
+    max_dd = np.empty((n_ma, n_pct))
+    n_trades = np.empty((n_ma, n_pct), dtype=np.int64)
+    for cell in prange(n_ma * n_pct):
+        i = cell // n_pct
+        j = cell % n_pct
+        equity, trades = backtest_ma5(open_, close, ma_grid[i], up_pcts[j], cash)
+        final[i, j] = equity[-1]
+        max_dd[i, j] = _max_drawdown(equity)
+        n_trades[i, j] = len(trades)
+    return final, max_dd, n_trades
+
+@njit(cache=True)
+def rebalance_buys(prices, held_shares, target_value, cash):
+    """
+    调仓日按选股顺序把每只股票补足到目标金额（编译执行）
+    - 价格为NaN（停牌）的股票跳过
+    - 需买入金额为正且不超过剩余现金时，买入整数股
+    :param prices: 选中股票当日收盘价
+    :param held_shares: 选中股票当前持股数
+    :return: (各股票买入股数, 买入后现金)
+    """
+    n = len(prices)
+    bought = np.zeros(n)
+    for i in range(n):
+        price = prices[i]
+        if np.isnan(price):
+            continue
+        buy_value = target_value - held_shares[i] * price
+        if buy_value > 0.0 and buy_value <= cash:
+            shares = np.floor(buy_value / price)
+            if shares > 0.0:
+                cash -= shares * price
+                bought[i] = shares
+    return bought, cash
@@ -1,6 +1,49 @@
+import logging
 import backtrader as bt
 import pandas as pd
+import numpy as np
+from numba import njit
 from data.get2 import get_stock_data
+from _kernels import atr_wilder, ema_sma_seed, crossover
+
+logger = logging.getLogger(__name__)  # 逐笔交易日志，默认WARNING级别下不格式化不输出
+
+EXIT_REASONS = ('', '移动止损', '死叉')  # 与scan_trailing返回的平仓原因编码一致
+
+@njit(cache=True)
+def scan_trailing(close, stop_line, golden, death):
+    """
+    移动止损状态机（编译执行）
+    移动止损依赖自身上一bar的取值，无法向量化，只能顺序扫描
+    :return: (开仓信号bar, 平仓信号bar（-1表示持有至结束）, 平仓原因（1=移动止损, 2=死叉）)
+    """
+    n = len(close)
+    entry_sig = np.empty(n, np.int64)
+    exit_sig = np.empty(n, np.int64)
+    reason = np.zeros(n, np.int8)
+    k = 0
+    in_pos = False
+    trailing = 0.0
+    for t in range(n):
+        if not in_pos:
+            # 信号在下一根K线开盘成交，最后一根K线的信号无法成交
+            if golden[t] and t + 1 < n:
+                entry_sig[k] = t
+                trailing = stop_line[t]
+                in_pos = True
+        else:
+            if stop_line[t] > trailing:
+                trailing = stop_line[t]
+            stop_triggered = close[t] < trailing
+            if (stop_triggered or death[t]) and t + 1 < n:
+                exit_sig[k] = t
+                reason[k] = 1 if stop_triggered else 2
+                k += 1
+                in_pos = False
+    if in_pos:
+        exit_sig[k] = -1
+        k += 1
+    return entry_sig[:k], exit_sig[:k], reason[:k]
 
 class BetterDoubleMAStrategy(bt.Strategy):
     """
@@ -24,62 +67,83 @@ class BetterDoubleMAStrategy(bt.Strategy):
         self.ema_fast = bt.indicators.EMA(period=self.p.fast_period)
         self.ema_slow = bt.indicators.EMA(period=self.p.slow_period)
         self.crossover = bt.indicators.CrossOver(self.ema_fast, self.ema_slow)
-        self.atr = bt.indicators.ATR(period=self.p.atr_period)
         
-        # 记录交易
-        self.trades = []
+        # ATR在回测前一次性编译计算（与backtrader的ATR一致），next()中按bar下标取值
+        self._atr_arr = atr_wilder(np.asarray(self.data.high.array),
+                                   np.asarray(self.data.low.array),
+                                   np.asarray(self.data.close.array),
+                                   self.p.atr_period)
+        
+        # 记录交易：按字段分别预分配数组，每根K线最多产生一笔记录
+        n = self.data.buflen()
+        self._trade_date = np.empty(n, 'datetime64[D]')
+        self._trade_kind = np.empty(n, np.int8)      # 0=买入, 1=卖出
+        self._trade_price = np.empty(n, np.float64)
+        self._trade_size = np.full(n, np.nan)
+        self._trade_stop = np.full(n, np.nan)
+        self._trade_reason = np.zeros(n, np.int8)    # EXIT_REASONS下标
+        self._ntrades = 0
         self.entry_price = None
         self.stop_price = None
         self.trailing_stop = None
         
     def next(self):
+        # 每根K线只读取一次行情和指标，之后都使用局部变量
+        close = self.data.close[0]
+        atr = self._atr_arr[len(self.data) - 1]
+        xover = self.crossover[0]
+        k = self.p.atr_multiplier
+        
         if not self.position:  # 没有持仓
-            if self.crossover > 0:  # 金叉
+            if xover > 0:  # 金叉
                 # 计算动态仓位
                 risk_amount = self.broker.getvalue() * self.p.risk_pct
-                stop_price = self.data.close[0] - self.p.atr_multiplier * self.atr[0]
-                size = risk_amount / (self.data.close[0] - stop_price)
+                stop_price = close - k * atr
+                size = risk_amount / (close - stop_price)
                 
                 # 执行买入
-                self.entry_price = self.data.close[0]
+                self.entry_price = close
                 self.stop_price = stop_price
                 self.trailing_stop = stop_price  # 初始移动止损价
                 self.buy(size=size)
                 
                 # 记录交易
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '买入',
-                    'price': self.data.close[0],
-                    'size': size,
-                    'stop': stop_price
-                })
-                print(f'金叉买入: 日期={self.data.datetime.date()}, '
-                      f'价格={self.data.close[0]:.2f}, 止损={stop_price:.2f}')
+                date = self.data.datetime.date()
+                i = self._ntrades
+                self._trade_date[i] = date
+                self._trade_kind[i] = 0
+                self._trade_price[i] = close
+                self._trade_size[i] = size
+                self._trade_stop[i] = stop_price
+                self._ntrades += 1
+                logger.info('金叉买入: 日期=%s, 价格=%.2f, 止损=%.2f', date, close, stop_price)
                 
         else:  # 持有仓位
             # 更新移动止损
-            potential_stop = self.data.close[0] - self.p.atr_multiplier * self.atr[0]
-            if potential_stop > self.trailing_stop:
-                self.trailing_stop = potential_stop
+            trailing = self.trailing_stop
+            potential_stop = close - k * atr
+            if potential_stop > trailing:
+                trailing = potential_stop
+                self.trailing_stop = trailing
             
             # 判断是否触及止损或死叉
-            stop_triggered = self.data.close[0] < self.trailing_stop
-            death_cross = self.crossover < 0
+            stop_triggered = close < trailing
+            death_cross = xover < 0
             
             if stop_triggered or death_cross:
                 self.close()  # 平仓
                 
                 # 记录交易
-                exit_reason = "移动止损" if stop_triggered else "死叉"
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '卖出',
-                    'price': self.data.close[0],
-                    'reason': exit_reason
-                })
-                print(f'{exit_reason}卖出: 日期={self.data.datetime.date()}, '
-                      f'价格={self.data.close[0]:.2f}')
+                reason = 1 if stop_triggered else 2
+                exit_reason = EXIT_REASONS[reason]
+                date = self.data.datetime.date()
+                i = self._ntrades
+                self._trade_date[i] = date
+                self._trade_kind[i] = 1
+                self._trade_price[i] = close
+                self._trade_reason[i] = reason
+                self._ntrades += 1
+                logger.info('%s卖出: 日期=%s, 价格=%.2f', exit_reason, date, close)
                 
                 # 重置状态
                 self.entry_price = None
@@ -89,8 +153,79 @@ class BetterDoubleMAStrategy(bt.Strategy):
     def stop(self):
         # 策略结束时打印交易汇总
         print('\n====== 交易记录 ======')
+        k = self._ntrades
+        for date, kind, price, size, stop, reason in zip(
+                self._trade_date[:k].tolist(), self._trade_kind[:k].tolist(),
+                self._trade_price[:k].tolist(), self._trade_size[:k].tolist(),
+                self._trade_stop[:k].tolist(), self._trade_reason[:k].tolist()):
+            if kind == 0:
+                print(f"买入: 日期={date}, 价格={price:.2f}, 数量={size:.2f}, 止损={stop:.2f}")
+            else:
+                print(f"{EXIT_REASONS[reason]}卖出: 日期={date}, 价格={price:.2f}")
+
+def vectorized_backtest(df, fast_period=5, slow_period=30, atr_period=14, risk_pct=0.02,
+                        atr_multiplier=3, cash=100000.0):
+    """
+    向量化回测，与BetterDoubleMAStrategy逻辑一致
+    - 指标和金叉/死叉信号整体计算，信号出现后下一根K线开盘成交
+    - 移动止损状态机交给scan_trailing编译执行，这里只按交易逐笔结算
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    high = df['high'].to_numpy(dtype=np.float64)
+    low = df['low'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    dates = df.index.to_numpy()
+    n = len(close)
+    
+    # 均线、ATR和交叉信号都与策略中的backtrader指标口径一致（EMA以前period根的简单平均为初值）
+    ema_fast = ema_sma_seed(close, fast_period)
+    ema_slow = ema_sma_seed(close, slow_period)
+    atr = atr_wilder(high, low, close, atr_period)
+    golden, death = crossover(ema_fast, ema_slow)
+    stop_line = close - atr_multiplier * atr
+    
+    entry_sig, exit_sig, exit_reason = scan_trailing(close, stop_line, golden, death)
+    
+    pnl = np.zeros(n)
+    trades = []
+    capital = cash  # 空仓时的账户资金，用于计算仓位
+    for i, signal, code in zip(entry_sig, exit_sig, exit_reason):
+        stop_price = stop_line[i]
+        size = capital * risk_pct / (close[i] - stop_price)
+        entry = i + 1
+        
+        if signal >= 0:
+            exit_bar = signal + 1
+            exit_price = open_[exit_bar]
+            reason = '移动止损' if code == 1 else '死叉'
+            pnl[exit_bar] += size * (exit_price - close[exit_bar - 1])
+        else:
+            exit_bar = n
+            exit_price = close[-1]
+            reason = '持有至结束'
+        
+        pnl[entry] += size * (close[entry] - open_[entry])
+        pnl[entry + 1:exit_bar] += size * np.diff(close[entry:exit_bar])
+        profit = size * (exit_price - open_[entry])
+        capital += profit
+        
+        trades.append({
+            'entry_date': dates[entry],
+            'entry_price': open_[entry],
+            'size': size,
+            'stop': stop_price,
+            'exit_date': dates[min(exit_bar, n - 1)],
+            'exit_price': exit_price,
+            'reason': reason,
+            'pnl': profit
+        })
+    
+    equity = cash + np.cumsum(pnl)
+    return {'trades': pd.DataFrame(trades), 'equity': pd.Series(equity, index=df.index)}
 
 # 运行回测
+logging.basicConfig(level=logging.WARNING, format='%(message)s')  # 需要逐笔日志时改为INFO
 cerebro = bt.Cerebro()
 df = get_stock_data()  # 获取股票数据
 data = bt.feeds.PandasData(dataname=df)
@@ -129,4 +264,10 @@ if trades['total']['total'] > 0:
     print('亏损交易: %d' % trades['lost']['total'])
     print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
 
+# 向量化回测结果（用于快速对照）
+vec = vectorized_backtest(df)
+print('\n======= 向量化回测 =======')
+print('交易次数: %d' % len(vec['trades']))
+print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
 cerebro.plot(style='candlestick')
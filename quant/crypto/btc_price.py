@@ -1,57 +1,143 @@
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
-import ta
 import time
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+# 复用TCP/TLS连接，多个时间级别的请求不再重复握手
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+CACHE_DIR = "kline_cache"  # K线磁盘缓存目录
+INTERVAL_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
 def get_current_price(symbol="BTCUSDT"):
-    url = f"https://api.binance.com/api/v3/ticker/price?symbol={symbol}"
-    response = requests.get(url)
+    url = "https://api.binance.com/api/v3/ticker/price"
+    response = _SESSION.get(url, params={"symbol": symbol}, timeout=10)
     data = response.json()
     return float(data['price'])
 
-def get_historical_data(symbol="BTCUSDT", interval="1h", limit=1000):
-    url = f"https://api.binance.com/api/v3/klines?symbol={symbol}&interval={interval}&limit={limit}"
-    response = requests.get(url)
+def _fetch_klines(symbol, interval, limit, start_time=None):
+    url = "https://api.binance.com/api/v3/klines"
+    params = {
+        "symbol": symbol,
+        "interval": interval,
+        "limit": limit
+    }
+    if start_time is not None:
+        params["startTime"] = start_time
+    response = _SESSION.get(url, params=params, timeout=10)
     data = response.json()
     
-    df = pd.DataFrame(data, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'])
-    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-    df.set_index('timestamp', inplace=True)
-    df = df[['open', 'high', 'low', 'close', 'volume']].astype(float)
+    # 只取需要的列直接构造，不生成完整的12列DataFrame；按列转置后显式指定dtype，避免类型推断
+    cols = list(zip(*data))
+    # 毫秒时间戳直接按datetime64[ms]解释，不再逐个经过to_datetime转换
+    ts_ms = np.asarray(cols[0], dtype=np.int64)
+    index = pd.DatetimeIndex(ts_ms.view('datetime64[ms]').astype('datetime64[ns]'), name='timestamp')
+    df = pd.DataFrame({
+        'open': np.asarray(cols[1], dtype=np.float64),
+        'high': np.asarray(cols[2], dtype=np.float64),
+        'low': np.asarray(cols[3], dtype=np.float64),
+        'close': np.asarray(cols[4], dtype=np.float64),
+        'volume': np.asarray(cols[5], dtype=np.float64)
+    }, index=index)
     
     return df
 
-def calculate_support_resistance_levels(symbol="BTCUSDT"):
-    timeframes = {'15m': 1000, '1h': 1000, '4h': 1000, '1d': 1000}
-    levels = {}
+def get_historical_data(symbol="BTCUSDT", interval="1h", limit=1000):
+    """
+    获取K线数据，优先读取磁盘缓存；缓存超过一个K线周期后只增量拉取新K线
+    缓存落后limit根K线以上时，一次增量请求补不到当前时间，改为重新拉取全部K线
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(CACHE_DIR, f"{symbol}_{interval}_{limit}.parquet")
+    interval_seconds = int(interval[:-1]) * INTERVAL_SECONDS[interval[-1]]
     
-    for timeframe, limit in timeframes.items():
-        df = get_historical_data(symbol, timeframe, limit)
-        
-        window = {'15m': 14, '1h': 24, '4h': 50, '1d': 200}[timeframe]
-        
-        indicator_bb = ta.volatility.BollingerBands(close=df['close'], window=window, window_dev=2)
-        df['bb_high'] = indicator_bb.bollinger_hband()
-        df['bb_low'] = indicator_bb.bollinger_lband()
-        
-        df['rsi'] = ta.momentum.RSIIndicator(close=df['close'], window=window).rsi()
+    cached = None
+    if os.path.exists(cache_file):
+        cached = pd.read_parquet(cache_file)
+        if os.path.getmtime(cache_file) > time.time() - interval_seconds:
+            return cached
+        # 最后一根K线距今不少于limit个周期时，缓存中的K线都不会保留，直接重新拉取
+        if time.time() - cached.index[-1].value / 10**9 >= limit * interval_seconds:
+            cached = None
+    
+    if cached is not None:
+        # 从缓存中最后一根（可能尚未收盘的）K线开始拉取，重叠部分以新数据为准
+        start_time = cached.index[-1].value // 10**6
+        df = pd.concat([cached, _fetch_klines(symbol, interval, limit, start_time)])
+        df = df[~df.index.duplicated(keep='last')].iloc[-limit:]
+    else:
+        df = _fetch_klines(symbol, interval, limit)
+    
+    df.to_parquet(cache_file)
+    return df
 
-        df['trend'] = np.where(df['close'] > df['close'].shift(window), 1, -1)
-        
-        resistance_levels = df[(df['rsi'] > 70) & (df['close'] > df['bb_high'])  | (df['trend'] == -1)]['close'].dropna()
-        support_levels = df[(df['rsi'] < 30) & (df['close'] < df['bb_low']) | (df['trend'] == 1)]['close'].dropna()
-        
-        levels[timeframe] = {
-            'R': [{"type": "R", "price": price, "timeframe": timeframe, "strength": count} 
-                  for price, count in resistance_levels.value_counts().items()],
-            'S': [{"type": "S", "price": price, "timeframe": timeframe, "strength": count} 
-                  for price, count in support_levels.value_counts().items()]
-        }
-        
-        levels[timeframe]['R'] = sorted(levels[timeframe]['R'], key=lambda x: x['strength'], reverse=True)
-        levels[timeframe]['S'] = sorted(levels[timeframe]['S'], key=lambda x: x['strength'], reverse=True)
+def _count_levels(prices, bin_size):
+    """
+    按价格区间聚合，否则原始浮点价格几乎不会重复，强度都是1
+    :return: (价位, 出现次数)，按次数降序，次数相同时按首次出现的先后
+    """
+    binned = np.round(prices / bin_size) * bin_size
+    uniq, first, counts = np.unique(binned, return_index=True, return_counts=True)
+    order = np.lexsort((first, -counts))
+    return uniq[order], counts[order]
+
+def _process_timeframe(symbol, timeframe, limit, bin_size):
+    """计算单个时间级别的支撑阻力位"""
+    df = get_historical_data(symbol, timeframe, limit)
+    
+    window = {'15m': 14, '1h': 24, '4h': 50, '1d': 200}[timeframe]
+    
+    close = df['close']
+    
+    # 布林带：同一个滚动窗口复用，计算均值和标准差
+    roll = close.rolling(window)
+    bb_mean = roll.mean()
+    bb_std = roll.std(ddof=0)
+    bb_high = bb_mean + 2 * bb_std
+    bb_low = bb_mean - 2 * bb_std
+    
+    # Wilder RSI
+    delta = close.diff().fillna(0)
+    up = delta.clip(lower=0).ewm(alpha=1 / window, min_periods=window, adjust=False).mean()
+    dn = (-delta.clip(upper=0)).ewm(alpha=1 / window, min_periods=window, adjust=False).mean()
+    rsi = 100 - 100 / (1 + up / dn)
+
+    # 趋势只需要布尔值，不必再物化成1/-1整数数组
+    up_trend = close > close.shift(window)
+    
+    # 筛选阶段全部在numpy数组上完成，指标不再写回df
+    close_arr = close.to_numpy()
+    rsi_arr = rsi.to_numpy()
+    up_arr = up_trend.to_numpy()
+    mask_r = ((rsi_arr > 70) & (close_arr > bb_high.to_numpy())) | ~up_arr
+    mask_s = ((rsi_arr < 30) & (close_arr < bb_low.to_numpy())) | up_arr
+    
+    r_prices, r_counts = _count_levels(close_arr[mask_r], bin_size)
+    s_prices, s_counts = _count_levels(close_arr[mask_s], bin_size)
+    
+    # 只为聚合后的价位构造字典，_count_levels已按强度降序排列，无需再排序
+    result = {
+        'R': [{"type": "R", "price": price, "timeframe": timeframe, "strength": count} 
+              for price, count in zip(r_prices.tolist(), r_counts.tolist())],
+        'S': [{"type": "S", "price": price, "timeframe": timeframe, "strength": count} 
+              for price, count in zip(s_prices.tolist(), s_counts.tolist())]
+    }
+    
+    return timeframe, result
+
+def calculate_support_resistance_levels(symbol="BTCUSDT", bin_size=100):
+    timeframes = {'15m': 1000, '1h': 1000, '4h': 1000, '1d': 1000}
+    
+    # 各时间级别相互独立，并发请求以重叠网络等待
+    with ThreadPoolExecutor(max_workers=len(timeframes)) as executor:
+        results = executor.map(lambda item: _process_timeframe(symbol, item[0], item[1], bin_size),
+                               timeframes.items())
+        levels = dict(results)
     
     return levels
 
@@ -77,35 +163,50 @@ def generate_support_resistance_map(current_price, resistance_levels, support_le
     levels_per_timeframe = 2  # 每个时间级别显示的支撑/阻力位数量
     
     timeframes = ['15m', '1h', '4h', '1d']
-    filtered_levels = []
+    tf_rank = {timeframe: i for i, timeframe in enumerate(timeframes)}
     
-    for timeframe in timeframes:
-        r_levels = [level for level in resistance_levels if level['timeframe'] == timeframe and min_price <= level['price'] <= max_price]
-        s_levels = [level for level in support_levels if level['timeframe'] == timeframe and min_price <= level['price'] <= max_price]
-        
-        filtered_levels.extend(r_levels[:levels_per_timeframe])
-        filtered_levels.extend(s_levels[:levels_per_timeframe])
+    # 所有支撑阻力位一次性转为结构化数组，之后的筛选和排序都在数组上完成
+    lv = np.array([(level['type'], level['timeframe'], level['price'], level['percentage'])
+                   for level in resistance_levels + support_levels],
+                  dtype=[('type', 'U1'), ('tf', 'U3'), ('price', 'f8'), ('pct', 'f8')])
+    idx = np.flatnonzero((lv['price'] >= min_price) & (lv['price'] <= max_price) & np.isin(lv['tf'], timeframes))
+    
+    # 按(时间级别, R/S)分组，组内保持原有的强度顺序，每组取前levels_per_timeframe个
+    group = np.array([tf_rank[tf] for tf in lv['tf'][idx]], dtype=np.int64) * 2 + (lv['type'][idx] == 'S')
+    order = np.lexsort((idx, group))
+    group_sorted = group[order]
+    uniq, starts = np.unique(group_sorted, return_index=True)
+    rank = np.arange(len(order)) - starts[np.searchsorted(uniq, group_sorted)]
+    filtered = lv[idx[order][rank < levels_per_timeframe]]
     
-    filtered_levels = sorted(filtered_levels + [{"type": None, "price": current_price, "timeframe": None, "percentage": 0}], key=lambda x: x["price"], reverse=True)
+    # 加入当前价格后按价格从高到低排列（价格相同时保持原顺序）
+    filtered = np.append(filtered, np.array([('', '', current_price, 0.0)], dtype=lv.dtype))
+    filtered = filtered[np.lexsort((np.arange(len(filtered)), -filtered['price']))]
     
-    for level in filtered_levels:
+    for level in filtered:
         if level['price'] == current_price:
             print(f">>> {level['price']:.0f} (当前价格⛳️)")
         else:
-            print(f"{level['type']} {level['price']:.0f} ({level['timeframe']}) {level['percentage']:+.2f}%")
+            print(f"{level['type']} {level['price']:.0f} ({level['tf']}) {level['pct']:+.2f}%")
     
     print("------------------------------------")
     print("支撑阻力统计（涨跌难度):")
-    ranges = [1, 3, 5, 10]
-    for r in ranges:
-        support_count = sum(1 for level in support_levels if abs(level['percentage']) <= r)
-        resistance_count = sum(1 for level in resistance_levels if abs(level['percentage']) <= r)
+    ranges = np.array([1, 3, 5, 10])
+    # 一次广播比较得到每个范围内的数量
+    s_pct = np.abs(np.fromiter((level['percentage'] for level in support_levels), dtype=np.float64, count=len(support_levels)))
+    r_pct = np.abs(np.fromiter((level['percentage'] for level in resistance_levels), dtype=np.float64, count=len(resistance_levels)))
+    support_counts = (s_pct[:, None] <= ranges[None, :]).sum(axis=0)
+    resistance_counts = (r_pct[:, None] <= ranges[None, :]).sum(axis=0)
+    for r, support_count, resistance_count in zip(ranges, support_counts, resistance_counts):
         print(f"{r}% 范围: 支撑 {support_count} | 阻力 {resistance_count}")
 
-current_price = get_current_price()
-support_resistance_levels = calculate_support_resistance_levels()
-resistance_levels, support_levels = analyze_levels_with_current_price(support_resistance_levels, current_price)
+def main():
+    current_price = get_current_price()
+    support_resistance_levels = calculate_support_resistance_levels()
+    resistance_levels, support_levels = analyze_levels_with_current_price(support_resistance_levels, current_price)
 
+    print(f"更新时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    generate_support_resistance_map(current_price, resistance_levels, support_levels)
 
-print(f"更新时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-generate_support_resistance_map(current_price, resistance_levels, support_levels)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
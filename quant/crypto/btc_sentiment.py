@@ -1,25 +1,47 @@
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import numpy as np
 import time
 from datetime import datetime
 
-def get_btc_data():
+# 复用TCP/TLS连接，避免每次请求重新握手
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+# K线缓存 {(symbol, interval, limit): (分钟时间桶, DataFrame)}
+_cache = {}
+CACHE_TTL = 60  # 缓存有效期（秒）
+
+def get_btc_data(symbol="BTCUSDT", interval="1d", limit=500):
+    """获取K线数据，同一分钟内的重复调用直接使用缓存"""
+    key = (symbol, interval, limit)
+    bucket = int(time.time() // CACHE_TTL)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == bucket:
+        return cached[1]
+
     url = "https://api.binance.com/api/v3/klines"
     params = {
-        "symbol": "BTCUSDT",
-        "interval": "1d",
-        "limit": 500
+        "symbol": symbol,
+        "interval": interval,
+        "limit": limit
     }
-    response = requests.get(url, params=params)
+    response = _SESSION.get(url, params=params, timeout=10)
     data = response.json()
-    df = pd.DataFrame(data, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'])
-    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-    df = df.set_index('timestamp')
-    df = df[['close', 'volume']].astype(float)
+    # 只取需要的列直接构造，不生成完整的12列DataFrame；按列转置后显式指定dtype，避免类型推断
+    cols = list(zip(*data))
+    # 毫秒时间戳直接按datetime64[ms]解释，不再逐个经过to_datetime转换
+    ts_ms = np.asarray(cols[0], dtype=np.int64)
+    index = pd.DatetimeIndex(ts_ms.view('datetime64[ms]').astype('datetime64[ns]'), name='timestamp')
+    df = pd.DataFrame({
+        'close': np.asarray(cols[4], dtype=np.float64),
+        'volume': np.asarray(cols[5], dtype=np.float64)
+    }, index=index)
+    _cache[key] = (bucket, df)
     return df
 
-def calculate_price_sentiment(df):
-    price_change = (df['close'].iloc[-1] - df['close'].iloc[0]) / df['close'].iloc[0]
+def calculate_price_sentiment(price_change):
     if price_change > 0.05:
         return 2  # 非常乐观
     elif price_change > 0.02:
@@ -31,9 +53,7 @@ def calculate_price_sentiment(df):
     else:
         return 0  # 中性
 
-def calculate_volume_sentiment(df):
-    avg_volume = df['volume'].mean()
-    last_volume = df['volume'].iloc[-1]
+def calculate_volume_sentiment(avg_volume, last_volume):
     if last_volume > avg_volume * 1.5:
         return 1  # 交易量增加，积极信号
     elif last_volume < avg_volume * 0.5:
@@ -41,18 +61,29 @@ def calculate_volume_sentiment(df):
     else:
         return 0  # 交易量正常
 
-def calculate_profit_index(df):
+def calculate_profit_index(price_change, avg_volume, last_volume):
     # 这里使用一个简单的方法计算获利指数，您可以根据需要调整
-    price_change = (df['close'].iloc[-1] - df['close'].iloc[0]) / df['close'].iloc[0]
-    volume_change = (df['volume'].iloc[-1] - df['volume'].mean()) / df['volume'].mean()
+    volume_change = (last_volume - avg_volume) / avg_volume
     profit_index = (price_change + volume_change) * 50 + 50  # 将范围调整到0-100%
     return max(0, min(100, profit_index))  # 确保结果在0-100%之间
 
+def _compute_sentiments(df):
+    """一次性提取各情绪指标共用的标量，子指标只接收浮点数"""
+    closes = df['close'].to_numpy()
+    volumes = df['volume'].to_numpy()
+    first_close, last_close = float(closes[0]), float(closes[-1])
+    price_change = (last_close - first_close) / first_close
+    avg_volume = float(volumes.mean())
+    last_volume = float(volumes[-1])
+    
+    price_sentiment = calculate_price_sentiment(price_change)
+    volume_sentiment = calculate_volume_sentiment(avg_volume, last_volume)
+    profit_index = calculate_profit_index(price_change, avg_volume, last_volume)
+    return price_sentiment, volume_sentiment, profit_index
+
 def calculate_overall_sentiment():
     df = get_btc_data()
-    price_sentiment = calculate_price_sentiment(df)
-    volume_sentiment = calculate_volume_sentiment(df)
-    profit_index = calculate_profit_index(df)
+    price_sentiment, volume_sentiment, profit_index = _compute_sentiments(df)
 
     overall_sentiment = price_sentiment + volume_sentiment
     
@@ -0,0 +1,82 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+import time
+import pandas as pd
+
+CACHE_DIR = "cache"  # 磁盘缓存目录
+
+def disk_cache(prefix, ttl=24 * 3600, fmt="pickle"):
+    """
+    两级缓存装饰器：进程内字典 + 磁盘文件
+    缓存文件按函数名和参数（补全默认值后）的sha256区分，超过ttl秒视为过期重新获取（ttl=None表示永不过期）
+    fmt="parquet"时按列式存储DataFrame，读取比pickle更快；其余结果用pickle
+    空结果（None或长度为0）不写入缓存，避免把失败的请求结果保存下来
+    先写临时文件再改名，写入中断或多个进程同时写入同一个键时不会留下半个文件；
+    读取失败的缓存文件（例如旧版本写坏的）视为未命中，删除后重新获取
+    """
+    ext = {"pickle": "pkl", "parquet": "parquet"}[fmt]
+
+    def load(path):
+        if fmt == "parquet":
+            return pd.read_parquet(path)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def dump(result, path):
+        # 临时文件与目标在同一目录，os.replace是原子操作；文件名带进程和线程号，并发写入互不覆盖
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if fmt == "parquet":
+                result.to_parquet(tmp_path)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(result, f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        memory = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # 位置参数和关键字参数的不同写法得到同一个键
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = hashlib.sha256(repr((func.__qualname__, sorted(bound.arguments.items()))).encode()).hexdigest()[:16]
+            now = time.time()
+
+            cached = memory.get(key)
+            if cached is not None and (ttl is None or now - cached[0] < ttl):
+                return cached[1]
+
+            path = os.path.join(CACHE_DIR, f"{prefix}_{key}.{ext}")
+            if os.path.exists(path):
+                mtime = os.path.getmtime(path)
+                if ttl is None or now - mtime < ttl:
+                    try:
+                        result = load(path)
+                    except Exception as e:
+                        print(f"缓存文件 {path} 读取失败，重新获取: {str(e)}")
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:  # 其他线程或进程已经删除
+                            pass
+                    else:
+                        memory[key] = (mtime, result)
+                        return result
+
+            result = func(*args, **kwargs)
+            if result is not None and len(result) > 0:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                dump(result, path)
+                memory[key] = (now, result)
+            return result
+        return wrapper
+    return decorator
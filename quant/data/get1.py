@@ -1,21 +1,17 @@
 import akshare as ak
 import pandas as pd 
+import numpy as np
 
 # 获取沪深300历史数据（示例）
 def get_stock_data(symbol="sh000300", period="daily"):
     df = ak.stock_zh_index_daily(symbol=symbol)
-    df.rename(columns={
-        'date': 'datetime',
-        'open': 'open',
-        'high': 'high',
-        'low': 'low',
-        'close': 'close',
-        'volume': 'volume'
-    }, inplace=True)
-    df['datetime'] = pd.to_datetime(df['datetime'])
-    df.set_index('datetime', inplace=True)
+    # 直接按需要的列构造，省去rename和额外拷贝
+    index = pd.DatetimeIndex(pd.to_datetime(df['date']), name='datetime')
+    df = pd.DataFrame({col: df[col].to_numpy(dtype=np.float64)
+                       for col in ['open', 'high', 'low', 'close', 'volume']}, index=index)
     return df
 
-# 保存数据到CSV
-data = get_stock_data()
-data.to_csv("sh000300.csv")
\ No newline at end of file
+if __name__ == "__main__":
+    # 保存数据到CSV
+    data = get_stock_data()
+    data.to_csv("sh000300.csv")
@@ -1,6 +1,11 @@
 import akshare as ak
 import pandas as pd 
+try:
+    from data.cache import disk_cache
+except ImportError:  # 直接运行本文件时data不是包
+    from cache import disk_cache
 
+@disk_cache("a_hist", fmt="parquet")  # 同一天内重复回测时直接读取，获取失败返回的None不缓存
 def get_stock_data(symbol="002123", start_date=None, end_date=None):
     """
     获取A股股票数据
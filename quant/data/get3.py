@@ -1,6 +1,11 @@
 import yfinance as yf
 import pandas as pd
+try:
+    from data.cache import disk_cache
+except ImportError:  # 直接运行本文件时data不是包
+    from cache import disk_cache
 
+@disk_cache("us", ttl=None, fmt="parquet")  # 起止日期固定的历史行情不会变化，缓存不过期
 def get_stock_data(symbol="VOO", start_date=None, end_date=None):
     """
     获取股票数据
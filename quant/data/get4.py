@@ -1,20 +1,21 @@
 import akshare as ak
 import pandas as pd
+import numpy as np
+try:
+    from data.cache import disk_cache
+except ImportError:  # 直接运行本文件时data不是包
+    from cache import disk_cache
 
+@disk_cache("etf", fmt="parquet")  # 返回全部历史行情，每天最多重新下载一次
 def get_stock_data(symbol="sh513380"):
     df = ak.fund_etf_hist_sina(symbol=symbol)
-    df.rename(columns={
-        'date': 'datetime',
-        'open': 'open',
-        'high': 'high',
-        'low': 'low',
-        'close': 'close',
-        'volume': 'volume'
-    }, inplace=True)
-    df['datetime'] = pd.to_datetime(df['datetime'])
-    df.set_index('datetime', inplace=True)
+    # 直接按需要的列构造，省去rename和额外拷贝
+    index = pd.DatetimeIndex(pd.to_datetime(df['date']), name='datetime')
+    df = pd.DataFrame({col: df[col].to_numpy(dtype=np.float64)
+                       for col in ['open', 'high', 'low', 'close', 'volume']}, index=index)
     return df
 
-# 保存数据到CSV
-data = get_stock_data()
-data.to_csv("sh563300.csv")
\ No newline at end of file
+if __name__ == "__main__":
+    # 保存数据到CSV
+    data = get_stock_data()
+    data.to_csv("sh563300.csv")
@@ -0,0 +1,29 @@
+import functools
+import threading
+import time
+
+def rate_limit(calls, period=1.0):
+    """
+    限速装饰器：所有线程合计每period秒最多调用calls次
+    各次调用按固定间隔排队，加锁只为领取发送时间，等待时不占用锁，其他线程可以继续排队
+    与disk_cache同时使用时放在内层，命中缓存的调用不必等待
+    """
+    interval = period / calls
+
+    def decorator(func):
+        lock = threading.Lock()
+        next_time = [0.0]  # 下一次允许调用的时间
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with lock:
+                start = max(time.monotonic(), next_time[0])
+                next_time[0] = start + interval
+            delay = start - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
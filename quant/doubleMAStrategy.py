@@ -1,6 +1,11 @@
+import logging
 import backtrader as bt
 import pandas as pd
+import numpy as np
 from data.get3 import get_stock_data
+from _kernels import sma_fsum, crossover
+
+logger = logging.getLogger(__name__)
 
 class DoubleMAStrategy(bt.Strategy):
     params = (('fast', 5), ('slow', 20))
@@ -11,15 +16,67 @@ class DoubleMAStrategy(bt.Strategy):
         self.crossover = bt.indicators.CrossOver(self.ma_fast, self.ma_slow)
 
     def next(self):
+        xover = self.crossover[0]
         if not self.position:
-            if self.crossover > 0:  # 金叉
+            if xover > 0:  # 金叉
                 self.buy(size=100)
-                print(f'金叉买入，价格：{self.data.close[0]:.2f}')
-        elif self.crossover < 0:    # 死叉
+                logger.info('金叉买入，价格：%.2f', self.data.close[0])
+        elif xover < 0:    # 死叉
             self.close()
-            print(f'死叉卖出，价格：{self.data.close[0]:.2f}')
+            logger.info('死叉卖出，价格：%.2f', self.data.close[0])
+
+def vectorized_backtest(df, fast=5, slow=20, size=100, cash=100000.0):
+    """
+    向量化双均线回测，与DoubleMAStrategy逻辑一致
+    - 金叉/死叉信号整体计算，信号出现后下一根K线开盘成交
+    - 金叉与死叉天然交替出现，持仓状态可直接向前填充得到
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    n = len(close)
+    
+    # 均线逐窗口精确求和、交叉沿用上一个非零差值，两者都与backtrader一致，价格平台上两线相等时不会误判交叉
+    ma_fast = sma_fsum(close, fast)
+    ma_slow = sma_fsum(close, slow)
+    golden, death = crossover(ma_fast, ma_slow)
+    
+    # 信号状态：金叉置1，死叉置0，其余沿用上一状态
+    state = pd.Series(np.where(golden, 1.0, np.where(death, 0.0, np.nan))).ffill().fillna(0).to_numpy()
+    # 第t根K线的持仓取决于t-1根K线收盘时的信号
+    held = np.concatenate(([False], state[:-1] > 0))
+    held_prev = np.concatenate(([False], held[:-1]))
+    entering = held & ~held_prev
+    exiting = ~held & held_prev
+    
+    # 逐K线盈亏：持有期间按收盘价变动计算，进出场当根按开盘价计算
+    prev_close = np.concatenate(([close[0]], close[:-1]))
+    pnl = np.zeros(n)
+    hold_mask = held & held_prev
+    pnl[hold_mask] = close[hold_mask] - prev_close[hold_mask]
+    pnl[entering] = close[entering] - open_[entering]
+    pnl[exiting] = open_[exiting] - prev_close[exiting]
+    equity = cash + size * np.cumsum(pnl)
+    
+    entry_idx = np.flatnonzero(entering)
+    exit_idx = np.flatnonzero(exiting)
+    exit_price = np.full(len(entry_idx), np.nan)
+    exit_price[:len(exit_idx)] = open_[exit_idx]
+    exit_date = np.full(len(entry_idx), np.datetime64('NaT'), dtype='datetime64[ns]')
+    exit_date[:len(exit_idx)] = df.index.to_numpy()[exit_idx]
+    trades = pd.DataFrame({
+        'entry_date': df.index.to_numpy()[entry_idx],
+        'entry_price': open_[entry_idx],
+        'exit_date': exit_date,
+        'exit_price': exit_price,
+        'size': size
+    })
+    trades['pnl'] = (trades['exit_price'] - trades['entry_price']) * size
+    
+    return {'trades': trades, 'equity': pd.Series(equity, index=df.index)}
 
 # 运行回测
+logging.basicConfig(level=logging.WARNING, format='%(message)s')  # 改为INFO可查看逐笔交易
 cerebro = bt.Cerebro()
 df = get_stock_data()  # 获取股票数据
 data = bt.feeds.PandasData(dataname=df)
@@ -47,4 +104,10 @@ print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
 print('回撤周期: %d 天' % drawdown['max']['len'])
 print('年化收益率: %.2f%%' % (returns['rnorm100']))
 
+# 向量化回测结果（用于快速对照）
+vec = vectorized_backtest(df, fast=DoubleMAStrategy.params.fast, slow=DoubleMAStrategy.params.slow)
+print('\n======= 向量化回测 =======')
+print('交易次数: %d' % len(vec['trades']))
+print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
 cerebro.plot(style='candlestick')
\ No newline at end of file
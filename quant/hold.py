@@ -1,7 +1,10 @@
+import logging
 import backtrader as bt
 import pandas as pd
 from data.get2 import get_stock_data
 
+logger = logging.getLogger(__name__)
+
 class HoldStrategy(bt.Strategy):
     """
     简单的买入持有策略
@@ -21,7 +24,7 @@ class HoldStrategy(bt.Strategy):
                 'type': '买入',
                 'price': self.data.close[0]
             })
-            print(f'买入: 日期={self.data.datetime.date()}, 价格={self.data.close[0]:.2f}')
+            logger.info('买入: 日期=%s, 价格=%.2f', self.data.datetime.date(), self.data.close[0])
 
     def stop(self):
         # 策略结束时打印交易汇总
@@ -30,6 +33,7 @@ class HoldStrategy(bt.Strategy):
             print(f"日期: {trade['date']}, 类型: {trade['type']}, 价格: {trade['price']:.2f}")
 
 # 运行回测
+logging.basicConfig(level=logging.WARNING, format='%(message)s')  # 改为INFO可查看逐笔交易
 cerebro = bt.Cerebro()
 df = get_stock_data()  # 获取股票数据
 data = bt.feeds.PandasData(dataname=df)
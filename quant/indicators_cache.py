@@ -0,0 +1,58 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data.cache import CACHE_DIR
+from _kernels import macd_ema3, atr_wilder
+
+# 各策略默认参数下共用的指标：MACD(12, 26, 9)、60日均线和标准差、200日趋势均线、14日ATR
+COLUMNS = ('macd_dif', 'macd_dea', 'sma60', 'std60', 'trend_ma200', 'atr14')
+INDICATORS_VERSION = 2  # 2: MACD的EMA改为以简单平均为初值
+
+def build_indicators(high, low, close):
+    """
+    在整段行情上计算共用指标，口径与各策略自行计算时一致
+    :return: {列名: numpy数组}
+    """
+    dif, dea, _ = macd_ema3(close, 12, 26, 9)
+    close_s = pd.Series(close)
+    roll = close_s.rolling(60)
+    return {
+        'macd_dif': dif,
+        'macd_dea': dea,
+        'sma60': roll.mean().to_numpy(),
+        'std60': roll.std(ddof=0).to_numpy(),  # 与backtrader的StdDev一致，使用总体标准差
+        'trend_ma200': close_s.rolling(200).mean().to_numpy(),
+        'atr14': atr_wilder(high, low, close, 14)
+    }
+
+def load_indicators(high, low, close):
+    """
+    读取共用指标，首次调用时计算并写入parquet
+    缓存文件按最高价、最低价、收盘价的sha256区分，行情变化后自动重新计算
+    指标口径变化时递增INDICATORS_VERSION，旧版本的缓存文件不再被读取
+    以内存映射方式读取，float64列直接转为numpy数组，不再复制（数组只读）
+    :return: {列名: numpy数组}
+    """
+    high, low, close = (np.ascontiguousarray(a, dtype=np.float64) for a in (high, low, close))
+    digest = hashlib.sha256()
+    for values in (high, low, close):
+        digest.update(values.tobytes())
+    path = os.path.join(CACHE_DIR, f"indicators_v{INDICATORS_VERSION}_{digest.hexdigest()[:16]}.parquet")
+
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # 先写临时文件再改名，参数扫描的多个进程同时写入时也不会读到半个文件
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(pa.table(build_indicators(high, low, close)), tmp_path)
+        os.replace(tmp_path, path)
+
+    table = pq.read_table(path, memory_map=True)
+    indicators = {}
+    for name in COLUMNS:
+        column = table.column(name)
+        chunk = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        indicators[name] = chunk.to_numpy(zero_copy_only=True)
+    return indicators
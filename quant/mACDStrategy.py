@@ -1,100 +1,188 @@
+import argparse
+import matplotlib
 import backtrader as bt
+import numpy as np
 import pandas as pd
 from data.get3 import get_stock_data
+from _kernels import macd_ema3, backtest_macd
+from indicators_cache import load_indicators
+from sweep import param_grid, add_analyzers, summarize, run_sweep
+
+TRADE_TYPES = ('买入', '卖出')  # 交易记录type字段的编码
+TRADE_DTYPE = [('date', 'datetime64[D]'), ('type', 'i1'), ('price', 'f8'),
+               ('DIF', 'f8'), ('DEA', 'f8'), ('MACD', 'f8')]
+
+def _precompute_signals(close, fastperiod=12, slowperiod=26, signalperiod=9, macd=None):
+    """
+    一次性计算整段行情的MACD及金叉/死叉信号，next()中只需按K线下标取值
+    :param macd: 已算好的(DIF, DEA)，为None时在close上计算
+    :return: (DIF, DEA, MACD柱, 买入信号, 卖出信号)，均为长度N的numpy数组
+    """
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    if macd is None:
+        dif, dea, bar = macd_ema3(close, fastperiod, slowperiod, signalperiod)
+    else:
+        dif, dea = macd
+        bar = dif - dea
+
+    # 金叉：柱由<=0变为>0；死叉：柱由>=0变为<0（DIF > DEA 与 柱 > 0 等价）
+    # 柱值恰好为0的K线按严格比较处理，与逐根比较DIF和DEA的结果一致
+    prev_bar = np.concatenate(([np.nan], bar[:-1]))
+    buy_mask = (bar > 0) & (prev_bar <= 0)
+    sell_mask = (bar < 0) & (prev_bar >= 0)
+
+    # 与backtrader MACD指标的预热期一致，之前的信号不可靠
+    warmup = slowperiod + signalperiod - 1
+    buy_mask[:warmup] = False
+    sell_mask[:warmup] = False
+    return dif, dea, bar, buy_mask, sell_mask
 
 class MACDStrategy(bt.Strategy):
     params = (
         ('fastperiod', 12),    # MACD快线周期
         ('slowperiod', 26),    # MACD慢线周期
         ('signalperiod', 9),   # MACD信号线周期
+        ('printlog', True),    # 是否在stop()中输出交易日志，参数扫描时关闭
     )
 
     def __init__(self):
-        # 添加MACD指标
-        self.macd = bt.indicators.MACD(
-            self.data.close,
-            period_me1=self.p.fastperiod,
-            period_me2=self.p.slowperiod,
-            period_signal=self.p.signalperiod
-        )
-        # DIF线
-        self.macd_dif = self.macd.macd
-        # DEA线（信号线）
-        self.macd_dea = self.macd.signal
-        # MACD柱状图
-        self.macd_bar = self.macd.macd - self.macd.signal
+        # 数据已预加载，直接在整段收盘价上计算MACD和买卖信号
+        close = np.asarray(self.data.close.array)
+        macd = None
+        if (self.p.fastperiod, self.p.slowperiod, self.p.signalperiod) == (12, 26, 9):
+            # 默认参数的MACD直接读取共用指标缓存
+            ind = load_indicators(self.data.high.array, self.data.low.array, close)
+            macd = ind['macd_dif'], ind['macd_dea']
+        (self.macd_dif, self.macd_dea, self.macd_bar,
+         self.buy_mask, self.sell_mask) = _precompute_signals(
+            close, self.p.fastperiod, self.p.slowperiod, self.p.signalperiod, macd)
         
-        # 记录交易
-        self.trades = []
+        # 记录交易：按K线数预分配结构化数组，每根K线最多一笔，按下标写入
+        self.trades = np.zeros(self.data.buflen(), dtype=TRADE_DTYPE)
+        self._ntrades = 0
+        self._log = []  # 回测过程中的日志，stop()时统一输出
+
+    def _record(self, i, kind, date, close):
+        """写入一笔交易记录，kind为TRADE_TYPES下标"""
+        self.trades[self._ntrades] = (date, kind, close, self.macd_dif[i], self.macd_dea[i], self.macd_bar[i])
+        self._ntrades += 1
 
     def next(self):
+        # 当前K线下标，每根K线只做一次数组取值
+        i = len(self.data) - 1
+        
         if not self.position:  # 没有持仓
             # MACD金叉（DIF上穿DEA）且MACD柱由负变正
-            if self.macd_dif[0] > self.macd_dea[0] and \
-               self.macd_dif[-1] <= self.macd_dea[-1] and \
-               self.macd_bar[0] > 0:
+            if self.buy_mask[i]:
+                close = self.data.close[0]
+                date = self.data.datetime.date()
                 self.buy()  # 买入信号
-                # 记录买入信息
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '买入',
-                    'price': self.data.close[0],
-                    'DIF': self.macd_dif[0],
-                    'DEA': self.macd_dea[0],
-                    'MACD': self.macd_bar[0]
-                })
-                print(f'买入: 日期={self.data.datetime.date()}, 价格={self.data.close[0]:.2f}')
+                self._record(i, 0, date, close)  # 记录买入信息
+                self._log.append(('买入: 日期=%s, 价格=%.2f', (date, close)))
                 
         else:  # 持有仓位
             # MACD死叉（DIF下穿DEA）且MACD柱由正变负
-            if self.macd_dif[0] < self.macd_dea[0] and \
-               self.macd_dif[-1] >= self.macd_dea[-1] and \
-               self.macd_bar[0] < 0:
+            if self.sell_mask[i]:
+                close = self.data.close[0]
+                date = self.data.datetime.date()
                 self.close()  # 卖出信号
-                # 记录卖出信息
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '卖出',
-                    'price': self.data.close[0],
-                    'DIF': self.macd_dif[0],
-                    'DEA': self.macd_dea[0],
-                    'MACD': self.macd_bar[0]
-                })
-                print(f'卖出: 日期={self.data.datetime.date()}, 价格={self.data.close[0]:.2f}')
+                self._record(i, 1, date, close)  # 记录卖出信息
+                self._log.append(('卖出: 日期=%s, 价格=%.2f', (date, close)))
 
     def stop(self):
+        if not self.p.printlog:
+            return
+        for fmt, args in self._log:
+            print(fmt % args)
         # 策略结束时打印交易汇总
         print('\n====== 交易记录 ======')
-        # for trade in self.trades:
-        #     print(f"日期: {trade['date']}, 类型: {trade['type']}, 价格: {trade['price']:.2f}")
+        # for trade in self.trades[:self._ntrades]:
+        #     print(f"日期: {trade['date']}, 类型: {TRADE_TYPES[trade['type']]}, 价格: {trade['price']:.2f}")
         #     print(f"DIF: {trade['DIF']:.4f}, DEA: {trade['DEA']:.4f}, MACD: {trade['MACD']:.4f}\n")
 
-# 运行回测
-cerebro = bt.Cerebro()
-df = get_stock_data()  # 获取股票数据
-data = bt.feeds.PandasData(dataname=df)
-cerebro.adddata(data)
-cerebro.addstrategy(MACDStrategy)
-cerebro.broker.setcash(100000.0)  # 设置初始资金
-cerebro.addsizer(bt.sizers.PercentSizer, percents=90)  # 仓位控制
-
-# 添加分析器
-cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 添加回撤分析器
-cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 添加收益分析器
-
-print('初始资金: %.2f' % cerebro.broker.getvalue())
-results = cerebro.run()
-strat = results[0]
-
-# 输出回撤相关指标
-drawdown = strat.analyzers.drawdown.get_analysis()
-print('\n====== 策略评估 ======')
-print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
-print('最大回撤周期: %d' % drawdown['max']['len'])
-
-# 输出收益相关指标
-returns = strat.analyzers.returns.get_analysis()
-print('年化收益率: %.2f%%' % (returns['rnorm100']))
-print('最终资金: %.2f' % cerebro.broker.getvalue())
-
-cerebro.plot(style='candlestick')
\ No newline at end of file
+def vectorized_backtest(df, fastperiod=12, slowperiod=26, signalperiod=9, percents=90, cash=100000.0):
+    """
+    编译执行的MACD回测，与MACDStrategy逻辑一致（不经过backtrader事件循环）
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    _, _, _, buy_mask, sell_mask = _precompute_signals(close, fastperiod, slowperiod, signalperiod)
+    equity, trades = backtest_macd(open_, close, buy_mask, sell_mask, cash, percents / 100)
+    
+    dates = df.index.to_numpy()
+    exit_idx = trades[:, 1].astype(np.int64)
+    trades = pd.DataFrame({
+        'entry_date': dates[trades[:, 0].astype(np.int64)],
+        'exit_date': np.where(exit_idx >= 0, dates[exit_idx], np.datetime64('NaT')),
+        'size': trades[:, 2],
+        'pnl': trades[:, 3]
+    })
+    return {'trades': trades, 'equity': pd.Series(equity, index=df.index)}
+
+def run_once(df, params):
+    """
+    单组参数运行一次回测，只返回核心指标（供参数扫描在子进程中调用）
+    :return: {'sharpe', 'max_drawdown', 'annual_return', 'final_value'}
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(bt.feeds.PandasData(dataname=df))
+    cerebro.addstrategy(MACDStrategy, printlog=False, **params)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    cerebro.addsizer(bt.sizers.PercentSizer, percents=90)
+    add_analyzers(cerebro)
+    strat = cerebro.run()[0]
+    return summarize(cerebro, strat)
+
+def run_backtest(plot=False):
+    # 运行回测
+    cerebro = bt.Cerebro()
+    df = get_stock_data()  # 获取股票数据
+    data = bt.feeds.PandasData(dataname=df)
+    cerebro.adddata(data)
+    cerebro.addstrategy(MACDStrategy)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    cerebro.addsizer(bt.sizers.PercentSizer, percents=90)  # 仓位控制
+
+    # 添加分析器
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 添加回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 添加收益分析器
+
+    print('初始资金: %.2f' % cerebro.broker.getvalue())
+    results = cerebro.run()
+    strat = results[0]
+
+    # 输出回撤相关指标
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    print('\n====== 策略评估 ======')
+    print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
+    print('最大回撤周期: %d' % drawdown['max']['len'])
+
+    # 输出收益相关指标
+    returns = strat.analyzers.returns.get_analysis()
+    print('年化收益率: %.2f%%' % (returns['rnorm100']))
+    print('最终资金: %.2f' % cerebro.broker.getvalue())
+
+    # 编译执行的回测结果（用于快速对照）
+    vec = vectorized_backtest(df)
+    print('\n====== 向量化回测 ======')
+    print('交易次数: %d' % len(vec['trades']))
+    print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
+    if plot:
+        cerebro.plot(style='candlestick')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MACD策略回测')
+    parser.add_argument('--plot', action='store_true', help='回测结束后绘制K线和交易图')
+    parser.add_argument('--sweep', action='store_true', help='多进程并行扫描参数网格')
+    parser.add_argument('--workers', type=int, default=None, help='参数扫描的进程数，默认CPU核数')
+    args = parser.parse_args()
+    if not args.plot:
+        matplotlib.use('Agg')  # 不绘图时跳过GUI后端初始化
+    if args.sweep:
+        grid = param_grid(fastperiod=(8, 12, 16), slowperiod=(21, 26, 34), signalperiod=(6, 9, 12))
+        results = run_sweep(run_once, get_stock_data(), grid, max_workers=args.workers)
+        print(results.to_string())
+    else:
+        run_backtest(plot=args.plot)
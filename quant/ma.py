@@ -1,7 +1,39 @@
+import argparse
+import matplotlib
 import backtrader as bt
 import pandas as pd
 import numpy as np
 from data.get4 import get_stock_data
+from _kernels import atr_wilder, backtest_mean_reversion
+from indicators_cache import load_indicators
+from sweep import param_grid, add_analyzers, summarize, run_sweep
+
+TRADE_TYPES = ('做多', '做空', '平仓')  # 交易记录type字段的编码
+TRADE_DTYPE = [('date', 'datetime64[D]'), ('type', 'i1'), ('price', 'f8'), ('size', 'f8'),
+               ('stop', 'f8'), ('zscore', 'f8'), ('profit', 'f8')]
+
+def _indicator_arrays(high, low, close, ma_period=60, trend_period=200, atr_period=14, entry_z=2.0):
+    """
+    向量化计算MeanReversionStrategy用到的全部指标，口径与backtrader指标一致
+    :return: (Z-Score, 动态入场阈值, 趋势均线, ATR)，预热期为NaN
+    """
+    if (ma_period, trend_period, atr_period) == (60, 200, 14):
+        # 默认周期的均线、标准差和ATR直接读取共用指标缓存
+        ind = load_indicators(high, low, close)
+        ma, std, trend, atr = ind['sma60'], ind['std60'], ind['trend_ma200'], ind['atr14']
+    else:
+        close_s = pd.Series(close)
+        roll = close_s.rolling(ma_period)
+        ma = roll.mean().to_numpy()
+        std = roll.std(ddof=0).to_numpy()  # backtrader的StdDev为总体标准差
+        trend = close_s.rolling(trend_period).mean().to_numpy()
+        atr = atr_wilder(high, low, close, atr_period)
+    z = (close - ma) / std
+    
+    # 相对波动率高时放宽、低时收紧入场阈值
+    vol = std / ma
+    threshold = np.where(vol > 0.03, entry_z * 0.8, np.where(vol < 0.01, entry_z * 1.2, entry_z))
+    return z, threshold, trend, atr
 
 class MeanReversionStrategy(bt.Strategy):
     """
@@ -19,185 +51,235 @@ class MeanReversionStrategy(bt.Strategy):
         ('risk_pct', 0.02),     # 单次风险比例
         ('max_drawdown', 0.05), # 最大回撤限制
         ('vol_window', 20),     # 波动率计算窗口
-        ('trend_ma', 200)       # 趋势过滤均线
+        ('trend_ma', 200),      # 趋势过滤均线
+        ('printlog', True),    # 是否在stop()中输出交易日志，参数扫描时关闭
     )
 
     def __init__(self):
-        # 计算指标
-        self.ma = bt.indicators.SMA(period=self.p.ma_period)
-        self.atr = bt.indicators.ATR(period=self.p.atr_period)
-        self.trend_ma = bt.indicators.SMA(period=self.p.trend_ma)
+        # 数据已预加载，全部指标以连续的float64数组一次算出，next()只按下标取值
+        self._close = np.asarray(self.data.close.array, dtype=np.float64)
+        self._z, self._threshold, self._trend, self._atr = _indicator_arrays(
+            np.asarray(self.data.high.array, dtype=np.float64),
+            np.asarray(self.data.low.array, dtype=np.float64),
+            self._close, self.p.ma_period, self.p.trend_ma, self.p.atr_period, self.p.entry_z)
         
-        # 计算Z-Score
-        self.std = bt.indicators.StdDev(self.data.close, period=self.p.ma_period)
-        self.zscore = (self.data.close - self.ma) / self.std
+        # 入场/离场条件整体计算，持仓相关的判断仍在next()中完成
+        self._ready = ~(np.isnan(self._z) | np.isnan(self._trend) | np.isnan(self._atr))
+        self._long_mask = (self._z < -self._threshold) & (self._close > self._trend)
+        self._short_mask = (self._z > self._threshold) & (self._close < self._trend)
+        self._exit_mask = (-self.p.exit_z < self._z) & (self._z < self.p.exit_z)
         
-        # 记录交易和绩效
-        self.trades = []
+        # 记录交易和绩效：按K线数预分配结构化数组，每根K线最多一笔，按下标写入
+        self.trades = np.zeros(self.data.buflen(), dtype=TRADE_DTYPE)
+        self.trades['profit'] = np.nan
+        self._ntrades = 0
         self.entry_price = None
         self.stop_price = None
         self.max_value = self.broker.getvalue()
         self.drawdown = 0
+        self._log = []  # 回测过程中的日志，stop()时统一输出
         
-    def get_dynamic_threshold(self):
-        """动态调整Z-Score阈值"""
-        vol = self.std[0] / self.ma[0]  # 相对波动率
-        base_z = self.p.entry_z
-        
-        if vol > 0.03:  # 高波动率环境
-            return base_z * 0.8
-        elif vol < 0.01:  # 低波动率环境
-            return base_z * 1.2
-        return base_z
+    def _record(self, date, kind, price, size=np.nan, stop=np.nan, zscore=np.nan, profit=np.nan):
+        """写入一笔交易记录，kind为TRADE_TYPES下标"""
+        self.trades[self._ntrades] = (date, kind, price, size, stop, zscore, profit)
+        self._ntrades += 1
         
     def next(self):
-        # 更新账户最大值和回撤
+        i = len(self.data) - 1  # 当前K线下标
+        if not self._ready[i]:
+            return
+        close = self._close[i]
+        zscore = self._z[i]
+        
+        # 更新账户最大值和回撤，账户价值每根K线只计算一次
         current_value = self.broker.getvalue()
-        self.max_value = max(self.max_value, current_value)
+        if current_value > self.max_value:
+            self.max_value = current_value
         self.drawdown = (self.max_value - current_value) / self.max_value
         
         # 检查是否触发风控
         if self.drawdown > self.p.max_drawdown:
             if self.position:
                 self.close()
-                print(f'触发风控平仓: 日期={self.data.datetime.date()}, 回撤={self.drawdown:.2%}')
+                self._log.append(('触发风控平仓: 日期=%s, 回撤=%.2f%%',
+                                  (self.data.datetime.date(), self.drawdown * 100)))
             return
             
-        # 获取动态阈值
-        dyn_threshold = self.get_dynamic_threshold()
-        
         if not self.position:  # 没有持仓
             # 计算动态仓位
-            risk_amount = self.broker.getvalue() * self.p.risk_pct
-            stop_range = self.atr[0] * 2
+            risk_amount = current_value * self.p.risk_pct
+            stop_range = self._atr[i] * 2
             size = risk_amount / stop_range
             
             # 开仓信号
-            if self.zscore[0] < -dyn_threshold:  # 做多信号
-                if self.data.close[0] > self.trend_ma[0]:  # 趋势过滤
-                    self.entry_price = self.data.close[0]
-                    self.stop_price = self.entry_price - stop_range
-                    self.buy(size=size)
-                    
-                    # 记录交易
-                    self.trades.append({
-                        'date': self.data.datetime.date(),
-                        'type': '做多',
-                        'price': self.entry_price,
-                        'size': size,
-                        'stop': self.stop_price,
-                        'zscore': self.zscore[0]
-                    })
-                    print(f'做多: 日期={self.data.datetime.date()}, '
-                          f'价格={self.entry_price:.2f}, Z值={self.zscore[0]:.2f}')
-                    
-            elif self.zscore[0] > dyn_threshold:  # 做空信号
-                if self.data.close[0] < self.trend_ma[0]:  # 趋势过滤
-                    self.entry_price = self.data.close[0]
-                    self.stop_price = self.entry_price + stop_range
-                    self.sell(size=size)
-                    
-                    # 记录交易
-                    self.trades.append({
-                        'date': self.data.datetime.date(),
-                        'type': '做空',
-                        'price': self.entry_price,
-                        'size': size,
-                        'stop': self.stop_price,
-                        'zscore': self.zscore[0]
-                    })
-                    print(f'做空: 日期={self.data.datetime.date()}, '
-                          f'价格={self.entry_price:.2f}, Z值={self.zscore[0]:.2f}')
-                    
+            if self._long_mask[i]:  # 做多信号（已含趋势过滤）
+                date = self.data.datetime.date()
+                self.entry_price = close
+                self.stop_price = self.entry_price - stop_range
+                self.buy(size=size)
+                
+                # 记录交易
+                self._record(date, 0, close, size=size, stop=self.stop_price, zscore=zscore)
+                self._log.append(('做多: 日期=%s, 价格=%.2f, Z值=%.2f', (date, close, zscore)))
+                
+            elif self._short_mask[i]:  # 做空信号（已含趋势过滤）
+                date = self.data.datetime.date()
+                self.entry_price = close
+                self.stop_price = self.entry_price + stop_range
+                self.sell(size=size)
+                
+                # 记录交易
+                self._record(date, 1, close, size=size, stop=self.stop_price, zscore=zscore)
+                self._log.append(('做空: 日期=%s, 价格=%.2f, Z值=%.2f', (date, close, zscore)))
+                
         else:  # 持有仓位
             # 检查止损
             if self.position.size > 0:  # 多仓
-                if self.data.close[0] < self.stop_price:
+                if close < self.stop_price:
                     self.close()
-                    print(f'多仓止损: 日期={self.data.datetime.date()}, '
-                          f'价格={self.data.close[0]:.2f}')
+                    self._log.append(('多仓止损: 日期=%s, 价格=%.2f', (self.data.datetime.date(), close)))
                     return
                     
             else:  # 空仓
-                if self.data.close[0] > self.stop_price:
+                if close > self.stop_price:
                     self.close()
-                    print(f'空仓止损: 日期={self.data.datetime.date()}, '
-                          f'价格={self.data.close[0]:.2f}')
+                    self._log.append(('空仓止损: 日期=%s, 价格=%.2f', (self.data.datetime.date(), close)))
                     return
                     
             # 检查是否满足平仓条件
-            if abs(self.zscore[0]) < self.p.exit_z:
+            if self._exit_mask[i]:
+                date = self.data.datetime.date()
                 self.close()
-                profit = (self.data.close[0] - self.entry_price) * self.position.size
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '平仓',
-                    'price': self.data.close[0],
-                    'profit': profit,
-                    'zscore': self.zscore[0]
-                })
-                print(f'平仓: 日期={self.data.datetime.date()}, '
-                      f'价格={self.data.close[0]:.2f}, 收益={profit:.2f}')
+                profit = (close - self.entry_price) * self.position.size
+                self._record(date, 2, close, zscore=zscore, profit=profit)
+                self._log.append(('平仓: 日期=%s, 价格=%.2f, 收益=%.2f', (date, close, profit)))
                 
                 self.entry_price = None
                 self.stop_price = None
 
     def stop(self):
+        if not self.p.printlog:
+            return
+        for fmt, args in self._log:
+            print(fmt % args)
         # 策略结束时打印交易汇总
         print('\n====== 交易记录 ======')
-        total_trades = len([t for t in self.trades if t['type'] in ['做多', '做空']])
-        winning_trades = len([t for t in self.trades if t.get('profit', 0) > 0])
+        trades = self.trades[:self._ntrades]
+        total_trades = np.count_nonzero(trades['type'] < 2)
+        winning_trades = np.count_nonzero(trades['profit'] > 0)
         
         print(f'总交易次数: {total_trades}')
         if total_trades > 0:
             win_rate = winning_trades / total_trades * 100
             print(f'胜率: {win_rate:.2f}%')
         
-        for trade in self.trades:
-            if trade['type'] in ['做多', '做空']:
-                print(f"{trade['type']}: 日期={trade['date']}, "
-                      f"价格={trade['price']:.2f}, Z值={trade['zscore']:.2f}")
+        for date, kind, price, zscore, profit in zip(
+                trades['date'].tolist(), trades['type'].tolist(), trades['price'].tolist(),
+                trades['zscore'].tolist(), trades['profit'].tolist()):
+            if kind < 2:
+                print(f"{TRADE_TYPES[kind]}: 日期={date}, "
+                      f"价格={price:.2f}, Z值={zscore:.2f}")
             else:
-                print(f"平仓: 日期={trade['date']}, "
-                      f"价格={trade['price']:.2f}, 收益={trade.get('profit', 0):.2f}")
-
-# 运行回测
-cerebro = bt.Cerebro()
-df = get_stock_data()  # 获取股票数据
-data = bt.feeds.PandasData(dataname=df)
-cerebro.adddata(data)
-cerebro.addstrategy(MeanReversionStrategy)
-cerebro.broker.setcash(100000.0)  # 设置初始资金
-
-# 添加分析器
-cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
-cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
-cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
-cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
-
-print('初始资金: %.2f' % cerebro.broker.getvalue())
-results = cerebro.run()
-strat = results[0]
-
-# 获取回测结果
-drawdown = strat.analyzers.drawdown.get_analysis()
-returns = strat.analyzers.returns.get_analysis()
-sharpe = strat.analyzers.sharpe.get_analysis()
-trades = strat.analyzers.trades.get_analysis()
-
-print('\n======= 核心指标 =======')
-print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
-print('回撤周期: %d 天' % drawdown['max']['len'])
-print('年化收益率: %.2f%%' % (returns['rnorm100']))
-print('夏普比率: %.2f' % sharpe['sharperatio'])
-print('最终资金: %.2f' % cerebro.broker.getvalue())
-
-# 输出交易统计
-print('\n======= 交易统计 =======')
-print('总交易次数: %d' % trades['total']['total'])
-if trades['total']['total'] > 0:
-    print('盈利交易: %d' % trades['won']['total'])
-    print('亏损交易: %d' % trades['lost']['total'])
-    print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
-
-cerebro.plot(style='candlestick')
+                print(f"平仓: 日期={date}, "
+                      f"价格={price:.2f}, 收益={profit:.2f}")
+
+def vectorized_backtest(df, ma_period=60, entry_z=2.0, exit_z=0.5, atr_period=14, risk_pct=0.02,
+                        max_drawdown=0.05, trend_ma=200, cash=100000.0):
+    """
+    编译执行的均线回归回测，与MeanReversionStrategy逻辑一致（不经过backtrader事件循环）
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    high = df['high'].to_numpy(dtype=np.float64)
+    low = df['low'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    z, threshold, trend, atr = _indicator_arrays(high, low, close, ma_period, trend_ma, atr_period, entry_z)
+    equity, trades = backtest_mean_reversion(open_, close, z, threshold, trend, atr, cash,
+                                             risk_pct, exit_z, max_drawdown)
+    
+    dates = df.index.to_numpy()
+    exit_idx = trades[:, 1].astype(np.int64)
+    trades = pd.DataFrame({
+        'entry_date': dates[trades[:, 0].astype(np.int64)],
+        'exit_date': np.where(exit_idx >= 0, dates[exit_idx], np.datetime64('NaT')),
+        'size': trades[:, 2],
+        'pnl': trades[:, 3]
+    })
+    return {'trades': trades, 'equity': pd.Series(equity, index=df.index)}
+
+def run_once(df, params):
+    """
+    单组参数运行一次回测，只返回核心指标（供参数扫描在子进程中调用）
+    :return: {'sharpe', 'max_drawdown', 'annual_return', 'final_value'}
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(bt.feeds.PandasData(dataname=df))
+    cerebro.addstrategy(MeanReversionStrategy, printlog=False, **params)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    add_analyzers(cerebro)
+    strat = cerebro.run()[0]
+    return summarize(cerebro, strat)
+
+def run_backtest(plot=False):
+    # 运行回测
+    cerebro = bt.Cerebro()
+    df = get_stock_data()  # 获取股票数据
+    data = bt.feeds.PandasData(dataname=df)
+    cerebro.adddata(data)
+    cerebro.addstrategy(MeanReversionStrategy)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+
+    # 添加分析器
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
+
+    print('初始资金: %.2f' % cerebro.broker.getvalue())
+    results = cerebro.run()
+    strat = results[0]
+
+    # 获取回测结果
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    returns = strat.analyzers.returns.get_analysis()
+    sharpe = strat.analyzers.sharpe.get_analysis()
+    trades = strat.analyzers.trades.get_analysis()
+
+    print('\n======= 核心指标 =======')
+    print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
+    print('回撤周期: %d 天' % drawdown['max']['len'])
+    print('年化收益率: %.2f%%' % (returns['rnorm100']))
+    print('夏普比率: %.2f' % sharpe['sharperatio'])
+    print('最终资金: %.2f' % cerebro.broker.getvalue())
+
+    # 输出交易统计
+    print('\n======= 交易统计 =======')
+    print('总交易次数: %d' % trades['total']['total'])
+    if trades['total']['total'] > 0:
+        print('盈利交易: %d' % trades['won']['total'])
+        print('亏损交易: %d' % trades['lost']['total'])
+        print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
+
+    # 编译执行的回测结果（用于快速对照）
+    vec = vectorized_backtest(df)
+    print('\n======= 向量化回测 =======')
+    print('交易次数: %d' % len(vec['trades']))
+    print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
+    if plot:
+        cerebro.plot(style='candlestick')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='均线回归策略回测')
+    parser.add_argument('--plot', action='store_true', help='回测结束后绘制K线和交易图')
+    parser.add_argument('--sweep', action='store_true', help='多进程并行扫描参数网格')
+    parser.add_argument('--workers', type=int, default=None, help='参数扫描的进程数，默认CPU核数')
+    args = parser.parse_args()
+    if not args.plot:
+        matplotlib.use('Agg')  # 不绘图时跳过GUI后端初始化
+    if args.sweep:
+        grid = param_grid(ma_period=(20, 40, 60, 90), entry_z=(1.5, 2.0, 2.5))
+        results = run_sweep(run_once, get_stock_data(), grid, max_workers=args.workers)
+        print(results.to_string())
+    else:
+        run_backtest(plot=args.plot)
@@ -1,6 +1,25 @@
+import argparse
+import matplotlib
 import backtrader as bt
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 from data.get3 import get_stock_data
+from _kernels import macd_ema3
+from indicators_cache import load_indicators
+from sweep import param_grid, add_analyzers, summarize, run_sweep
+
+def rolling_extreme(values, window):
+    """
+    滑动窗口最大/最小值，基于sliding_window_view一次性归约
+    :return: (最大值, 最小值)，下标j对应以j结尾的窗口，窗口未满时为NaN
+    """
+    view = sliding_window_view(values, window)
+    hi = np.full(len(values), np.nan)
+    lo = np.full(len(values), np.nan)
+    hi[window - 1:] = view.max(axis=1)
+    lo[window - 1:] = view.min(axis=1)
+    return hi, lo
 
 class MACDDivergenceStrategy(bt.Strategy):
     params = (
@@ -8,81 +27,128 @@ class MACDDivergenceStrategy(bt.Strategy):
         ('slowperiod', 26),    # MACD慢线周期
         ('signalperiod', 9),   # MACD信号线周期
         ('lookback', 20),      # 用于判断背离的回看周期
+        ('printlog', True),    # 是否在stop()中输出交易日志，参数扫描时关闭
     )
 
     def __init__(self):
-        # 添加MACD指标
-        self.macd = bt.indicators.MACD(
-            self.data.close,
-            period_me1=self.p.fastperiod,
-            period_me2=self.p.slowperiod,
-            period_signal=self.p.signalperiod
-        )
-        # DIF线
-        self.macd_dif = self.macd.macd
-        # DEA线（信号线）
-        self.macd_dea = self.macd.signal
-        # MACD柱状图
-        self.macd_bar = self.macd.macd - self.macd.signal
+        # 数据已预加载，MACD在整段收盘价上一次算出，不再经过backtrader指标
+        close = np.ascontiguousarray(self.data.close.array, dtype=np.float64)
+        if (self.p.fastperiod, self.p.slowperiod, self.p.signalperiod) == (12, 26, 9):
+            # 默认参数的MACD直接读取共用指标缓存
+            ind = load_indicators(self.data.high.array, self.data.low.array, close)
+            self.macd_dif, self.macd_dea = ind['macd_dif'], ind['macd_dea']
+            self.macd_bar = self.macd_dif - self.macd_dea
+        else:
+            self.macd_dif, self.macd_dea, self.macd_bar = macd_ema3(
+                close, self.p.fastperiod, self.p.slowperiod, self.p.signalperiod)
+        # MACD柱从下标slowperiod+signalperiod-2起有效（与backtrader MACD指标的预热期一致），
+        # 背离判断还要用到之前lookback-1根的MACD柱，所以第一根判断的K线下标为
+        # slowperiod+signalperiod+lookback-3，之前的K线不判断
+        self._warmup = self.p.slowperiod + self.p.signalperiod + self.p.lookback - 3
+        
+        # 用于判断高点和低点：以每根K线结尾的lookback窗口内最高/最低收盘价
+        self.highest_price, self.lowest_price = rolling_extreme(close, self.p.lookback)
+        # 以每根K线结尾的lookback-1窗口内MACD柱最大/最小值
+        self._macd_max, self._macd_min = rolling_extreme(self.macd_bar, self.p.lookback - 1)
         
-        # 用于判断高点和低点
-        self.highest_price = bt.indicators.Highest(self.data.close, period=self.p.lookback)
-        self.lowest_price = bt.indicators.Lowest(self.data.close, period=self.p.lookback)
+        self._log = []  # 回测过程中的日志，stop()时统一输出
         
-    def is_price_making_higher_high(self):
+    def is_price_making_higher_high(self, close, i):
         """判断价格是否创新高"""
-        return self.data.close[0] > self.highest_price[-1]
+        return close > self.highest_price[i - 1]
         
-    def is_price_making_lower_low(self):
+    def is_price_making_lower_low(self, close, i):
         """判断价格是否创新低"""
-        return self.data.close[0] < self.lowest_price[-1]
+        return close < self.lowest_price[i - 1]
         
-    def is_macd_making_lower_high(self):
+    def is_macd_making_lower_high(self, i):
         """判断MACD是否形成更低的高点"""
-        return self.macd_bar[0] < max([self.macd_bar[-i] for i in range(1, self.p.lookback)])
+        return self.macd_bar[i] < self._macd_max[i - 1]
         
-    def is_macd_making_higher_low(self):
+    def is_macd_making_higher_low(self, i):
         """判断MACD是否形成更高的低点"""
-        return self.macd_bar[0] > min([self.macd_bar[-i] for i in range(1, self.p.lookback)])
+        return self.macd_bar[i] > self._macd_min[i - 1]
 
     def next(self):
+        i = len(self.data) - 1  # 当前K线下标
+        if i < self._warmup:
+            return
+        close = self.data.close[0]
+        
         if not self.position:  # 没有持仓
             # 判断底背离：价格创新低但MACD没有创新低
-            if self.is_price_making_lower_low() and self.is_macd_making_higher_low():
+            if self.is_price_making_lower_low(close, i) and self.is_macd_making_higher_low(i):
                 self.buy()  # 买入信号
-                print(f'底背离买入，价格：{self.data.close[0]:.2f}')
+                self._log.append(('底背离买入，价格：%.2f', (close,)))
                 
         else:  # 持有仓位
             # 判断顶背离：价格创新高但MACD没有创新高
-            if self.is_price_making_higher_high() and self.is_macd_making_lower_high():
+            if self.is_price_making_higher_high(close, i) and self.is_macd_making_lower_high(i):
                 self.close()  # 卖出信号
-                print(f'顶背离卖出，价格：{self.data.close[0]:.2f}')
+                self._log.append(('顶背离卖出，价格：%.2f', (close,)))
+
+    def stop(self):
+        if not self.p.printlog:
+            return
+        for fmt, args in self._log:
+            print(fmt % args)
+
+def run_once(df, params):
+    """
+    单组参数运行一次回测，只返回核心指标（供参数扫描在子进程中调用）
+    :return: {'sharpe', 'max_drawdown', 'annual_return', 'final_value'}
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(bt.feeds.PandasData(dataname=df))
+    cerebro.addstrategy(MACDDivergenceStrategy, printlog=False, **params)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    cerebro.addsizer(bt.sizers.PercentSizer, percents=90)
+    add_analyzers(cerebro)
+    strat = cerebro.run()[0]
+    return summarize(cerebro, strat)
+
+def run_backtest(plot=False):
+    # 运行回测
+    cerebro = bt.Cerebro()
+    df = get_stock_data()  # 获取股票数据
+    data = bt.feeds.PandasData(dataname=df)
+    cerebro.adddata(data)
+    cerebro.addstrategy(MACDDivergenceStrategy)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    cerebro.addsizer(bt.sizers.PercentSizer, percents=90)  # 仓位控制
 
-# 运行回测
-cerebro = bt.Cerebro()
-df = get_stock_data()  # 获取股票数据
-data = bt.feeds.PandasData(dataname=df)
-cerebro.adddata(data)
-cerebro.addstrategy(MACDDivergenceStrategy)
-cerebro.broker.setcash(100000.0)  # 设置初始资金
-cerebro.addsizer(bt.sizers.PercentSizer, percents=90)  # 仓位控制
+    # 添加分析器
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 添加回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 添加收益分析器
 
-# 添加分析器
-cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 添加回撤分析器
-cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 添加收益分析器
+    print('初始资金: %.2f' % cerebro.broker.getvalue())
+    results = cerebro.run()
+    strat = results[0]
 
-print('初始资金: %.2f' % cerebro.broker.getvalue())
-results = cerebro.run()
-strat = results[0]
+    # 输出回撤相关指标
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
+    print('最大回撤周期: %d' % drawdown['max']['len'])
 
-# 输出回撤相关指标
-drawdown = strat.analyzers.drawdown.get_analysis()
-print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
-print('最大回撤周期: %d' % drawdown['max']['len'])
+    # 输出收益相关指标
+    returns = strat.analyzers.returns.get_analysis()
+    print('年化收益率: %.2f%%' % (returns['rnorm100']))
+    print('最终资金: %.2f' % cerebro.broker.getvalue())
 
-# 输出收益相关指标
-returns = strat.analyzers.returns.get_analysis()
-print('年化收益率: %.2f%%' % (returns['rnorm100']))
-print('最终资金: %.2f' % cerebro.broker.getvalue())
+    if plot:
+        cerebro.plot(style='candlestick')
 
-cerebro.plot(style='candlestick')
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MACD背离策略回测')
+    parser.add_argument('--plot', action='store_true', help='回测结束后绘制K线和交易图')
+    parser.add_argument('--sweep', action='store_true', help='多进程并行扫描参数网格')
+    parser.add_argument('--workers', type=int, default=None, help='参数扫描的进程数，默认CPU核数')
+    args = parser.parse_args()
+    if not args.plot:
+        matplotlib.use('Agg')  # 不绘图时跳过GUI后端初始化
+    if args.sweep:
+        grid = param_grid(fastperiod=(8, 12, 16), lookback=(10, 20, 30, 40))
+        results = run_sweep(run_once, get_stock_data(), grid, max_workers=args.workers)
+        print(results.to_string())
+    else:
+        run_backtest(plot=args.plot)
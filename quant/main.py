@@ -1,8 +1,31 @@
 import akshare as ak
 import time
+from datetime import datetime, timedelta
 from rotation_strategy import RotationStrategy
+from data.cache import disk_cache
 import logging
 
+# A股交易时段（未处理节假日，节假日运行时策略取不到新数据，不影响结果）
+TRADING_SESSIONS = (("09:30", "11:30"), ("13:00", "15:00"))
+RUN_INTERVAL = timedelta(hours=1)  # 交易时段内的运行间隔
+
+def next_run_time(now):
+    """计算下一次运行时间：工作日交易时段内，从开盘起每隔RUN_INTERVAL运行一次"""
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(8):
+        if day.weekday() < 5:
+            for start, end in TRADING_SESSIONS:
+                h, m = map(int, start.split(':'))
+                run_at = day.replace(hour=h, minute=m)
+                h, m = map(int, end.split(':'))
+                session_end = day.replace(hour=h, minute=m)
+                while run_at < session_end:
+                    if run_at > now:
+                        return run_at
+                    run_at += RUN_INTERVAL
+        day += timedelta(days=1)
+
+@disk_cache("pool")  # 成分股最多按月调整，一天内直接使用缓存
 def get_stock_pool():
     """获取股票池（这里使用沪深300成分股作为示例）"""
     try:
@@ -10,7 +33,7 @@ def get_stock_pool():
         hs300 = ak.index_stock_cons_weight_csindex(symbol="000300")
         return hs300['成分券代码'].tolist()
     except Exception as e:
-        logging.error(f"获取股票池失败: {str(e)}")
+        logging.error("获取股票池失败: %s", e)
         return []
 
 def main():
@@ -29,24 +52,28 @@ def main():
         logging.error("获取股票池失败，程序退出")
         return
     
-    logging.info(f"初始化完成，股票池大小: {len(stock_pool)}")
+    logging.info("初始化完成，股票池大小: %d", len(stock_pool))
     
     # 运行策略
     while True:
         try:
+            # 缓存超过一天后才重新请求成分股，失败时沿用上一次的股票池
+            stock_pool = get_stock_pool() or stock_pool
             strategy.run_strategy(stock_pool)
             
             # 打印当前组合状态
             status = strategy.get_portfolio_status()
             logging.info("当前组合状态:")
             for key, value in status.items():
-                logging.info(f"{key}: {value}")
+                logging.info("%s: %s", key, value)
             
-            # 等待下一个交易周期
-            time.sleep(60 * 60)  # 每小时运行一次
+            # 休眠到下一个交易时段的运行时间，收盘后和周末不再空转
+            next_run = next_run_time(datetime.now())
+            logging.info("下次运行时间: %s", next_run)
+            time.sleep(max(0, (next_run - datetime.now()).total_seconds()))
             
         except Exception as e:
-            logging.error(f"策略运行出错: {str(e)}")
+            logging.error("策略运行出错: %s", e)
             time.sleep(60)  # 出错后等待1分钟再试
 
 if __name__ == "__main__":
@@ -1,8 +1,17 @@
+import argparse
+import matplotlib
 import backtrader as bt
 import pandas as pd
 import numpy as np
 # from scipy import stats
 from data.get3 import get_stock_data
+from _kernels import backtest_pair
+from sweep import param_grid, add_analyzers, summarize, run_sweep
+
+# 交易记录type字段的编码
+TRADE_TYPES = ('开仓-做空spread', '开仓-做多spread', '平仓-Z-Score回归', '平仓-止损', '平仓-获利了结')
+TRADE_DTYPE = [('date', 'datetime64[D]'), ('type', 'i1'), ('stock1_price', 'f8'),
+               ('stock2_price', 'f8'), ('z_score', 'f8'), ('profit_pct', 'f8')]
 
 class PairTradingStrategy(bt.Strategy):
     """
@@ -18,7 +27,8 @@ class PairTradingStrategy(bt.Strategy):
         ('window', 20),        # 计算均值和标准差的窗口
         ('stop_loss', 0.03),   # 止损比例
         ('take_profit', 0.05), # 获利目标
-        ('beta', 0.8)          # 对冲比率
+        ('beta', 0.8),         # 对冲比率
+        ('printlog', True),    # 是否在stop()中输出交易日志，参数扫描时关闭
     )
 
     def __init__(self):
@@ -26,179 +36,249 @@ class PairTradingStrategy(bt.Strategy):
         self.stock1 = self.datas[0]  # 主要交易股票
         self.stock2 = self.datas[1]  # 对冲股票
         
-        # 计算价差
-        self.spread = bt.indicators.PctChange(self.stock1.close, period=1) - \
-                     self.p.beta * bt.indicators.PctChange(self.stock2.close, period=1)
-        
-        # 计算移动均值和标准差
-        self.spread_mean = bt.indicators.SMA(self.spread, period=self.p.window)
-        self.spread_std = bt.indicators.StdDev(self.spread, period=self.p.window)
+        # 数据已预加载，价差和Z-Score在整段行情上一次算出
+        self._z, self._spread = self._precompute(
+            np.asarray(self.stock1.close.array), np.asarray(self.stock2.close.array),
+            self.p.beta, self.p.window)
         
-        # 计算Z-Score
-        self.z_score = (self.spread - self.spread_mean) / self.spread_std
-        
-        # 记录交易
-        self.trades = []
+        # 记录交易：按K线数预分配结构化数组，每根K线最多一笔，按下标写入
+        self.trades = np.zeros(self.stock1.buflen(), dtype=TRADE_DTYPE)
+        self._ntrades = 0
         self.entry_price1 = None
         self.entry_price2 = None
+        self._log = []  # 回测过程中的日志，stop()时统一输出
+        
+    @staticmethod
+    def _precompute(close1, close2, beta, window):
+        """
+        向量化计算价差及其Z-Score
+        :return: (Z-Score, 价差)，窗口未满时为NaN
+        """
+        spread = pd.Series(close1).pct_change() - beta * pd.Series(close2).pct_change()
+        roll = spread.rolling(window)
+        # 与backtrader的StdDev一致，使用总体标准差
+        z = (spread - roll.mean()) / roll.std(ddof=0)
+        return z.to_numpy(), spread.to_numpy()
+        
+    def _record(self, date, kind, close1, close2, z_score, profit_pct=np.nan):
+        """写入一笔交易记录，kind为TRADE_TYPES下标"""
+        self.trades[self._ntrades] = (date, kind, close1, close2, z_score, profit_pct)
+        self._ntrades += 1
         
     def next(self):
         # 确保有足够的数据来计算指标
-        if len(self.spread) < self.p.window:
+        z_score = self._z[len(self.stock1) - 1]
+        if np.isnan(z_score):
             return
+        
+        # 每根K线只读取一次两只股票的收盘价
+        close1 = self.stock1.close[0]
+        close2 = self.stock2.close[0]
             
         if not self.position:  # 没有持仓
             # 检查是否满足开仓条件
-            if self.z_score[0] > self.p.z_entry:  # 做空spread
+            if z_score > self.p.z_entry:  # 做空spread
                 # 做空stock1，做多stock2
-                self.entry_price1 = self.stock1.close[0]
-                self.entry_price2 = self.stock2.close[0]
+                self.entry_price1 = close1
+                self.entry_price2 = close2
                 
                 # 计算头寸大小（市值平衡）
                 value = self.broker.getvalue() * 0.4  # 使用40%资金
-                qty1 = value / self.stock1.close[0]
-                qty2 = value * self.p.beta / self.stock2.close[0]
+                qty1 = value / close1
+                qty2 = value * self.p.beta / close2
                 
                 self.sell(data=self.stock1, size=qty1)
                 self.buy(data=self.stock2, size=qty2)
                 
                 # 记录交易
-                self.trades.append({
-                    'date': self.stock1.datetime.date(),
-                    'type': '开仓-做空spread',
-                    'stock1_price': self.stock1.close[0],
-                    'stock2_price': self.stock2.close[0],
-                    'z_score': self.z_score[0]
-                })
-                print(f'开仓-做空spread: 日期={self.stock1.datetime.date()}, Z-Score={self.z_score[0]:.2f}')
+                date = self.stock1.datetime.date()
+                self._record(date, 0, close1, close2, z_score)
+                self._log.append(('开仓-做空spread: 日期=%s, Z-Score=%.2f', (date, z_score)))
                 
-            elif self.z_score[0] < -self.p.z_entry:  # 做多spread
+            elif z_score < -self.p.z_entry:  # 做多spread
                 # 做多stock1，做空stock2
-                self.entry_price1 = self.stock1.close[0]
-                self.entry_price2 = self.stock2.close[0]
+                self.entry_price1 = close1
+                self.entry_price2 = close2
                 
                 # 计算头寸大小
                 value = self.broker.getvalue() * 0.4
-                qty1 = value / self.stock1.close[0]
-                qty2 = value * self.p.beta / self.stock2.close[0]
+                qty1 = value / close1
+                qty2 = value * self.p.beta / close2
                 
                 self.buy(data=self.stock1, size=qty1)
                 self.sell(data=self.stock2, size=qty2)
                 
                 # 记录交易
-                self.trades.append({
-                    'date': self.stock1.datetime.date(),
-                    'type': '开仓-做多spread',
-                    'stock1_price': self.stock1.close[0],
-                    'stock2_price': self.stock2.close[0],
-                    'z_score': self.z_score[0]
-                })
-                print(f'开仓-做多spread: 日期={self.stock1.datetime.date()}, Z-Score={self.z_score[0]:.2f}')
+                date = self.stock1.datetime.date()
+                self._record(date, 1, close1, close2, z_score)
+                self._log.append(('开仓-做多spread: 日期=%s, Z-Score=%.2f', (date, z_score)))
                 
         else:  # 持有仓位
             # 计算当前收益
             if self.position.size > 0:  # 做多spread
-                profit_pct = ((self.stock1.close[0] / self.entry_price1) - 
-                             self.p.beta * (self.stock2.close[0] / self.entry_price2))
+                profit_pct = ((close1 / self.entry_price1) - 
+                             self.p.beta * (close2 / self.entry_price2))
             else:  # 做空spread
-                profit_pct = (-(self.stock1.close[0] / self.entry_price1) + 
-                             self.p.beta * (self.stock2.close[0] / self.entry_price2))
+                profit_pct = (-(close1 / self.entry_price1) + 
+                             self.p.beta * (close2 / self.entry_price2))
             
-            # 检查是否满足平仓条件
-            close_position = False
-            exit_reason = ''
+            # 检查是否满足平仓条件，exit_kind为TRADE_TYPES下标，0表示继续持有
+            exit_kind = 0
             
-            if abs(self.z_score[0]) < self.p.z_exit:
-                close_position = True
-                exit_reason = 'Z-Score回归'
+            if -self.p.z_exit < z_score < self.p.z_exit:
+                exit_kind = 2  # Z-Score回归
             elif profit_pct < -self.p.stop_loss:
-                close_position = True
-                exit_reason = '止损'
+                exit_kind = 3  # 止损
             elif profit_pct > self.p.take_profit:
-                close_position = True
-                exit_reason = '获利了结'
+                exit_kind = 4  # 获利了结
             
-            if close_position:
+            if exit_kind:
                 self.close(data=self.stock1)
                 self.close(data=self.stock2)
                 
                 # 记录交易
-                self.trades.append({
-                    'date': self.stock1.datetime.date(),
-                    'type': f'平仓-{exit_reason}',
-                    'stock1_price': self.stock1.close[0],
-                    'stock2_price': self.stock2.close[0],
-                    'z_score': self.z_score[0],
-                    'profit_pct': profit_pct * 100
-                })
-                print(f'平仓-{exit_reason}: 日期={self.stock1.datetime.date()}, '
-                      f'收益率={profit_pct*100:.2f}%, Z-Score={self.z_score[0]:.2f}')
+                date = self.stock1.datetime.date()
+                self._record(date, exit_kind, close1, close2, z_score, profit_pct * 100)
+                self._log.append(('%s: 日期=%s, 收益率=%.2f%%, Z-Score=%.2f',
+                                  (TRADE_TYPES[exit_kind], date, profit_pct * 100, z_score)))
                 
                 self.entry_price1 = None
                 self.entry_price2 = None
 
     def stop(self):
+        if not self.p.printlog:
+            return
+        for fmt, args in self._log:
+            print(fmt % args)
         # 策略结束时打印交易汇总
         print('\n====== 交易记录 ======')
-        for trade in self.trades:
-            if '开仓' in trade['type']:
-                print(f"{trade['type']}: 日期={trade['date']}, "
-                      f"Z-Score={trade['z_score']:.2f}")
+        trades = self.trades[:self._ntrades]
+        for date, kind, z_score, profit_pct in zip(
+                trades['date'].tolist(), trades['type'].tolist(),
+                trades['z_score'].tolist(), trades['profit_pct'].tolist()):
+            if kind < 2:  # 开仓
+                print(f"{TRADE_TYPES[kind]}: 日期={date}, "
+                      f"Z-Score={z_score:.2f}")
             else:
-                print(f"{trade['type']}: 日期={trade['date']}, "
-                      f"收益率={trade['profit_pct']:.2f}%, "
-                      f"Z-Score={trade['z_score']:.2f}")
-
-# 运行回测
-cerebro = bt.Cerebro()
-
-# 添加数据
-df1 = get_stock_data("AAPL", '2023-01-01')  # 苹果股票数据
-df2 = get_stock_data("QQQ", '2023-01-01')   # 纳斯达克ETF数据
-
-# 确保两个数据集的长度相同
-min_date = max(df1.index[0], df2.index[0])
-max_date = min(df1.index[-1], df2.index[-1])
-df1 = df1[min_date:max_date]
-df2 = df2[min_date:max_date]
-
-data1 = bt.feeds.PandasData(dataname=df1)
-data2 = bt.feeds.PandasData(dataname=df2)
-cerebro.adddata(data1)
-cerebro.adddata(data2)
-
-cerebro.addstrategy(PairTradingStrategy)
-cerebro.broker.setcash(100000.0)  # 设置初始资金
-
-# 添加分析器
-cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
-cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
-cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
-cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
-
-print('初始资金: %.2f' % cerebro.broker.getvalue())
-results = cerebro.run()
-strat = results[0]
-
-# 获取回测结果
-drawdown = strat.analyzers.drawdown.get_analysis()
-returns = strat.analyzers.returns.get_analysis()
-sharpe = strat.analyzers.sharpe.get_analysis()
-trades = strat.analyzers.trades.get_analysis()
-
-print('\n======= 核心指标 =======')
-print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
-print('回撤周期: %d 天' % drawdown['max']['len'])
-print('年化收益率: %.2f%%' % (returns['rnorm100']))
-print('夏普比率: %.2f' % sharpe['sharperatio'])
-print('最终资金: %.2f' % cerebro.broker.getvalue())
-
-# 输出交易统计
-print('\n======= 交易统计 =======')
-print('总交易次数: %d' % trades['total']['total'])
-if trades['total']['total'] > 0:
-    print('盈利交易: %d' % trades['won']['total'])
-    print('亏损交易: %d' % trades['lost']['total'])
-    print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
-
-cerebro.plot(style='candlestick')
+                print(f"{TRADE_TYPES[kind]}: 日期={date}, "
+                      f"收益率={profit_pct:.2f}%, "
+                      f"Z-Score={z_score:.2f}")
+
+def vectorized_backtest(df1, df2, z_entry=2.0, z_exit=0.5, window=20, stop_loss=0.03,
+                        take_profit=0.05, beta=0.8, cash=100000.0):
+    """
+    编译执行的配对交易回测，与PairTradingStrategy逻辑一致（不经过backtrader事件循环）
+    两只股票的行情需按日期对齐
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    close1 = df1['close'].to_numpy(dtype=np.float64)
+    close2 = df2['close'].to_numpy(dtype=np.float64)
+    z, _ = PairTradingStrategy._precompute(close1, close2, beta, window)
+    equity, trades = backtest_pair(df1['open'].to_numpy(dtype=np.float64), close1,
+                                   df2['open'].to_numpy(dtype=np.float64), close2,
+                                   z, cash, beta, z_entry, z_exit, stop_loss, take_profit)
+    
+    dates = df1.index.to_numpy()
+    exit_idx = trades[:, 1].astype(np.int64)
+    trades = pd.DataFrame({
+        'entry_date': dates[trades[:, 0].astype(np.int64)],
+        'exit_date': np.where(exit_idx >= 0, dates[exit_idx], np.datetime64('NaT')),
+        'size': trades[:, 2],
+        'pnl': trades[:, 3]
+    })
+    return {'trades': trades, 'equity': pd.Series(equity, index=df1.index)}
+
+def load_pair_data():
+    """获取两只股票的行情并截取共同的日期区间"""
+    df1 = get_stock_data("AAPL", '2023-01-01')  # 苹果股票数据
+    df2 = get_stock_data("QQQ", '2023-01-01')   # 纳斯达克ETF数据
+
+    # 确保两个数据集的长度相同
+    min_date = max(df1.index[0], df2.index[0])
+    max_date = min(df1.index[-1], df2.index[-1])
+    return df1[min_date:max_date], df2[min_date:max_date]
+
+def run_once(data, params):
+    """
+    单组参数运行一次回测，只返回核心指标（供参数扫描在子进程中调用）
+    :return: {'sharpe', 'max_drawdown', 'annual_return', 'final_value'}
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    df1, df2 = data
+    cerebro.adddata(bt.feeds.PandasData(dataname=df1))
+    cerebro.adddata(bt.feeds.PandasData(dataname=df2))
+    cerebro.addstrategy(PairTradingStrategy, printlog=False, **params)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+    add_analyzers(cerebro)
+    strat = cerebro.run()[0]
+    return summarize(cerebro, strat)
+
+def run_backtest(plot=False):
+    # 运行回测
+    cerebro = bt.Cerebro()
+
+    # 添加数据
+    df1, df2 = load_pair_data()
+
+    data1 = bt.feeds.PandasData(dataname=df1)
+    data2 = bt.feeds.PandasData(dataname=df2)
+    cerebro.adddata(data1)
+    cerebro.adddata(data2)
+
+    cerebro.addstrategy(PairTradingStrategy)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+
+    # 添加分析器
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
+
+    print('初始资金: %.2f' % cerebro.broker.getvalue())
+    results = cerebro.run()
+    strat = results[0]
+
+    # 获取回测结果
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    returns = strat.analyzers.returns.get_analysis()
+    sharpe = strat.analyzers.sharpe.get_analysis()
+    trades = strat.analyzers.trades.get_analysis()
+
+    print('\n======= 核心指标 =======')
+    print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
+    print('回撤周期: %d 天' % drawdown['max']['len'])
+    print('年化收益率: %.2f%%' % (returns['rnorm100']))
+    print('夏普比率: %.2f' % sharpe['sharperatio'])
+    print('最终资金: %.2f' % cerebro.broker.getvalue())
+
+    # 输出交易统计
+    print('\n======= 交易统计 =======')
+    print('总交易次数: %d' % trades['total']['total'])
+    if trades['total']['total'] > 0:
+        print('盈利交易: %d' % trades['won']['total'])
+        print('亏损交易: %d' % trades['lost']['total'])
+        print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
+
+    # 编译执行的回测结果（用于快速对照）
+    vec = vectorized_backtest(df1, df2)
+    print('\n======= 向量化回测 =======')
+    print('交易次数: %d' % len(vec['trades']))
+    print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
+    if plot:
+        cerebro.plot(style='candlestick')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='配对交易策略回测')
+    parser.add_argument('--plot', action='store_true', help='回测结束后绘制K线和交易图')
+    parser.add_argument('--sweep', action='store_true', help='多进程并行扫描参数网格')
+    parser.add_argument('--workers', type=int, default=None, help='参数扫描的进程数，默认CPU核数')
+    args = parser.parse_args()
+    if not args.plot:
+        matplotlib.use('Agg')  # 不绘图时跳过GUI后端初始化
+    if args.sweep:
+        grid = param_grid(window=(10, 20, 40), z_entry=(1.5, 2.0, 2.5))
+        results = run_sweep(run_once, load_pair_data(), grid, max_workers=args.workers)
+        print(results.to_string())
+    else:
+        run_backtest(plot=args.plot)
@@ -1,14 +1,90 @@
-import akshare as ak
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
+import functools
 import time
 import random
-import json
 import os
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
-import matplotlib.dates as mdates
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # 复用quant/data下的缓存工具
+from data.cache import disk_cache
+from _kernels import rebalance_buys
+
+ST_PATTERN = re.compile('ST|退')  # ST股票和退市股票的名称特征
+
+def _ak():
+    """akshare导入较慢，只在缓存未命中、确实要请求数据时才导入"""
+    import akshare
+    return akshare
+
+# akshare的历史数据请求，结果以parquet缓存到磁盘，重复回测时直接读取
+# 同一进程内重复调用返回的是同一个DataFrame，调用方不要原地修改
+# 历史日线不会再变化，缓存保留7天；其余数据保留1天
+@disk_cache("hist", ttl=7 * 24 * 3600, fmt="parquet")
+def fetch_stock_hist(symbol, start_date, end_date):
+    """获取股票在指定区间的日线行情"""
+    return _ak().stock_zh_a_hist(symbol=symbol, period="daily", start_date=start_date, end_date=end_date)
+
+@disk_cache("close", ttl=7 * 24 * 3600, fmt="parquet")
+def fetch_close_history(symbol, start_date, end_date):
+    """
+    获取股票在指定区间的收盘价
+    只保留日期和收盘两列，日期在缓存前解析为datetime，读取后不必再转换
+    """
+    hist = _ak().stock_zh_a_hist(symbol=symbol, period="daily", start_date=start_date, end_date=end_date)
+    if hist.empty:
+        return hist
+    return pd.DataFrame({'日期': pd.to_datetime(hist['日期']), '收盘': hist['收盘'].to_numpy()})
+
+@disk_cache("trade_cal", fmt="parquet")
+def fetch_trade_calendar():
+    """获取交易日历"""
+    return _ak().tool_trade_date_hist_sina()
+
+@disk_cache("index", fmt="parquet")
+def fetch_index_daily(symbol):
+    """获取指数日线行情"""
+    return _ak().stock_zh_index_daily(symbol=symbol)
+
+@disk_cache("spot")  # 行情列表中有混合类型的列，用pickle保存
+def fetch_spot_list():
+    """
+    获取A股行情列表，只用于回测时抽样股票代码（不使用其中的价格，缓存最多保留1天）
+    """
+    return _ak().stock_zh_a_spot_em()
+
+# 实时选股要用最新价格，1分钟内重复获取时才使用缓存
+@disk_cache("spot_live", ttl=60)
+def fetch_spot_quotes():
+    """获取A股实时行情列表（选股用）"""
+    return _ak().stock_zh_a_spot_em()
+
+# 同一日期、同样数量的选股结果不变，参数扫描或重复回测时直接复用
+@functools.lru_cache(maxsize=2048)
+def select_stocks_for_date(date, top_n):
+    """
+    按指定日期的行情选股
+    这里应该实现根据历史数据选股的逻辑
+    由于历史数据获取比较复杂，这里简化处理，实际应该使用当时的股票数据进行选股
+    :param date: 'YYYY-MM-DD'格式的日期
+    :return: ((股票代码, 名称, 收盘价), ...)，元组不可变，可以安全地缓存
+    """
+    # 获取当日的股票数据
+    stock_df = fetch_stock_hist("all", date, date)
+    if stock_df is None or stock_df.empty:
+        # 当日没有行情（非交易日或数据缺失）属于正常情况，直接返回空结果
+        return ()
+    
+    # 筛选股价在2~9元之间的股票
+    stock_df = stock_df[(stock_df['收盘'] >= 2) & (stock_df['收盘'] <= 9)]
+    
+    # 按市值选择最小的N支股票（这里简化处理以成交额代替，实际应该考虑股息率和PEG）
+    # 只需要前N名，用nsmallest部分排序即可
+    selected = stock_df.nsmallest(top_n, '成交额')
+    return tuple(zip(selected['代码'], selected['名称'], selected['收盘']))
 
 class CaichangDamaStrategy:
     """
@@ -21,13 +97,15 @@ class CaichangDamaStrategy:
     def __init__(self):
         self.stock_info = None
         self.selected_stocks = None
+        self._price_cache = {}  # 回测价格缓存 {stock_code: 回测区间内按日期索引的收盘价}
+        self._price_range = None  # 价格缓存对应的(开始日期, 结束日期)
         
     def get_all_stock_data(self, max_retries=3):
         """获取所有股票的基本面数据"""
         for retry in range(max_retries):
             try:
-                # 获取所有A股实时行情数据
-                stock_df = ak.stock_zh_a_spot_em()
+                # 获取所有A股实时行情数据（rename得到的是副本，不会改动缓存）
+                stock_df = fetch_spot_quotes()
                 
                 # 打印列名，用于调试
                 print("原始数据列名:", stock_df.columns.tolist())
@@ -45,7 +123,11 @@ class CaichangDamaStrategy:
                 # 使用更直接的方式获取股息率数据
                 # 由于akshare的股息率数据可能不稳定，我们使用简化的方法
                 # 这里我们使用60日涨跌幅作为质量因子的替代
-                stock_df['dividend_yield'] = pd.to_numeric(stock_df['60日涨跌幅'], errors='coerce')
+                stock_df['dividend_yield'] = stock_df['60日涨跌幅']
+                
+                # 将空值和异常值替换为 NaN，所有数值列一次转换
+                numeric_columns = ['pe', 'pb', 'total_mv', 'price', 'dividend_yield']
+                stock_df[numeric_columns] = stock_df[numeric_columns].apply(pd.to_numeric, errors='coerce')
                 
                 # 获取PEG数据
                 # 由于akshare可能没有直接提供PEG，我们需要计算
@@ -54,21 +136,24 @@ class CaichangDamaStrategy:
                 growth_df = self.get_profit_growth()
                 if growth_df is not None:
                     stock_df = pd.merge(stock_df, growth_df, on='stock_code', how='left')
-                    # 计算PEG
-                    stock_df['peg'] = stock_df.apply(
-                        lambda x: x['pe'] / x['profit_growth'] if x['profit_growth'] > 0 else np.nan, 
-                        axis=1
-                    )
-                
-                # 将空值和异常值替换为 NaN
-                stock_df['pe'] = pd.to_numeric(stock_df['pe'], errors='coerce')
-                stock_df['pb'] = pd.to_numeric(stock_df['pb'], errors='coerce')
-                stock_df['total_mv'] = pd.to_numeric(stock_df['total_mv'], errors='coerce')
-                stock_df['price'] = pd.to_numeric(stock_df['price'], errors='coerce')
+                    # 计算PEG，盈利增长率不为正时记为NaN
+                    growth = stock_df['profit_growth'].to_numpy(dtype=np.float64)
+                    positive = growth > 0
+                    stock_df['peg'] = np.where(positive, stock_df['pe'].to_numpy() / np.where(positive, growth, 1.0), np.nan)
                 
                 # 将总市值从元转换为亿元
                 stock_df['total_mv'] = stock_df['total_mv'] / 100000000
                 
+                # ST股票和退市股票标记，获取数据时计算一次，选股时直接使用
+                stock_df['is_st'] = stock_df['name'].astype('string').str.contains(ST_PATTERN, na=False).astype(bool)
+                
+                # 行情数值精度不高，用float32存储，筛选和排序时读取的数据量减半
+                float_columns = [c for c in numeric_columns + ['peg'] if c in stock_df.columns]
+                stock_df[float_columns] = stock_df[float_columns].astype(np.float32)
+                
+                # 代码和名称重复值少，按分类类型存储
+                stock_df[['stock_code', 'name']] = stock_df[['stock_code', 'name']].astype('category')
+                
                 self.stock_info = stock_df
                 return True
             except Exception as e:
@@ -109,45 +194,34 @@ class CaichangDamaStrategy:
                 print("获取股票数据失败")
                 return []
         
-        # 创建一个副本以避免修改原始数据
-        df = self.stock_info.copy()
+        df = self.stock_info
         
+        # 以下条件写成一个表达式一次求值（安装了numexpr时由pandas自动使用，单次遍历各列）
         # 1. 剔除ST股票和退市股票
-        df = df[~df['name'].str.contains('ST|退', na=False)]
-        
         # 2. 剔除停牌股票
-        df = df[df['price'] > 0]
-        
         # 3. 剔除涨跌停股票
         # 这里简化处理，实际应该根据涨跌幅判断
-        
         # 4. 价低：股价在2~9元之间
-        df = df[(df['price'] >= 2) & (df['price'] <= 9)]
-        
         # 5. 质好：股息率高、PEG低
-        # 剔除股息率为空或为0的股票
-        df = df[df['dividend_yield'] > 0]
-        
-        # 如果有PEG数据，则使用PEG进行筛选
-        if 'peg' in df.columns:
-            # 剔除PEG为空或异常的股票
-            df = df[df['peg'] > 0]
-            # 按PEG升序排序
-            df = df.sort_values('peg')
-            # 取前50%的股票
-            df = df.head(len(df) // 2)
+        # 剔除股息率为空或为0的股票，如果有PEG数据，剔除PEG为空或异常的股票
+        conditions = ['~is_st', 'price > 0', '2 <= price <= 9', 'dividend_yield > 0']
+        has_peg = 'peg' in df.columns
+        if has_peg:
+            conditions.append('peg > 0')
+        mask = df.eval(' & '.join(f'({c})' for c in conditions))
         
-        # 6. 按股息率降序排序
-        df = df.sort_values('dividend_yield', ascending=False)
+        df = df.loc[mask]
         
-        # 7. 取前50%的股票
-        df = df.head(len(df) // 2)
+        # 以下各步只需要排名靠前的部分，用nsmallest/nlargest代替完整排序
+        if has_peg:
+            # 取PEG最低的50%的股票
+            df = df.nsmallest(len(df) // 2, 'peg')
         
-        # 8. 市值小：按市值升序排序
-        df = df.sort_values('total_mv')
+        # 6~7. 取股息率最高的50%的股票
+        df = df.nlargest(len(df) // 2, 'dividend_yield')
         
-        # 9. 选择市值最小的N支股票
-        self.selected_stocks = df.head(top_n)
+        # 8~9. 市值小：选择市值最小的N支股票（按市值升序）
+        self.selected_stocks = df.nsmallest(top_n, 'total_mv')
         
         return self.selected_stocks
     
@@ -160,16 +234,17 @@ class CaichangDamaStrategy:
         print("\n====== 菜场大妈策略选股结果 ======")
         print(f"共筛选出 {len(self.selected_stocks)} 只股票")
         
-        for _, stock in self.selected_stocks.iterrows():
-            print(f"\n股票代码: {stock['stock_code']}")
-            print(f"股票名称: {stock['name']}")
-            print(f"当前价格: {stock['price']:.2f}元")
-            print(f"股息率: {stock['dividend_yield']:.2f}%")
-            if 'peg' in stock and not pd.isna(stock['peg']):
-                print(f"PEG: {stock['peg']:.2f}")
-            print(f"市盈率: {stock['pe']:.2f}")
-            print(f"市净率: {stock['pb']:.2f}")
-            print(f"总市值: {stock['total_mv']:.2f}亿")
+        has_peg = 'peg' in self.selected_stocks.columns
+        for stock in self.selected_stocks.itertuples(index=False):
+            print(f"\n股票代码: {stock.stock_code}")
+            print(f"股票名称: {stock.name}")
+            print(f"当前价格: {stock.price:.2f}元")
+            print(f"股息率: {stock.dividend_yield:.2f}%")
+            if has_peg and not pd.isna(stock.peg):
+                print(f"PEG: {stock.peg:.2f}")
+            print(f"市盈率: {stock.pe:.2f}")
+            print(f"市净率: {stock.pb:.2f}")
+            print(f"总市值: {stock.total_mv:.2f}亿")
     
     def backtest(self, start_date='2013-01-01', end_date=None, top_n=10, initial_capital=1000000):
         """
@@ -190,277 +265,219 @@ class CaichangDamaStrategy:
         
         print(f"开始回测菜场大妈策略，回测区间: {start_date} 至 {end_date}")
         
+        # 每只股票只请求一次整个回测区间的行情，之后按日期查表
+        self._price_cache = {}
+        self._price_range = (start_date, end_date)
+        
         # 获取交易日历
         try:
-            trade_cal = ak.tool_trade_date_hist_sina()
-            trade_cal['trade_date'] = pd.to_datetime(trade_cal['trade_date'])
-            trade_cal = trade_cal[(trade_cal['trade_date'] >= pd.to_datetime(start_date)) & 
-                                 (trade_cal['trade_date'] <= pd.to_datetime(end_date))]
-            trade_dates = trade_cal['trade_date'].tolist()
+            all_trade_dates = pd.to_datetime(fetch_trade_calendar()['trade_date'])
+            trade_dates = all_trade_dates[(all_trade_dates >= pd.to_datetime(start_date)) & 
+                                          (all_trade_dates <= pd.to_datetime(end_date))].tolist()
         except Exception as e:
             print(f"获取交易日历失败: {str(e)}")
             return None
         
-        # 初始化回测结果
+        # 初始化回测结果，逐日序列按交易日数预先分配（首个元素为初始状态）
+        n = len(trade_dates) + 1
         backtest_results = {
-            'dates': [],
-            'portfolio_value': [],
-            'benchmark_value': [],  # 沪深300指数作为基准
-            'holdings': [],
+            'dates': np.empty(n, dtype='datetime64[ns]'),
+            'portfolio_value': np.empty(n),
+            'benchmark_value': np.empty(n),  # 沪深300指数作为基准
+            'holdings': None,  # 持仓记录，只保存有持股的(日期, 股票代码, 股数)
             'trades': []
         }
         
         # 获取基准指数数据（沪深300）
         try:
-            benchmark = ak.stock_zh_index_daily(symbol="sh000300")
-            benchmark['date'] = pd.to_datetime(benchmark['date'])
-            benchmark = benchmark.set_index('date')
+            benchmark = fetch_index_daily("sh000300")
+            benchmark = benchmark.assign(date=pd.to_datetime(benchmark['date'])).set_index('date')
             benchmark_start_value = benchmark.loc[pd.to_datetime(start_date):pd.to_datetime(start_date)]['close'].iloc[0]
         except Exception as e:
             print(f"获取基准指数数据失败: {str(e)}")
             return None
         
-        # 初始化投资组合
+        # 记录初始状态
+        backtest_results['dates'][0] = pd.to_datetime(start_date).to_datetime64()
+        backtest_results['portfolio_value'][0] = initial_capital
+        backtest_results['benchmark_value'][0] = initial_capital
+        
+        # 选股不依赖持仓，先取出每月第一个交易日的选股结果
+        trade_index = pd.DatetimeIndex(trade_dates)
+        rebalance_dates = trade_index.to_series().groupby(trade_index.to_period('M')).first()
+        rebalance_selections = {date: self.get_stocks_for_date(date.strftime('%Y-%m-%d'), top_n)
+                                for date in rebalance_dates}
+        
+        # 并行预取所有调仓日选出的股票在整个回测区间的价格
+        stock_codes = list(dict.fromkeys(code for selected in rebalance_selections.values()
+                                         if selected is not None and not selected.empty
+                                         for code in selected['stock_code']))
+        self.prefetch_prices(stock_codes)
+        
+        # 所有调仓日选出的股票的收盘价面板（交易日 × 股票），停牌日为NaN
+        prices = pd.DataFrame({code: self._price_cache[code].reindex(trade_index) for code in stock_codes},
+                              index=trade_index, columns=stock_codes)
+        column = {code: j for j, code in enumerate(stock_codes)}
+        prices_arr = prices.to_numpy()
+        
+        # 初始化投资组合，持仓按stock_codes的顺序存成持股数和成本两个数组
         portfolio = {
-            'cash': initial_capital,
-            'positions': {},  # 持仓 {stock_code: {'shares': 股数, 'cost': 成本}}
+            'cash': float(initial_capital),
+            'shares': np.zeros(len(stock_codes)),
+            'cost': np.zeros(len(stock_codes)),
             'value': initial_capital
         }
+        shares, cost = portfolio['shares'], portfolio['cost']
         
-        # 记录初始状态
-        backtest_results['dates'].append(pd.to_datetime(start_date))
-        backtest_results['portfolio_value'].append(portfolio['value'])
-        backtest_results['benchmark_value'].append(initial_capital)
-        backtest_results['holdings'].append({})
-        
-        # 上一次调仓的月份
-        last_rebalance_month = None
-        
-        # 按日期遍历
-        for date in trade_dates:
+        # 只在调仓日处理买卖，两次调仓之间持股和现金保持不变
+        shares_panel = np.zeros(prices.shape, dtype=np.int32)  # 逐日持股数均为整数股
+        cash_series = np.full(len(trade_index), float(initial_capital))
+        rebalance_idx = trade_index.get_indexer(list(rebalance_selections))
+        for k, (date, selected_stocks) in enumerate(rebalance_selections.items()):
             current_date = date.strftime('%Y-%m-%d')
-            current_month = date.month
+            print(f"调仓日期: {current_date}")
+            day_prices = prices_arr[rebalance_idx[k]]
             
-            # 判断是否为每月第一个交易日
-            is_first_day_of_month = (last_rebalance_month != current_month)
+            # 调仓前的投资组合市值，停牌股票不计入
+            portfolio_value_before = portfolio['cash'] + np.nansum(shares * day_prices)
             
-            # 更新持仓市值
-            portfolio_value_before = portfolio['cash']
-            for stock_code, position in list(portfolio['positions'].items()):
-                try:
-                    # 获取当日股票价格
-                    stock_price = self.get_stock_price(stock_code, current_date)
-                    if stock_price is None:
-                        # 如果无法获取价格，假设股票停牌，使用上一次的价格
-                        continue
-                    
-                    # 更新持仓市值
-                    position_value = position['shares'] * stock_price
-                    portfolio_value_before += position_value
-                except Exception as e:
-                    print(f"更新持仓市值时出错 ({stock_code}, {current_date}): {str(e)}")
-            
-            # 如果是每月第一个交易日，进行调仓
-            if is_first_day_of_month:
-                print(f"调仓日期: {current_date}")
-                last_rebalance_month = current_month
+            if selected_stocks is not None and not selected_stocks.empty:
+                codes = selected_stocks['stock_code'].tolist()
+                selected_cols = np.array([column[code] for code in codes])
                 
-                # 获取当日符合条件的股票
-                selected_stocks = self.get_stocks_for_date(current_date, top_n)
+                # 卖出不在新选股列表中的股票，停牌（无价格）的暂不卖出
+                to_sell = (shares > 0) & ~np.isnan(day_prices)
+                to_sell[selected_cols] = False
+                for j in np.flatnonzero(to_sell):
+                    sell_value = shares[j] * day_prices[j]
+                    portfolio['cash'] += sell_value
+                    backtest_results['trades'].append({
+                        'date': current_date,
+                        'stock_code': stock_codes[j],
+                        'action': 'sell',
+                        'shares': int(shares[j]),
+                        'price': day_prices[j],
+                        'value': sell_value
+                    })
+                shares[to_sell] = 0.0
+                cost[to_sell] = 0.0
                 
-                if selected_stocks is not None and not selected_stocks.empty:
-                    # 卖出不在新选股列表中的股票
-                    for stock_code, position in list(portfolio['positions'].items()):
-                        if stock_code not in selected_stocks['stock_code'].values:
-                            try:
-                                # 获取当日股票价格
-                                stock_price = self.get_stock_price(stock_code, current_date)
-                                if stock_price is None:
-                                    # 如果无法获取价格，假设股票停牌，暂不卖出
-                                    continue
-                                
-                                # 卖出股票
-                                sell_value = position['shares'] * stock_price
-                                portfolio['cash'] += sell_value
-                                
-                                # 记录交易
-                                backtest_results['trades'].append({
-                                    'date': current_date,
-                                    'stock_code': stock_code,
-                                    'action': 'sell',
-                                    'shares': position['shares'],
-                                    'price': stock_price,
-                                    'value': sell_value
-                                })
-                                
-                                # 移除持仓
-                                del portfolio['positions'][stock_code]
-                            except Exception as e:
-                                print(f"卖出股票时出错 ({stock_code}, {current_date}): {str(e)}")
-                    
-                    # 计算每只股票的目标持仓金额
-                    target_value_per_stock = portfolio_value_before / len(selected_stocks)
-                    
-                    # 买入新选的股票
-                    for _, stock in selected_stocks.iterrows():
-                        stock_code = stock['stock_code']
-                        try:
-                            # 获取当日股票价格
-                            stock_price = self.get_stock_price(stock_code, current_date)
-                            if stock_price is None:
-                                # 如果无法获取价格，跳过该股票
-                                continue
-                            
-                            # 如果已持有该股票，计算需要调整的份额
-                            current_shares = 0
-                            current_value = 0
-                            if stock_code in portfolio['positions']:
-                                current_shares = portfolio['positions'][stock_code]['shares']
-                                current_value = current_shares * stock_price
-                            
-                            # 计算需要买入的金额
-                            buy_value = target_value_per_stock - current_value
-                            
-                            if buy_value > 0 and buy_value <= portfolio['cash']:
-                                # 计算买入股数（整数股）
-                                shares_to_buy = int(buy_value / stock_price)
-                                if shares_to_buy > 0:
-                                    actual_buy_value = shares_to_buy * stock_price
-                                    
-                                    # 更新持仓
-                                    if stock_code not in portfolio['positions']:
-                                        portfolio['positions'][stock_code] = {
-                                            'shares': shares_to_buy,
-                                            'cost': stock_price
-                                        }
-                                    else:
-                                        # 更新持仓成本
-                                        total_shares = current_shares + shares_to_buy
-                                        total_cost = (current_shares * portfolio['positions'][stock_code]['cost'] + 
-                                                     shares_to_buy * stock_price)
-                                        portfolio['positions'][stock_code] = {
-                                            'shares': total_shares,
-                                            'cost': total_cost / total_shares
-                                        }
-                                    
-                                    # 更新现金
-                                    portfolio['cash'] -= actual_buy_value
-                                    
-                                    # 记录交易
-                                    backtest_results['trades'].append({
-                                        'date': current_date,
-                                        'stock_code': stock_code,
-                                        'action': 'buy',
-                                        'shares': shares_to_buy,
-                                        'price': stock_price,
-                                        'value': actual_buy_value
-                                    })
-                        except Exception as e:
-                            print(f"买入股票时出错 ({stock_code}, {current_date}): {str(e)}")
-            
-            # 计算当日投资组合总市值
-            portfolio_value = portfolio['cash']
-            current_holdings = {}
-            
-            for stock_code, position in portfolio['positions'].items():
-                try:
-                    # 获取当日股票价格
-                    stock_price = self.get_stock_price(stock_code, current_date)
-                    if stock_price is None:
-                        # 如果无法获取价格，使用上一次的价格
-                        continue
-                    
-                    # 计算持仓市值
-                    position_value = position['shares'] * stock_price
-                    portfolio_value += position_value
-                    
-                    # 记录当前持仓
-                    current_holdings[stock_code] = {
-                        'shares': position['shares'],
-                        'price': stock_price,
-                        'value': position_value
-                    }
-                except Exception as e:
-                    print(f"计算持仓市值时出错 ({stock_code}, {current_date}): {str(e)}")
-            
-            # 更新投资组合价值
-            portfolio['value'] = portfolio_value
-            
-            # 获取基准指数当日价值
-            try:
-                benchmark_price = benchmark.loc[date:date]['close'].iloc[0]
-                benchmark_value = initial_capital * (benchmark_price / benchmark_start_value)
-            except:
-                # 如果当日没有基准数据，使用上一次的价值
-                benchmark_value = backtest_results['benchmark_value'][-1] if backtest_results['benchmark_value'] else initial_capital
+                # 计算每只股票的目标持仓金额
+                target_value_per_stock = portfolio_value_before / len(selected_stocks)
+                
+                # 买入新选的股票，补足到目标金额
+                stock_prices = day_prices[selected_cols]
+                bought, portfolio['cash'] = rebalance_buys(stock_prices, shares[selected_cols], target_value_per_stock,
+                                                           portfolio['cash'])
+                for i in np.flatnonzero(bought):
+                    backtest_results['trades'].append({
+                        'date': current_date,
+                        'stock_code': codes[i],
+                        'action': 'buy',
+                        'shares': int(bought[i]),
+                        'price': stock_prices[i],
+                        'value': bought[i] * stock_prices[i]
+                    })
+                
+                # 更新持仓和加权平均成本
+                j = selected_cols[bought > 0]
+                new_shares = bought[bought > 0]
+                cost[j] = (shares[j] * cost[j] + new_shares * stock_prices[bought > 0]) / (shares[j] + new_shares)
+                shares[j] += new_shares
             
-            # 记录回测结果
-            backtest_results['dates'].append(date)
-            backtest_results['portfolio_value'].append(portfolio_value)
-            backtest_results['benchmark_value'].append(benchmark_value)
-            backtest_results['holdings'].append(current_holdings)
+            # 本次调仓后的持股和现金一直保持到下一次调仓
+            segment = slice(rebalance_idx[k], rebalance_idx[k + 1] if k + 1 < len(rebalance_idx) else None)
+            shares_panel[segment] = shares
+            cash_series[segment] = portfolio['cash']
+        
+        # 逐日投资组合市值整体计算，停牌股票当日不计入市值
+        portfolio_values = cash_series + np.nansum(shares_panel * prices_arr, axis=1)
+        portfolio['value'] = portfolio_values[-1]
+        
+        # 基准指数逐日价值，当日没有基准数据时沿用上一日的价值
+        benchmark_close = benchmark['close'].reindex(trade_index).ffill()
+        benchmark_values = (initial_capital * benchmark_close / benchmark_start_value).fillna(initial_capital)
+        
+        # 记录回测结果
+        backtest_results['dates'][1:] = trade_index.to_numpy()
+        backtest_results['portfolio_value'][1:] = portfolio_values
+        backtest_results['benchmark_value'][1:] = benchmark_values.to_numpy()
+        day_idx, stock_idx = np.nonzero(shares_panel)
+        backtest_results['holdings'] = pd.DataFrame({
+            'date': trade_index[day_idx],
+            'stock_code': np.array(stock_codes, dtype=object)[stock_idx],
+            'shares': shares_panel[day_idx, stock_idx]
+        })
         
         # 计算回测指标
-        returns = self.calculate_backtest_metrics(backtest_results)
+        returns, df = self.calculate_backtest_metrics(backtest_results)
         
-        # 绘制回测结果
-        self.plot_backtest_results(backtest_results)
+        # 绘制回测结果，复用计算指标时得到的净值和回撤
+        self.plot_backtest_results(df)
         
         return returns
     
     def get_stocks_for_date(self, date, top_n=10):
         """获取指定日期的选股结果"""
-        # 这里应该实现根据历史数据选股的逻辑
-        # 由于历史数据获取比较复杂，这里简化处理
-        # 实际应该使用当时的股票数据进行选股
-        
-        # 模拟选股结果
-        # 这里应该根据历史数据实现真实的选股逻辑
         print(f"获取 {date} 的选股结果")
         
         try:
-            # 获取当日的股票数据
-            stock_df = ak.stock_zh_a_hist(symbol="all", period="daily", 
-                                         start_date=date, end_date=date)
-            
-            # 筛选股价在2~9元之间的股票
-            stock_df = stock_df[(stock_df['收盘'] >= 2) & (stock_df['收盘'] <= 9)]
-            
-            # 按市值排序（这里简化处理，实际应该考虑股息率和PEG）
-            stock_df = stock_df.sort_values('成交额')
-            
-            # 选择市值最小的N支股票
-            selected = stock_df.head(top_n)
-            
+            records = select_stocks_for_date(pd.Timestamp(date).strftime('%Y-%m-%d'), top_n)
             # 转换为需要的格式
-            result = pd.DataFrame({
-                'stock_code': selected['代码'],
-                'name': selected['名称'],
-                'price': selected['收盘']
-            })
-            
-            return result
+            return pd.DataFrame(list(records), columns=['stock_code', 'name', 'price'])
         except Exception as e:
             print(f"获取 {date} 的选股结果失败: {str(e)}")
             return None
     
+    def invalidate_cache(self):
+        """清空进程内的选股结果和回测价格缓存，数据源更新后重新获取（磁盘缓存不受影响）"""
+        select_stocks_for_date.cache_clear()
+        self._price_cache = {}
+        self._price_range = None
+    
+    def load_prices(self, stock_code, start_date, end_date, max_retries=3):
+        """获取股票在指定区间内的收盘价，返回按日期索引的Series，失败时为空"""
+        for retry in range(max_retries):
+            try:
+                stock_data = fetch_close_history(stock_code, start_date, end_date)
+                break
+            except Exception as e:
+                print(f"获取股票 {stock_code} 在 {start_date} 至 {end_date} 的价格失败 "
+                      f"(尝试 {retry+1}/{max_retries}): {str(e)}")
+                if retry < max_retries - 1:
+                    time.sleep(random.uniform(1, 3))  # 随机等待，避免并发请求同时重试
+        else:
+            return pd.Series(dtype='float64')
+        
+        if stock_data.empty:
+            return pd.Series(dtype='float64')
+        return pd.Series(stock_data['收盘'].to_numpy(), index=pd.DatetimeIndex(stock_data['日期']))
+    
+    def prefetch_prices(self, stock_codes, max_workers=16):
+        """多线程把尚未缓存的股票在整个回测区间内的价格取到缓存中（网络请求为主，线程足够）"""
+        missing = [code for code in dict.fromkeys(stock_codes) if code not in self._price_cache]
+        if not missing:
+            return
+        start_date, end_date = self._price_range
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            prices = executor.map(lambda code: self.load_prices(code, start_date, end_date), missing)
+            self._price_cache.update(zip(missing, prices))
+    
     def get_stock_price(self, stock_code, date):
-        """获取指定日期的股票价格"""
-        try:
-            # 获取股票历史数据
-            stock_data = ak.stock_zh_a_hist(symbol=stock_code, period="daily", 
-                                           start_date=date, end_date=date)
-            
-            if stock_data.empty:
-                return None
-            
-            return stock_data['收盘'].iloc[0]
-        except Exception as e:
-            print(f"获取股票 {stock_code} 在 {date} 的价格失败: {str(e)}")
-            return None
+        """获取指定日期的股票价格，回测中从价格缓存查表，停牌或无数据时返回None"""
+        if self._price_range is None:
+            # 不在回测中，只取当天的数据
+            prices = self.load_prices(stock_code, date, date)
+        else:
+            self.prefetch_prices((stock_code,))
+            prices = self._price_cache[stock_code]
+        return prices.get(pd.Timestamp(date))
     
     def calculate_backtest_metrics(self, backtest_results):
-        """计算回测指标"""
+        """
+        计算回测指标
+        :return: (指标dict, 逐日净值DataFrame)，DataFrame含收益率和回撤列，供绘图复用
+        """
         # 转换为DataFrame便于计算
         df = pd.DataFrame({
             'date': backtest_results['dates'],
@@ -499,7 +516,7 @@ class CaichangDamaStrategy:
         # 计算换手率
         turnover = len(backtest_results['trades']) / (years * 12)  # 月均换手次数
         
-        return {
+        metrics = {
             'total_return': total_return,
             'benchmark_return': benchmark_return,
             'annual_return': annual_return,
@@ -510,23 +527,30 @@ class CaichangDamaStrategy:
             'turnover': turnover,
             'years': years
         }
+        return metrics, df
     
-    def plot_backtest_results(self, backtest_results):
-        """绘制回测结果图表"""
+    def plot_backtest_results(self, df):
+        """
+        绘制回测结果图表
+        :param df: calculate_backtest_metrics返回的逐日净值DataFrame
+        """
+        # matplotlib导入较慢，只在绘图时导入；图表只保存为PNG文件，使用不需要GUI的Agg后端
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        
+        # 直接把numpy数组交给matplotlib，避免每次绘图重复转换pandas对象
+        dates = df.index.to_numpy()
+        portfolio_value = df['portfolio_value'].to_numpy()
+        benchmark_value = df['benchmark_value'].to_numpy()
+        
         # 创建图表
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10), gridspec_kw={'height_ratios': [3, 1]})
         
-        # 转换为DataFrame便于绘图
-        df = pd.DataFrame({
-            'date': backtest_results['dates'],
-            'portfolio_value': backtest_results['portfolio_value'],
-            'benchmark_value': backtest_results['benchmark_value']
-        })
-        df = df.set_index('date')
-        
         # 绘制普通坐标轴的收益曲线
-        ax1.plot(df.index, df['portfolio_value'], label='菜场大妈策略')
-        ax1.plot(df.index, df['benchmark_value'], label='沪深300', alpha=0.7)
+        ax1.plot(dates, portfolio_value, label='菜场大妈策略')
+        ax1.plot(dates, benchmark_value, label='沪深300', alpha=0.7)
         ax1.set_title('菜场大妈策略回测结果 (普通坐标轴)')
         ax1.set_ylabel('投资组合价值')
         ax1.legend()
@@ -536,12 +560,8 @@ class CaichangDamaStrategy:
         ax1.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
         ax1.xaxis.set_major_locator(mdates.YearLocator())
         
-        # 计算回撤
-        df['portfolio_cummax'] = df['portfolio_value'].cummax()
-        df['drawdown'] = (df['portfolio_value'] - df['portfolio_cummax']) / df['portfolio_cummax']
-        
         # 绘制回撤曲线
-        ax2.fill_between(df.index, df['drawdown'], 0, color='red', alpha=0.3)
+        ax2.fill_between(dates, df['drawdown'].to_numpy(), 0, color='red', alpha=0.3)
         ax2.set_title('回撤')
         ax2.set_ylabel('回撤比例')
         ax2.set_ylim(-1, 0)
@@ -557,8 +577,8 @@ class CaichangDamaStrategy:
         
         # 绘制对数坐标轴的收益曲线
         plt.figure(figsize=(12, 6))
-        plt.semilogy(df.index, df['portfolio_value'], label='菜场大妈策略')
-        plt.semilogy(df.index, df['benchmark_value'], label='沪深300', alpha=0.7)
+        plt.semilogy(dates, portfolio_value, label='菜场大妈策略')
+        plt.semilogy(dates, benchmark_value, label='沪深300', alpha=0.7)
         plt.title('菜场大妈策略回测结果 (对数坐标轴)')
         plt.ylabel('投资组合价值 (对数尺度)')
         plt.legend()
@@ -1,54 +1,106 @@
-import akshare as ak
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-import time
-import random
-import json
 import os
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
-import matplotlib.dates as mdates
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # quant目录下的编译内核
+from _kernels import rebalance_buys
+# akshare请求统一经过caichang_dama中带磁盘缓存的函数，两个模块共用同一份缓存
+from caichang_dama import fetch_close_history, fetch_trade_calendar, fetch_index_daily, fetch_spot_list
+
+PLOT_MAX_POINTS = 2000  # 绘图时超过这么多个交易日就抽样
+PLOT_TARGET_POINTS = 1500  # 抽样后大约保留的点数
 
 class CaichangDamaBacktest:
     """
     菜场大妈策略回测
     每月第一个交易日调仓，选择符合条件的10支股票等权重持有
     """
+    PRICE_LOOKBACK = timedelta(days=7)  # 当日停牌时，往前最多找7天内最近的收盘价
+    
     def __init__(self):
-        pass
+        self._price_cache = {}  # 回测价格缓存 {stock_code: 回测区间内按日期索引的收盘价}
+        self._price_range = None  # 价格缓存对应的(开始日期, 结束日期)，不在回测中时为None
+    
+    def load_prices(self, stock_code, start_date, end_date):
+        """获取股票在指定区间内的收盘价，返回按日期索引的Series，无数据时为空"""
+        stock_data = fetch_close_history(stock_code, start_date, end_date)
+        if stock_data.empty:
+            return pd.Series(dtype='float64')
+        return pd.Series(stock_data['收盘'].to_numpy(), index=pd.DatetimeIndex(stock_data['日期']))
     
     def get_stock_price(self, stock_code, date):
         """获取指定日期的股票价格"""
         try:
-            # 获取股票历史数据
-            # 为了提高成功率，我们尝试获取一个时间范围内的数据
             date_dt = pd.to_datetime(date)
-            start_date = (date_dt - timedelta(days=7)).strftime('%Y-%m-%d')  # 往前找7天
-            end_date = date
-            
-            stock_data = ak.stock_zh_a_hist(symbol=stock_code, period="daily", 
-                                           start_date=start_date, end_date=end_date)
+            if self._price_range is None:
+                # 不在回测中，只取指定日期往前7天的数据
+                prices = self.load_prices(stock_code, (date_dt - self.PRICE_LOOKBACK).strftime('%Y-%m-%d'), date)
+            else:
+                # 回测中每只股票只下载一次整个回测区间的数据，之后查表
+                prices = self._price_cache.get(stock_code)
+                if prices is None:
+                    prices = self.load_prices(stock_code, *self._price_range)
+                    self._price_cache[stock_code] = prices
             
-            if stock_data.empty:
+            # 找到指定日期或之前最近一天的收盘价（二分查找），超过7天视为没有数据
+            i = prices.index.searchsorted(date_dt, side='right') - 1
+            if i < 0 or prices.index[i] < date_dt - self.PRICE_LOOKBACK:
                 print(f"无法获取股票 {stock_code} 在 {date} 的价格数据")
                 return None
-            
-            # 找到最接近指定日期的数据
-            stock_data['date'] = pd.to_datetime(stock_data['日期'])
-            stock_data = stock_data.set_index('date')
-            
-            # 如果有指定日期的数据，直接返回
-            if date_dt in stock_data.index:
-                return stock_data.loc[date_dt, '收盘']
-            
-            # 否则返回最近的一天的收盘价
-            return stock_data['收盘'].iloc[-1]
+            return prices.iloc[i]
             
         except Exception as e:
             print(f"获取股票 {stock_code} 在 {date} 的价格失败: {str(e)}")
             return None
     
+    def price_panel(self, stock_codes, dates):
+        """
+        回测中各股票在各交易日的收盘价（交易日 × 股票）
+        取值规则与get_stock_price一致：指定日期或之前7天内最近一天的收盘价，没有则为NaN
+        尚未缓存（包括之前获取失败）的股票先下载一次
+        """
+        self.prefetch_prices(stock_codes)
+        panel = np.full((len(dates), len(stock_codes)), np.nan)
+        earliest = dates - self.PRICE_LOOKBACK  # 各日期可接受的最早价格日期，各股票共用
+        for j, code in enumerate(stock_codes):
+            prices = self._price_cache.get(code)
+            if prices is None or prices.empty:
+                continue
+            i = prices.index.searchsorted(dates, side='right') - 1
+            found = (i >= 0) & (prices.index[np.maximum(i, 0)] >= earliest)
+            panel[found, j] = prices.to_numpy()[i[found]]
+        return pd.DataFrame(panel, index=dates, columns=stock_codes)
+    
+    def get_close_on(self, stock_code, date):
+        """获取股票在指定日期的收盘价，当日没有数据或获取失败时返回None"""
+        try:
+            stock_data = fetch_close_history(stock_code, date, date)
+        except Exception as e:
+            print(f"获取股票 {stock_code} 在 {date} 的数据失败: {str(e)}")
+            return None
+        return None if stock_data.empty else stock_data['收盘'].iloc[0]
+    
+    def prefetch_prices(self, stock_codes, max_workers=16):
+        """多线程把尚未缓存的股票在整个回测区间内的价格取到缓存中，获取失败的留待get_stock_price重试"""
+        missing = [code for code in dict.fromkeys(stock_codes) if code not in self._price_cache]
+        if not missing:
+            return
+        
+        def load(code):
+            try:
+                return self.load_prices(code, *self._price_range)
+            except Exception as e:
+                print(f"预取股票 {code} 的价格失败: {str(e)}")
+                return None
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            for code, prices in zip(missing, executor.map(load, missing)):
+                if prices is not None:
+                    self._price_cache[code] = prices
+    
     def get_stocks_for_date(self, date, top_n=10):
         """获取指定日期的选股结果"""
         print(f"获取 {date} 的选股结果")
@@ -59,7 +111,7 @@ class CaichangDamaBacktest:
             # 注意：这里是简化处理，实际回测应该使用当日的历史数据
             
             # 获取A股列表
-            stock_list = ak.stock_zh_a_spot_em()
+            stock_list = fetch_spot_list()
             
             # 随机选择50只股票进行模拟
             # 在实际应用中，应该根据历史数据进行选股
@@ -69,50 +121,40 @@ class CaichangDamaBacktest:
                 selected_stocks = stock_list
             
             # 对于每只股票，获取其历史价格
-            result_list = []
-            for idx, row in selected_stocks.iterrows():
-                stock_code = row['代码']
-                stock_name = row['名称']
-                
-                try:
-                    # 获取该股票在指定日期的价格
-                    stock_data = ak.stock_zh_a_hist(symbol=stock_code, period="daily", 
-                                                  start_date=date, end_date=date)
-                    
-                    if not stock_data.empty:
+            codes, names, found_prices = [], [], []
+            # 多线程同时获取候选股票当日的价格，按抽样顺序取前top_n只有数据的股票
+            executor = ThreadPoolExecutor(max_workers=16)
+            try:
+                prices = executor.map(lambda code: self.get_close_on(code, date), selected_stocks['代码'])
+                for stock_code, stock_name, price in zip(selected_stocks['代码'], selected_stocks['名称'], prices):
+                    if price is not None:
                         # 如果有数据，添加到结果列表
-                        result_list.append({
-                            'stock_code': stock_code,
-                            'name': stock_name,
-                            'price': stock_data['收盘'].iloc[0]
-                        })
+                        codes.append(stock_code)
+                        names.append(stock_name)
+                        found_prices.append(price)
                         
-                        # 如果已经有足够的股票，就停止
-                        if len(result_list) >= top_n:
+                        # 如果已经有足够的股票，就停止，尚未开始的请求直接取消
+                        if len(codes) >= top_n:
                             break
-                except Exception as e:
-                    print(f"获取股票 {stock_code} 在 {date} 的数据失败: {str(e)}")
-                    continue
+            finally:
+                executor.shutdown(cancel_futures=True)
             
             # 如果没有足够的股票，使用模拟数据
-            if len(result_list) < top_n:
-                print(f"警告: 只找到 {len(result_list)} 只股票，少于目标数量 {top_n}")
+            if len(codes) < top_n:
+                print(f"警告: 只找到 {len(codes)} 只股票，少于目标数量 {top_n}")
                 # 如果一只股票都没找到，返回None
-                if len(result_list) == 0:
+                if len(codes) == 0:
                     return None
             
-            # 转换为DataFrame
-            result = pd.DataFrame(result_list)
-            
-            # 筛选股价在2~9元之间的股票
-            result = result[result['price'].between(2, 9)]
-            
-            # 如果筛选后没有足够的股票，返回所有符合条件的股票
-            if len(result) < top_n:
-                return result
-            
-            # 返回前top_n只股票
-            return result.head(top_n)
+            # 筛选股价在2~9元之间的股票，先在numpy数组上筛选再构造DataFrame
+            # 结果最多top_n只，筛选后不足top_n只时返回所有符合条件的股票
+            found_prices = np.array(found_prices, dtype=np.float64)
+            in_range = (found_prices >= 2) & (found_prices <= 9)
+            return pd.DataFrame({
+                'stock_code': np.array(codes, dtype=object)[in_range],
+                'name': np.array(names, dtype=object)[in_range],
+                'price': found_prices[in_range]
+            })
             
         except Exception as e:
             print(f"获取 {date} 的选股结果失败: {str(e)}")
@@ -149,25 +191,28 @@ class CaichangDamaBacktest:
         
         print(f"开始回测菜场大妈策略，回测区间: {start_date} 至 {end_date}")
         
+        # 每次回测重新建立价格缓存，区间向前多取7天，回测首日停牌的股票也能找到最近价格
+        self._price_cache = {}
+        self._price_range = ((pd.to_datetime(start_date) - self.PRICE_LOOKBACK).strftime('%Y-%m-%d'), end_date)
+        
         # 获取交易日历
         try:
-            trade_cal = ak.tool_trade_date_hist_sina()
-            trade_cal['trade_date'] = pd.to_datetime(trade_cal['trade_date'])
-            trade_cal = trade_cal[(trade_cal['trade_date'] >= pd.to_datetime(start_date)) & 
-                                 (trade_cal['trade_date'] <= pd.to_datetime(end_date))]
-            trade_dates = trade_cal['trade_date'].tolist()
+            all_trade_dates = pd.to_datetime(fetch_trade_calendar()['trade_date'])
+            trade_dates = all_trade_dates[(all_trade_dates >= pd.to_datetime(start_date)) & 
+                                          (all_trade_dates <= pd.to_datetime(end_date))].tolist()
         except Exception as e:
             print(f"获取交易日历失败: {str(e)}")
             # 如果无法获取交易日历，使用日期范围代替
             print("使用日期范围代替交易日历")
             trade_dates = pd.date_range(start=start_date, end=end_date, freq='B')  # 'B'表示工作日
             
-        # 初始化回测结果
+        # 初始化回测结果，逐日序列按交易日数预先分配，第0个位置是初始状态
+        n_records = len(trade_dates) + 1
         backtest_results = {
-            'dates': [],
-            'portfolio_value': [],
-            'benchmark_value': [],  # 沪深300指数作为基准
-            'holdings': [],
+            'dates': np.empty(n_records, dtype='datetime64[ns]'),
+            'portfolio_value': np.empty(n_records),
+            'benchmark_value': np.empty(n_records),  # 沪深300指数作为基准
+            'holdings': None,  # 调仓后的持股数（调仓日 × 股票），两次调仓之间不变
             'trades': []
         }
         
@@ -178,10 +223,9 @@ class CaichangDamaBacktest:
             benchmark = None
             try:
                 # 尝试获取沪深300指数数据
-                benchmark = ak.stock_zh_index_daily(symbol="sh000300")
+                benchmark = fetch_index_daily("sh000300")
                 if benchmark is not None and not benchmark.empty:
-                    benchmark['date'] = pd.to_datetime(benchmark['date'])
-                    benchmark = benchmark.set_index('date')
+                    benchmark = benchmark.assign(date=pd.to_datetime(benchmark['date'])).set_index('date')
             except Exception as e:
                 print(f"获取沪深300指数数据失败: {str(e)}")
             
@@ -189,10 +233,9 @@ class CaichangDamaBacktest:
             if benchmark is None or benchmark.empty:
                 try:
                     print("尝试获取上证指数数据作为替代")
-                    benchmark = ak.stock_zh_index_daily(symbol="sh000001")
+                    benchmark = fetch_index_daily("sh000001")
                     if benchmark is not None and not benchmark.empty:
-                        benchmark['date'] = pd.to_datetime(benchmark['date'])
-                        benchmark = benchmark.set_index('date')
+                        benchmark = benchmark.assign(date=pd.to_datetime(benchmark['date'])).set_index('date')
                 except Exception as e:
                     print(f"获取上证指数数据失败: {str(e)}")
             
@@ -200,20 +243,10 @@ class CaichangDamaBacktest:
             if benchmark is None or benchmark.empty:
                 raise Exception("无法获取任何指数数据")
             
-            # 获取基准起始值
-            # 找到最接近开始日期的数据点
-            start_date_dt = pd.to_datetime(start_date)
-            if start_date_dt in benchmark.index:
-                benchmark_start_value = benchmark.loc[start_date_dt, 'close']
-            else:
-                # 找到大于等于开始日期的第一个日期
-                future_dates = benchmark.index[benchmark.index >= start_date_dt]
-                if len(future_dates) > 0:
-                    first_date = future_dates[0]
-                    benchmark_start_value = benchmark.loc[first_date, 'close']
-                else:
-                    # 如果没有大于等于开始日期的数据，使用第一个可用的数据
-                    benchmark_start_value = benchmark['close'].iloc[0]
+            # 获取基准起始值：开始日期当天或之后第一个有数据的日期（二分查找），都没有则用第一个可用的数据
+            benchmark_close = benchmark['close'].to_numpy()
+            i = benchmark.index.searchsorted(pd.to_datetime(start_date))
+            benchmark_start_value = benchmark_close[i] if i < len(benchmark_close) else benchmark_close[0]
                     
         except Exception as e:
             print(f"获取基准指数数据失败: {str(e)}")
@@ -224,197 +257,129 @@ class CaichangDamaBacktest:
             benchmark_start_value = 1000
         
         # 初始化投资组合
+        # 持仓按股票序号存成持股数和成本两个数组，序号对应universe中的位置，新买入的股票追加到末尾
         portfolio = {
             'cash': initial_capital,
-            'positions': {},  # 持仓 {stock_code: {'shares': 股数, 'cost': 成本}}
             'value': initial_capital
         }
+        universe = []  # 回测中买入过的股票代码
+        code_idx = {}  # 股票代码 -> 序号
+        shares_arr = np.zeros(0)
+        cost_arr = np.zeros(0)
         
         # 记录初始状态
-        backtest_results['dates'].append(pd.to_datetime(start_date))
-        backtest_results['portfolio_value'].append(portfolio['value'])
-        backtest_results['benchmark_value'].append(initial_capital)
-        backtest_results['holdings'].append({})
-        
-        # 上一次调仓的月份
-        last_rebalance_month = None
-        
-        # 按日期遍历
-        for date in trade_dates:
-            current_date = date.strftime('%Y-%m-%d')
-            current_month = date.month
+        backtest_results['dates'][0] = pd.to_datetime(start_date).to_datetime64()
+        backtest_results['portfolio_value'][0] = portfolio['value']
+        backtest_results['benchmark_value'][0] = initial_capital
+        
+        # 每月第一个交易日作为调仓日，按月份一次求出调仓日在交易日中的序号
+        # 日期字符串也一次格式化好，循环中只用整数序号取值
+        trade_index = pd.DatetimeIndex(trade_dates)
+        rebalance_idx = np.unique(trade_index.to_period('M').asi8, return_index=True)[1]
+        rebalance_strs = trade_index[rebalance_idx].strftime('%Y-%m-%d')
+        
+        # 只在调仓日处理买卖，记录调仓后的持股和现金，两次调仓之间保持不变
+        snapshots = []
+        for day_idx, current_date in zip(rebalance_idx, rebalance_strs):
+            print(f"调仓日期: {current_date}")
             
-            # 判断是否为每月第一个交易日
-            is_first_day_of_month = (last_rebalance_month != current_month)
+            # 调仓前的持仓市值，无法获取价格（停牌）的股票不计入
+            day_index = trade_index[day_idx:day_idx + 1]
+            day_prices = self.price_panel(universe, day_index).to_numpy()[0]
+            held = shares_arr > 0
+            portfolio_value_before = portfolio['cash'] + np.nansum(shares_arr[held] * day_prices[held])
             
-            # 更新持仓市值
-            portfolio_value_before = portfolio['cash']
-            for stock_code, position in list(portfolio['positions'].items()):
-                try:
-                    # 获取当日股票价格
-                    stock_price = self.get_stock_price(stock_code, current_date)
-                    if stock_price is None:
-                        # 如果无法获取价格，假设股票停牌，使用上一次的价格
-                        continue
-                    
-                    # 更新持仓市值
-                    position_value = position['shares'] * stock_price
-                    portfolio_value_before += position_value
-                except Exception as e:
-                    print(f"更新持仓市值时出错 ({stock_code}, {current_date}): {str(e)}")
+            # 获取当日符合条件的股票
+            selected_stocks = self.get_stocks_for_date(current_date, top_n)
             
-            # 如果是每月第一个交易日，进行调仓
-            if is_first_day_of_month:
-                print(f"调仓日期: {current_date}")
-                last_rebalance_month = current_month
-                
-                # 获取当日符合条件的股票
-                selected_stocks = self.get_stocks_for_date(current_date, top_n)
+            if selected_stocks is not None and not selected_stocks.empty:
+                selected_codes = selected_stocks['stock_code'].to_numpy()
                 
-                if selected_stocks is not None and not selected_stocks.empty:
-                    # 卖出不在新选股列表中的股票
-                    for stock_code, position in list(portfolio['positions'].items()):
-                        if stock_code not in selected_stocks['stock_code'].values:
-                            try:
-                                # 获取当日股票价格
-                                stock_price = self.get_stock_price(stock_code, current_date)
-                                if stock_price is None:
-                                    # 如果无法获取价格，假设股票停牌，暂不卖出
-                                    continue
-                                
-                                # 卖出股票
-                                sell_value = position['shares'] * stock_price
-                                portfolio['cash'] += sell_value
-                                
-                                # 记录交易
-                                backtest_results['trades'].append({
-                                    'date': current_date,
-                                    'stock_code': stock_code,
-                                    'action': 'sell',
-                                    'shares': position['shares'],
-                                    'price': stock_price,
-                                    'value': sell_value
-                                })
-                                
-                                # 移除持仓
-                                del portfolio['positions'][stock_code]
-                            except Exception as e:
-                                print(f"卖出股票时出错 ({stock_code}, {current_date}): {str(e)}")
+                # 卖出不在新选股列表中的股票，无法获取价格（停牌）的暂不卖出
+                to_sell = held & ~np.isnan(day_prices) & ~np.isin(np.array(universe, dtype=object), selected_codes)
+                for j in np.flatnonzero(to_sell):
+                    sell_value = shares_arr[j] * day_prices[j]
+                    portfolio['cash'] += sell_value
                     
-                    # 计算每只股票的目标持仓金额
-                    target_value_per_stock = portfolio_value_before / len(selected_stocks)
+                    # 记录交易
+                    backtest_results['trades'].append({
+                        'date': current_date,
+                        'stock_code': universe[j],
+                        'action': 'sell',
+                        'shares': int(shares_arr[j]),
+                        'price': day_prices[j],
+                        'value': sell_value
+                    })
+                shares_arr[to_sell] = 0
+                cost_arr[to_sell] = 0
+                
+                # 计算每只股票的目标持仓金额
+                target_value_per_stock = portfolio_value_before / len(selected_stocks)
+                
+                # 买入新选的股票，按选股顺序补足到目标金额，逐只扣减现金的循环编译执行
+                # 当日价格一次查出（新选股票在此并行预取整个回测区间的价格），不再逐只调用get_stock_price
+                selected_prices = self.price_panel(selected_codes, day_index).to_numpy()[0]
+                held_selected = np.array([shares_arr[code_idx[code]] if code in code_idx else 0.0
+                                          for code in selected_codes])
+                bought, portfolio['cash'] = rebalance_buys(selected_prices, held_selected, target_value_per_stock,
+                                                           portfolio['cash'])
+                for i in np.flatnonzero(bought):
+                    stock_code, stock_price, shares_to_buy = selected_codes[i], selected_prices[i], bought[i]
+                    actual_buy_value = shares_to_buy * stock_price
                     
-                    # 买入新选的股票
-                    for _, stock in selected_stocks.iterrows():
-                        stock_code = stock['stock_code']
-                        try:
-                            # 获取当日股票价格
-                            stock_price = self.get_stock_price(stock_code, current_date)
-                            if stock_price is None:
-                                # 如果无法获取价格，跳过该股票
-                                continue
-                            
-                            # 如果已持有该股票，计算需要调整的份额
-                            current_shares = 0
-                            current_value = 0
-                            if stock_code in portfolio['positions']:
-                                current_shares = portfolio['positions'][stock_code]['shares']
-                                current_value = current_shares * stock_price
-                            
-                            # 计算需要买入的金额
-                            buy_value = target_value_per_stock - current_value
-                            
-                            if buy_value > 0 and buy_value <= portfolio['cash']:
-                                # 计算买入股数（整数股）
-                                shares_to_buy = int(buy_value / stock_price)
-                                if shares_to_buy > 0:
-                                    actual_buy_value = shares_to_buy * stock_price
-                                    
-                                    # 更新持仓
-                                    if stock_code not in portfolio['positions']:
-                                        portfolio['positions'][stock_code] = {
-                                            'shares': shares_to_buy,
-                                            'cost': stock_price
-                                        }
-                                    else:
-                                        # 更新持仓成本
-                                        total_shares = current_shares + shares_to_buy
-                                        total_cost = (current_shares * portfolio['positions'][stock_code]['cost'] + 
-                                                     shares_to_buy * stock_price)
-                                        portfolio['positions'][stock_code] = {
-                                            'shares': total_shares,
-                                            'cost': total_cost / total_shares
-                                        }
-                                    
-                                    # 更新现金
-                                    portfolio['cash'] -= actual_buy_value
-                                    
-                                    # 记录交易
-                                    backtest_results['trades'].append({
-                                        'date': current_date,
-                                        'stock_code': stock_code,
-                                        'action': 'buy',
-                                        'shares': shares_to_buy,
-                                        'price': stock_price,
-                                        'value': actual_buy_value
-                                    })
-                        except Exception as e:
-                            print(f"买入股票时出错 ({stock_code}, {current_date}): {str(e)}")
-            
-            # 计算当日投资组合总市值
-            portfolio_value = portfolio['cash']
-            current_holdings = {}
-            
-            for stock_code, position in portfolio['positions'].items():
-                try:
-                    # 获取当日股票价格
-                    stock_price = self.get_stock_price(stock_code, current_date)
-                    if stock_price is None:
-                        # 如果无法获取价格，使用上一次的价格
-                        continue
+                    # 第一次买入的股票加入universe
+                    j = code_idx.get(stock_code)
+                    if j is None:
+                        j = code_idx[stock_code] = len(universe)
+                        universe.append(stock_code)
+                        shares_arr = np.append(shares_arr, 0.0)
+                        cost_arr = np.append(cost_arr, 0.0)
                     
-                    # 计算持仓市值
-                    position_value = position['shares'] * stock_price
-                    portfolio_value += position_value
+                    # 更新持仓和加权平均成本
+                    cost_arr[j] = (shares_arr[j] * cost_arr[j] + actual_buy_value) / (shares_arr[j] + shares_to_buy)
+                    shares_arr[j] += shares_to_buy
                     
-                    # 记录当前持仓
-                    current_holdings[stock_code] = {
-                        'shares': position['shares'],
+                    # 记录交易
+                    backtest_results['trades'].append({
+                        'date': current_date,
+                        'stock_code': stock_code,
+                        'action': 'buy',
+                        'shares': int(shares_to_buy),
                         'price': stock_price,
-                        'value': position_value
-                    }
-                except Exception as e:
-                    print(f"计算持仓市值时出错 ({stock_code}, {current_date}): {str(e)}")
+                        'value': actual_buy_value
+                    })
             
-            # 更新投资组合价值
-            portfolio['value'] = portfolio_value
-            
-            # 获取基准指数当日价值
-            try:
-                # 找到最接近当前日期的基准指数价格
-                if date in benchmark.index:
-                    benchmark_price = benchmark.loc[date, 'close']
-                else:
-                    # 找到小于等于当前日期的最近日期
-                    past_dates = benchmark.index[benchmark.index <= date]
-                    if len(past_dates) > 0:
-                        last_date = past_dates[-1]
-                        benchmark_price = benchmark.loc[last_date, 'close']
-                    else:
-                        # 如果没有小于等于当前日期的数据，使用第一个可用的数据
-                        benchmark_price = benchmark['close'].iloc[0]
-                
-                benchmark_value = initial_capital * (benchmark_price / benchmark_start_value)
-            except Exception as e:
-                print(f"计算基准指数价值时出错 ({date}): {str(e)}")
-                # 如果当日没有基准数据，使用上一次的价值
-                benchmark_value = backtest_results['benchmark_value'][-1] if backtest_results['benchmark_value'] else initial_capital
-            
-            # 记录回测结果
-            backtest_results['dates'].append(date)
-            backtest_results['portfolio_value'].append(portfolio_value)
-            backtest_results['benchmark_value'].append(benchmark_value)
-            backtest_results['holdings'].append(current_holdings)
+            snapshots.append((shares_arr.copy(), portfolio['cash'], portfolio_value_before))
+        
+        # 各调仓日的持股数、现金和调仓前市值，持股都是整数股
+        holdings = np.zeros((len(snapshots), len(universe)), dtype=np.int32)
+        cash_after = np.empty(len(snapshots))
+        value_before = np.empty(len(snapshots))
+        for k, (shares, cash, value) in enumerate(snapshots):
+            holdings[k, :len(shares)] = shares
+            cash_after[k] = cash
+            value_before[k] = value
+        
+        # 逐日投资组合市值整体计算：每个交易日取最近一次调仓的持股 × 收盘价面板（交易日 × 股票）
+        prices = self.price_panel(universe, trade_index)
+        segment = np.searchsorted(rebalance_idx, np.arange(len(trade_index)), side='right') - 1
+        # 无法获取价格（停牌）的股票当日不计入市值
+        portfolio_values = cash_after[segment] + np.nansum(holdings[segment] * prices.to_numpy(), axis=1)
+        # 调仓按当日收盘价成交、没有手续费，调仓日市值与调仓前相同，直接取调仓前市值，
+        # 不用调仓后重新求和的结果（求和顺序不同会有1e-16量级的误差，第一天的收益率就不是恰好为0，胜率会多算一天）
+        portfolio_values[rebalance_idx] = value_before
+        portfolio['value'] = portfolio_values[-1]
+        
+        # 基准指数逐日价值：当日没有数据时取之前最近一天的收盘价，之前都没有数据则用第一个可用的数据
+        benchmark_price = benchmark['close'].reindex(trade_index, method='ffill').fillna(benchmark['close'].iloc[0])
+        benchmark_values = initial_capital * (benchmark_price.to_numpy() / benchmark_start_value)
+        
+        # 记录回测结果
+        backtest_results['dates'][1:] = trade_index.to_numpy()
+        backtest_results['portfolio_value'][1:] = portfolio_values
+        backtest_results['benchmark_value'][1:] = benchmark_values
+        # 持仓只记录调仓日，需要逐日持仓时按交易日reindex(method='ffill')即可
+        backtest_results['holdings'] = pd.DataFrame(holdings, index=trade_index[rebalance_idx], columns=universe)
         
         # 计算回测指标
         returns = self.calculate_backtest_metrics(backtest_results)
@@ -425,40 +390,35 @@ class CaichangDamaBacktest:
         return returns
     
     def calculate_backtest_metrics(self, backtest_results):
-        """计算回测指标"""
-        # 转换为DataFrame便于计算
-        df = pd.DataFrame({
-            'date': backtest_results['dates'],
-            'portfolio_value': backtest_results['portfolio_value'],
-            'benchmark_value': backtest_results['benchmark_value']
-        })
-        df = df.set_index('date')
+        """计算回测指标（直接在numpy数组上计算，参数扫描时反复调用也不必构造DataFrame）"""
+        dates = backtest_results['dates']
+        pv = backtest_results['portfolio_value']
+        bv = backtest_results['benchmark_value']
         
         # 计算每日收益率
-        df['portfolio_return'] = df['portfolio_value'].pct_change()
-        df['benchmark_return'] = df['benchmark_value'].pct_change()
+        portfolio_return = pv[1:] / pv[:-1] - 1
+        benchmark_return = bv[1:] / bv[:-1] - 1
         
         # 计算累计收益率
-        total_return = (df['portfolio_value'].iloc[-1] / df['portfolio_value'].iloc[0]) - 1
-        benchmark_return = (df['benchmark_value'].iloc[-1] / df['benchmark_value'].iloc[0]) - 1
+        total_return = (pv[-1] / pv[0]) - 1
+        benchmark_total_return = (bv[-1] / bv[0]) - 1
         
         # 计算年化收益率
-        years = (df.index[-1] - df.index[0]).days / 365
+        years = (dates[-1] - dates[0]).astype('timedelta64[D]').astype(np.int64) / 365
         annual_return = (1 + total_return) ** (1 / years) - 1
-        benchmark_annual_return = (1 + benchmark_return) ** (1 / years) - 1
+        benchmark_annual_return = (1 + benchmark_total_return) ** (1 / years) - 1
         
         # 计算夏普比率
         risk_free_rate = 0.03  # 假设无风险利率为3%
-        sharpe_ratio = (annual_return - risk_free_rate) / (df['portfolio_return'].std() * np.sqrt(252))
+        sharpe_ratio = (annual_return - risk_free_rate) / (np.std(portfolio_return, ddof=1) * np.sqrt(252))
         
         # 计算最大回撤
-        df['portfolio_cummax'] = df['portfolio_value'].cummax()
-        df['drawdown'] = (df['portfolio_value'] - df['portfolio_cummax']) / df['portfolio_cummax']
-        max_drawdown = df['drawdown'].min()
+        portfolio_cummax = np.maximum.accumulate(pv)
+        max_drawdown = ((pv - portfolio_cummax) / portfolio_cummax).min()
         
         # 计算胜率
-        win_days = sum(df['portfolio_return'] > df['benchmark_return'])
-        total_days = len(df) - 1  # 减去第一天，因为第一天没有收益率
+        win_days = int(np.count_nonzero(portfolio_return > benchmark_return))
+        total_days = len(pv) - 1  # 减去第一天，因为第一天没有收益率
         win_rate = win_days / total_days if total_days > 0 else 0
         
         # 计算换手率
@@ -466,7 +426,7 @@ class CaichangDamaBacktest:
         
         return {
             'total_return': total_return,
-            'benchmark_return': benchmark_return,
+            'benchmark_return': benchmark_total_return,
             'annual_return': annual_return,
             'benchmark_annual_return': benchmark_annual_return,
             'sharpe_ratio': sharpe_ratio,
@@ -477,21 +437,40 @@ class CaichangDamaBacktest:
         }
     
     def plot_backtest_results(self, backtest_results):
-        """绘制回测结果图表"""
+        """
+        绘制回测结果图表
+        超过PLOT_MAX_POINTS个交易日时等间隔抽样绘制，回撤在全部数据上计算，每段取最深的回撤，不会漏掉低点
+        """
+        # 只在绘图时导入matplotlib，不绘图的调用（如参数扫描）不必承担导入开销
+        import matplotlib
+        matplotlib.use('Agg')  # 图表只保存为PNG文件，不需要初始化GUI后端
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        
+        dates = backtest_results['dates']
+        pv = backtest_results['portfolio_value']
+        bv = backtest_results['benchmark_value']
+        
+        # 计算回撤
+        peak = np.maximum.accumulate(pv)
+        drawdown = (pv - peak) / peak
+        
+        # 抽样，保证最后一天也在图中
+        step = max(1, len(dates) // PLOT_TARGET_POINTS) if len(dates) > PLOT_MAX_POINTS else 1
+        if step > 1:
+            idx = np.arange(0, len(dates), step)
+            drawdown = np.minimum.reduceat(drawdown, idx)
+            if idx[-1] != len(dates) - 1:
+                idx = np.append(idx, len(dates) - 1)
+                drawdown = np.append(drawdown, drawdown[-1])
+            dates, pv, bv = dates[idx], pv[idx], bv[idx]
+        
         # 创建图表
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10), gridspec_kw={'height_ratios': [3, 1]})
         
-        # 转换为DataFrame便于绘图
-        df = pd.DataFrame({
-            'date': backtest_results['dates'],
-            'portfolio_value': backtest_results['portfolio_value'],
-            'benchmark_value': backtest_results['benchmark_value']
-        })
-        df = df.set_index('date')
-        
         # 绘制普通坐标轴的收益曲线
-        ax1.plot(df.index, df['portfolio_value'], label='菜场大妈策略')
-        ax1.plot(df.index, df['benchmark_value'], label='沪深300', alpha=0.7)
+        ax1.plot(dates, pv, label='菜场大妈策略', linewidth=0.8)
+        ax1.plot(dates, bv, label='沪深300', alpha=0.7, linewidth=0.8)
         ax1.set_title('菜场大妈策略回测结果 (普通坐标轴)')
         ax1.set_ylabel('投资组合价值')
         ax1.legend()
@@ -501,12 +480,8 @@ class CaichangDamaBacktest:
         ax1.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
         ax1.xaxis.set_major_locator(mdates.YearLocator())
         
-        # 计算回撤
-        df['portfolio_cummax'] = df['portfolio_value'].cummax()
-        df['drawdown'] = (df['portfolio_value'] - df['portfolio_cummax']) / df['portfolio_cummax']
-        
         # 绘制回撤曲线
-        ax2.fill_between(df.index, df['drawdown'], 0, color='red', alpha=0.3)
+        ax2.fill_between(dates, drawdown, 0, color='red', alpha=0.3)
         ax2.set_title('回撤')
         ax2.set_ylabel('回撤比例')
         ax2.set_ylim(-1, 0)
@@ -522,8 +497,8 @@ class CaichangDamaBacktest:
         
         # 绘制对数坐标轴的收益曲线
         plt.figure(figsize=(12, 6))
-        plt.semilogy(df.index, df['portfolio_value'], label='菜场大妈策略')
-        plt.semilogy(df.index, df['benchmark_value'], label='沪深300', alpha=0.7)
+        plt.semilogy(dates, pv, label='菜场大妈策略', linewidth=0.8)
+        plt.semilogy(dates, bv, label='沪深300', alpha=0.7, linewidth=0.8)
         plt.title('菜场大妈策略回测结果 (对数坐标轴)')
         plt.ylabel('投资组合价值 (对数尺度)')
         plt.legend()
@@ -1,8 +1,6 @@
-import akshare as ak
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
 from caichang_dama import CaichangDamaStrategy
 from caichang_dama_backtest import CaichangDamaBacktest
 
@@ -6,6 +6,29 @@ import time
 import random
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # 复用quant/data下的缓存工具
+from data.cache import disk_cache
+from data.ratelimit import rate_limit
+
+HIST_REQUESTS_PER_SECOND = 10  # 所有线程合计每秒最多请求历史行情的次数
+
+# 历史行情按请求的日期区间以parquet缓存到磁盘，同一天内重复收集数据时直接读取
+@disk_cache("hist_qfq", fmt="parquet")
+@rate_limit(HIST_REQUESTS_PER_SECOND)
+def fetch_hist_qfq(symbol, start_date, end_date):
+    """获取股票在指定区间的前复权日线行情（只有实际发出的请求参与限速）"""
+    return ak.stock_zh_a_hist(symbol=symbol, period="daily", start_date=start_date, end_date=end_date, adjust="qfq")
+
+# 实时行情列表1分钟内重复获取时直接使用缓存（列表中有混合类型的列，用pickle保存）
+@disk_cache("spot_em", ttl=60)
+def fetch_spot_em():
+    """获取A股实时行情列表"""
+    return ak.stock_zh_a_spot_em()
+
+FACTOR_COLUMNS = ['momentum', 'roe', 'pe', 'pb', 'total_mv']  # 数据文件中的数值因子列
 
 class StockDataCollector:
     """股票数据收集器"""
@@ -16,8 +39,8 @@ class StockDataCollector:
         """获取所有股票的基本面数据"""
         for retry in range(max_retries):
             try:
-                # 获取所有A股实时行情数据
-                stock_df = ak.stock_zh_a_spot_em()
+                # 获取所有A股实时行情数据（缓存中的DataFrame是共用的，rename得到副本后再修改）
+                stock_df = fetch_spot_em()
                 
                 # 打印列名，用于调试
                 print("原始数据列名:", stock_df.columns.tolist())
@@ -35,15 +58,13 @@ class StockDataCollector:
                     print("缺少必要的数据列，实际列名:", stock_df.columns.tolist())
                     return False
                 
-                # 将空值和异常值替换为 NaN
-                stock_df['ROE'] = pd.to_numeric(stock_df['ROE'], errors='coerce')
-                stock_df['市盈率'] = pd.to_numeric(stock_df['市盈率'], errors='coerce')
-                stock_df['市净率'] = pd.to_numeric(stock_df['市净率'], errors='coerce')
-                stock_df['总市值'] = pd.to_numeric(stock_df['总市值'], errors='coerce')
-                stock_df['当前价格'] = pd.to_numeric(stock_df['当前价格'], errors='coerce')
+                # 将空值和异常值替换为 NaN，已经是数值类型的列（akshare通常已转换好）不必再转换
+                for col in ['ROE', '市盈率', '市净率', '总市值', '当前价格']:
+                    if not pd.api.types.is_numeric_dtype(stock_df[col]):
+                        stock_df[col] = pd.to_numeric(stock_df[col], errors='coerce')
                 
                 # 将总市值从元转换为亿元
-                stock_df['总市值'] = stock_df['总市值'] / 100000000
+                stock_df['总市值'] /= 100000000
                 
                 # 过滤条件：
                 # 1. 只保留主板股票（以60或00开头的股票代码）
@@ -58,6 +79,12 @@ class StockDataCollector:
                 # 4. 剔除数据不完整的股票
                 #stock_df = stock_df.dropna(subset=['ROE', '市盈率', '市净率', '总市值', '当前价格'])
                 
+                # 5. 剔除基本面数据不合理的股票，在获取历史数据之前过滤，这些股票不必再请求历史行情
+                #    （NaN参与比较的结果为False，会被剔除）
+                valid = ((stock_df['ROE'].abs() <= 100) & (stock_df['市盈率'] > 0) & (stock_df['市盈率'] <= 1000) &
+                         (stock_df['市净率'] > 0) & (stock_df['市净率'] <= 50) & (stock_df['总市值'] > 0))
+                stock_df = stock_df[valid]
+                
                 print(f"\n过滤后剩余股票数量: {len(stock_df)}")
                 
                 self.stock_info = stock_df
@@ -69,18 +96,14 @@ class StockDataCollector:
         return False
 
     def get_stock_history(self, stock_code, max_retries=3):
-        """获取单个股票的历史数据"""
+        """获取单个股票近一年的历史数据，同一天内重复调用时读取磁盘缓存"""
         for retry in range(max_retries):
             try:
-                df = ak.stock_zh_a_hist(
-                    symbol=stock_code,
-                    period="daily",
+                return fetch_hist_qfq(
+                    stock_code,
                     start_date=(datetime.now() - timedelta(days=365)).strftime("%Y%m%d"),
-                    end_date=datetime.now().strftime("%Y%m%d"),
-                    adjust="qfq"
+                    end_date=datetime.now().strftime("%Y%m%d")
                 )
-                time.sleep(random.uniform(0.5, 2))
-                return df
             except Exception as e:
                 print(f"获取股票 {stock_code} 历史数据时出错 (尝试 {retry+1}/{max_retries}): {str(e)}")
                 if retry < max_retries - 1:
@@ -92,68 +115,50 @@ class StockDataCollector:
         try:
             if len(df) < 60:  # 至少需要60个交易日的数据
                 return None
-            return (df['收盘'].iloc[-1] / df['收盘'].iloc[0] - 1) * 100
+            close = df['收盘'].to_numpy()
+            return (close[-1] / close[0] - 1) * 100
         except Exception as e:
             print(f"计算动量因子时出错: {str(e)}")
             return None
 
-    def collect_and_save_data(self, output_file='stock_data.json'):
-        """收集数据并保存到JSON文件"""
+    def collect_and_save_data(self, output_file='stock_data.parquet', max_workers=8):
+        """
+        收集数据并保存到parquet文件（按列存储，数值和时间保留原类型）
+        :param max_workers: 同时获取历史数据的线程数，请求以网络等待为主，多线程即可并发
+        """
         if not self.get_all_stock_data():
             print("获取股票数据失败")
             return False
 
-        factor_data = []
-        print("\n开始收集股票数据...")
+        stock_info = self.stock_info
+        print(f"\n开始收集股票数据，共 {len(stock_info)} 只股票...")
         
-        for _, stock in self.stock_info.iterrows():
-            stock_code = stock['代码']
-            print(f"\n处理股票 {stock_code}")
-            
-            try:
-                # 获取历史数据计算动量
-                price_data = self.get_stock_history(stock_code)
-                if price_data is None:
-                    continue
-                
-                momentum = self.calculate_momentum(price_data)
-                
-                # 获取其他因子
-                roe = float(stock['ROE'])
-                pe = float(stock['市盈率'])
-                pb = float(stock['市净率'])
-                total_mv = float(stock['总市值'])
-                
-                # 数据合理性检查
-                if any([
-                    momentum is None,
-                    np.isnan(roe) or abs(roe) > 100,
-                    np.isnan(pe) or pe <= 0 or pe > 1000,
-                    np.isnan(pb) or pb <= 0 or pb > 50,
-                    np.isnan(total_mv) or total_mv <= 0
-                ]):
-                    continue
-                
-                factor_data.append({
-                    'stock_code': stock_code,
-                    'name': stock['名称'],
-                    'momentum': momentum,
-                    'roe': roe,
-                    'pe': pe,
-                    'pb': pb,
-                    'total_mv': total_mv,
-                    'update_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                print(f"股票 {stock_code} 数据收集完成")
-                
-            except Exception as e:
-                print(f"处理股票 {stock_code} 时出错: {str(e)}")
-                continue
+        # 多线程同时获取各股票的历史数据计算动量，结果按股票顺序返回，数据不足或获取失败的记为NaN
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            momentum = np.full(len(stock_info), np.nan)
+            for i, price_data in enumerate(executor.map(self.get_stock_history, stock_info['代码'])):
+                value = None if price_data is None else self.calculate_momentum(price_data)
+                if value is not None:
+                    momentum[i] = value
+        
+        # 基本面数据已在get_all_stock_data中检查过，这里只剔除没有动量因子的股票
+        valid = ~np.isnan(momentum)
+        
+        factor_data = pd.DataFrame({
+            'stock_code': stock_info['代码'].to_numpy()[valid],
+            'name': stock_info['名称'].to_numpy()[valid],
+            'momentum': momentum[valid],
+            'roe': stock_info['ROE'].to_numpy(dtype=np.float64)[valid],
+            'pe': stock_info['市盈率'].to_numpy(dtype=np.float64)[valid],
+            'pb': stock_info['市净率'].to_numpy(dtype=np.float64)[valid],
+            'total_mv': stock_info['总市值'].to_numpy(dtype=np.float64)[valid],
+            'update_time': pd.Timestamp.now().floor('s')
+        })
+        print(f"\n{len(factor_data)} 只股票数据收集完成")
 
-        # 保存数据到JSON文件
-        if factor_data:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(factor_data, f, ensure_ascii=False, indent=2)
+        # 保存数据到parquet文件
+        if len(factor_data) > 0:
+            factor_data.to_parquet(output_file, compression='zstd', index=False)
             print(f"\n数据已保存到 {output_file}")
             return True
         return False
@@ -165,28 +170,29 @@ class StockSelector:
         self.factor_data = pd.DataFrame()
         self.selected_stocks = []
         
-    def normalize_factor(self, series):
-        """对因子进行标准化"""
+    def normalize_factor(self, factors):
+        """对因子进行标准化，传入DataFrame时各列一次分别标准化"""
         try:
-            if len(series) <= 1:
-                return series
-            return (series - series.mean()) / series.std()
+            if len(factors) <= 1:
+                return factors
+            return (factors - factors.mean()) / factors.std()
         except Exception as e:
             print(f"标准化因子时出错: {str(e)}")
-            return series
+            return factors
 
-    def select_stocks(self, data_file='stock_data.json', top_n=10):
-        """从JSON文件读取数据并选股"""
+    def select_stocks(self, data_file='stock_data.parquet', top_n=10):
+        """从数据文件读取数据并选股（以前保存的JSON数据文件也可以读取）"""
         try:
-            # 读取JSON数据
+            # 读取数据
             if not os.path.exists(data_file):
                 print(f"数据文件 {data_file} 不存在")
                 return []
-                
-            with open(data_file, 'r', encoding='utf-8') as f:
-                factor_data = json.load(f)
             
-            self.factor_data = pd.DataFrame(factor_data)
+            if data_file.endswith('.json'):
+                with open(data_file, 'r', encoding='utf-8') as f:
+                    self.factor_data = pd.DataFrame(json.load(f))
+            else:
+                self.factor_data = pd.read_parquet(data_file)
             
             # 如果指定了股票池，进行过滤
             if self.stock_pool is not None:
@@ -195,12 +201,19 @@ class StockSelector:
             if len(self.factor_data) == 0:
                 print("没有获取到有效数据")
                 return []
+            
+            # 因子精度要求不高，用float32存储，标准化和打分时读取的数据量减半；代码和名称按分类类型存储
+            self.factor_data = self.factor_data.astype(
+                {**dict.fromkeys(FACTOR_COLUMNS, np.float32), 'stock_code': 'category', 'name': 'category'})
 
-            # 标准化因子
-            self.factor_data['momentum_norm'] = self.normalize_factor(self.factor_data['momentum'])
-            # self.factor_data['roe_norm'] = self.normalize_factor(self.factor_data['roe'])
-            self.factor_data['pe_norm'] = self.normalize_factor(1 / self.factor_data['pe'])
-            self.factor_data['pb_norm'] = self.normalize_factor(1 / self.factor_data['pb'])
+            # 标准化因子，所有因子放在一个矩阵中一次完成
+            normalized = self.normalize_factor(pd.DataFrame({
+                'momentum_norm': self.factor_data['momentum'],
+                # 'roe_norm': self.factor_data['roe'],
+                'pe_norm': 1 / self.factor_data['pe'],
+                'pb_norm': 1 / self.factor_data['pb']
+            }))
+            self.factor_data[normalized.columns] = normalized
 
             # 计算综合得分（重新分配权重），暂时不计算ROE
             # self.factor_data['total_score'] = (
@@ -209,11 +222,9 @@ class StockSelector:
             #     self.factor_data['pe_norm'] * 0.15 +
             #     self.factor_data['pb_norm'] * 0.15
             # )
-            self.factor_data['total_score'] = (
-                self.factor_data['momentum_norm'] * 0.4 +
-                self.factor_data['pe_norm'] * 0.3 +
-                self.factor_data['pb_norm'] * 0.3
-            )
+            # 各因子权重依次为动量0.4、市盈率0.3、市净率0.3，一次矩阵乘法得到综合得分
+            weights = np.array([0.4, 0.3, 0.3], dtype=np.float32)
+            self.factor_data['total_score'] = normalized.to_numpy() @ weights
 
             # 选择得分最高的股票
             self.selected_stocks = self.factor_data.nlargest(top_n, 'total_score')
@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -19,8 +20,12 @@ class RotationStrategy:
         self.oversold_threshold = oversold_threshold
         self.holding_period = holding_period
         self.stop_loss = stop_loss
-        self.positions = {}  # 当前持仓 {股票代码: (买入价格, 买入时间)}
+        # 当前持仓，按股票代码索引，买入价格和买入时间各占一列，止损和持有期检查对所有持仓一次计算
+        self.positions = pd.DataFrame({'buy_price': pd.Series(dtype='float64'),
+                                       'buy_time': pd.Series(dtype='datetime64[ns]')},
+                                      index=pd.Index([], dtype=object, name='code'))
         self.cash = initial_capital
+        self._spot_prices = pd.Series(dtype='float64')  # 全市场最新价 {股票代码: 最新价}，每次运行策略时刷新
         
     def get_market_data(self, stock_code, days=30):
         """获取股票行情数据"""
@@ -34,72 +39,91 @@ class RotationStrategy:
             logging.error(f"获取股票{stock_code}数据失败: {str(e)}")
             return None
 
+    def refresh_spot_prices(self):
+        """获取全市场最新价，一次请求代替逐只股票请求行情，获取失败时清空（之后逐只请求）"""
+        try:
+            spot = ak.stock_zh_a_spot_em()
+            self._spot_prices = pd.Series(pd.to_numeric(spot['最新价'], errors='coerce').to_numpy(), index=spot['代码'])
+        except Exception as e:
+            logging.error(f"获取全市场行情失败: {str(e)}")
+            self._spot_prices = pd.Series(dtype='float64')
+
+    def get_current_price(self, stock_code):
+        """获取股票最新价，全市场行情中没有（停牌或行情获取失败）时单独请求，都没有时返回None"""
+        price = self._spot_prices.get(stock_code)
+        if price is not None and not np.isnan(price):
+            return price
+        df = self.get_market_data(stock_code, days=5)
+        if df is None or len(df) == 0:
+            return None
+        return df['收盘'].to_numpy()[-1]
+
     def find_oversold_stocks(self, stock_pool):
         """筛选超跌股票"""
         oversold_stocks = []
-        for stock in stock_pool:
-            df = self.get_market_data(stock)
-            if df is None:
-                continue
-            
-            # 计算N日跌幅
-            if len(df) > 0:
-                price_change = ((df['收盘'].iloc[-1] - df['收盘'].iloc[0]) / df['收盘'].iloc[0]) * 100
-                if price_change <= self.oversold_threshold:
-                    oversold_stocks.append((stock, price_change))
+        # 多线程同时获取股票池的行情，结果按股票池顺序返回
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for stock, df in zip(stock_pool, executor.map(self.get_market_data, stock_pool)):
+                if df is None:
+                    continue
+                
+                # 计算N日跌幅
+                if len(df) > 0:
+                    close = df['收盘'].to_numpy()
+                    price_change = ((close[-1] - close[0]) / close[0]) * 100
+                    if price_change <= self.oversold_threshold:
+                        oversold_stocks.append((stock, price_change))
         
         # 按跌幅排序
         oversold_stocks.sort(key=lambda x: x[1])
         return oversold_stocks
 
     def check_stop_loss(self):
-        """检查止损"""
-        stocks_to_sell = []
-        for stock, (buy_price, buy_time) in self.positions.items():
-            df = self.get_market_data(stock, days=5)
-            if df is None:
-                continue
-            
-            current_price = df['收盘'].iloc[-1]
-            price_change = ((current_price - buy_price) / buy_price) * 100
-            
-            # 检查止损条件
-            if price_change <= self.stop_loss:
-                stocks_to_sell.append(stock)
-            
-            # 检查持有期
-            if (datetime.now() - buy_time).days >= self.holding_period:
-                stocks_to_sell.append(stock)
+        """检查止损和持有期，返回需要卖出的股票代码"""
+        current_price = self._spot_prices.reindex(self.positions.index).to_numpy(dtype=np.float64, copy=True)
+        # 全市场行情中没有的持仓单独获取最新价
+        for i in np.flatnonzero(np.isnan(current_price)):
+            price = self.get_current_price(self.positions.index[i])
+            if price is not None:
+                current_price[i] = price
         
-        return stocks_to_sell
+        buy_price = self.positions['buy_price'].to_numpy()
+        price_change = ((current_price - buy_price) / buy_price) * 100
+        held_days = (pd.Timestamp.now() - self.positions['buy_time']).dt.days.to_numpy()
+        
+        # 触发止损或持有期到期的卖出，获取不到最新价的持仓本次不检查
+        to_sell = ~np.isnan(current_price) & ((price_change <= self.stop_loss) | (held_days >= self.holding_period))
+        return self.positions.index[to_sell].tolist()
 
     def execute_trade(self, action, stock_code, price, amount):
         """执行交易"""
         if action == "buy":
             if self.cash >= price * amount:
                 self.cash -= price * amount
-                self.positions[stock_code] = (price, datetime.now())
+                self.positions.loc[stock_code] = (price, pd.Timestamp.now())
                 logging.info(f"买入 {stock_code}: 价格={price}, 数量={amount}")
             else:
                 logging.warning(f"资金不足，无法买入 {stock_code}")
         
         elif action == "sell":
-            if stock_code in self.positions:
+            if stock_code in self.positions.index:
                 self.cash += price * amount
-                buy_price = self.positions[stock_code][0]
+                buy_price = self.positions.at[stock_code, 'buy_price']
                 profit = ((price - buy_price) / buy_price) * 100
-                del self.positions[stock_code]
+                self.positions = self.positions.drop(stock_code)
                 logging.info(f"卖出 {stock_code}: 价格={price}, 数量={amount}, 收益率={profit:.2f}%")
 
     def run_strategy(self, stock_pool):
         """运行策略"""
+        # 本次运行统一使用同一份全市场最新价
+        self.refresh_spot_prices()
+        
         # 检查止损
         stocks_to_sell = self.check_stop_loss()
         for stock in stocks_to_sell:
-            if stock in self.positions:
-                df = self.get_market_data(stock, days=1)
-                if df is not None:
-                    current_price = df['收盘'].iloc[-1]
+            if stock in self.positions.index:
+                current_price = self.get_current_price(stock)
+                if current_price is not None:
                     self.execute_trade("sell", stock, current_price, 100)  # 假设每次交易100股
 
         # 寻找新的超跌股票
@@ -108,22 +132,20 @@ class RotationStrategy:
             available_positions = self.position_limit - len(self.positions)
             
             for stock, _ in oversold_stocks[:available_positions]:
-                if stock not in self.positions:
-                    df = self.get_market_data(stock, days=1)
-                    if df is not None:
-                        current_price = df['收盘'].iloc[-1]
+                if stock not in self.positions.index:
+                    current_price = self.get_current_price(stock)
+                    if current_price is not None:
                         # 计算可买入数量（假设每个持仓均分资金）
                         amount = int((self.cash / available_positions) / current_price / 100) * 100
                         if amount > 0:
                             self.execute_trade("buy", stock, current_price, amount)
 
     def get_portfolio_status(self):
-        """获取当前组合状态"""
+        """获取当前组合状态（使用上一次运行策略时的全市场最新价）"""
         total_value = self.cash
-        for stock, (buy_price, _) in self.positions.items():
-            df = self.get_market_data(stock, days=1)
-            if df is not None:
-                current_price = df['收盘'].iloc[-1]
+        for stock in self.positions.index:
+            current_price = self.get_current_price(stock)
+            if current_price is not None:
                 position_value = current_price * 100  # 假设每个持仓100股
                 total_value += position_value
         
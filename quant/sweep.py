@@ -0,0 +1,51 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import backtrader as bt
+import pandas as pd
+
+_data = None  # 工作进程内的行情数据，由_init_worker在进程启动时设置一次
+
+def param_grid(**ranges):
+    """
+    生成参数网格（各参数取值的笛卡尔积）
+    :return: [{'参数名': 取值, ...}, ...]
+    """
+    keys = list(ranges)
+    return [dict(zip(keys, values)) for values in itertools.product(*ranges.values())]
+
+def add_analyzers(cerebro):
+    """添加参数扫描统一使用的分析器"""
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
+
+def summarize(cerebro, strat):
+    """从分析器中提取核心指标"""
+    sharpe = strat.analyzers.sharpe.get_analysis()['sharperatio']
+    return {
+        'sharpe': float('nan') if sharpe is None else sharpe,
+        'max_drawdown': strat.analyzers.drawdown.get_analysis()['max']['drawdown'],
+        'annual_return': strat.analyzers.returns.get_analysis()['rnorm100'],
+        'final_value': cerebro.broker.getvalue()
+    }
+
+def _init_worker(data):
+    global _data
+    _data = data
+
+def _run(run_once, params):
+    return run_once(_data, params)
+
+def run_sweep(run_once, data, grid, max_workers=None):
+    """
+    多进程并行执行参数扫描，每组参数一个独立的Cerebro
+    行情数据在每个工作进程启动时传入一次，之后每个任务只传参数
+    :param run_once: 模块级函数run_once(data, params) -> 指标dict
+    :param max_workers: 进程数，默认CPU核数
+    :return: 每组参数及其指标的DataFrame，按夏普比率降序
+    """
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data,)) as executor:
+        metrics = list(executor.map(_run, itertools.repeat(run_once), grid))
+    results = pd.DataFrame([{**params, **m} for params, m in zip(grid, metrics)])
+    return results.sort_values('sharpe', ascending=False, ignore_index=True)
@@ -1,6 +1,19 @@
 import backtrader as bt
+import numpy as np
 import pandas as pd
 from data.get3 import get_stock_data
+from _kernels import atr_wilder, backtest_vegas
+
+def _ema(close, period):
+    """
+    与backtrader的EMA指标一致：前period根收盘价的简单平均作为初值，之后指数平滑
+    :return: EMA数组，前period-1根为NaN
+    """
+    ema = np.full(len(close), np.nan)
+    if len(close) >= period:
+        seeded = np.concatenate(([close[:period].mean()], close[period:]))
+        ema[period - 1:] = pd.Series(seeded).ewm(span=period, adjust=False).mean().to_numpy()
+    return ema
 
 class VegasStrategy(bt.Strategy):
     """
@@ -33,11 +46,13 @@ class VegasStrategy(bt.Strategy):
         # 记录交易
         self.trades = []
         self.entry_price = None
+        self._log = []  # 回测过程中的日志，stop()时统一输出
         
     def next(self):
+        close = self.data.close[0]
         if not self.position:  # 没有持仓
             # 判断大趋势（价格在慢速均线上方）
-            trend_up = self.data.close[0] > self.ema_slow[0]
+            trend_up = close > self.ema_slow[0]
             
             # Vegas通道突破（快线突破中期通道）
             channel_break = (self.ema_fast[0] > self.ema_mid1[0] and 
@@ -48,28 +63,29 @@ class VegasStrategy(bt.Strategy):
                 # 计算动态仓位
                 risk_amount = self.broker.getvalue() * self.p.risk_pct
                 stop_price = self.data.low[0] - self.p.atr_multiplier * self.atr[0]
-                size = risk_amount / (self.data.close[0] - stop_price)
+                size = risk_amount / (close - stop_price)
                 
                 # 执行买入
-                self.entry_price = self.data.close[0]
+                self.entry_price = close
                 self.buy(size=size)
                 
                 # 记录交易
+                date = self.data.datetime.date()
                 self.trades.append({
-                    'date': self.data.datetime.date(),
+                    'date': date,
                     'type': '买入',
-                    'price': self.data.close[0],
+                    'price': close,
                     'size': size,
                     'stop': stop_price
                 })
-                print(f'买入: 日期={self.data.datetime.date()}, 价格={self.data.close[0]:.2f}, 止损={stop_price:.2f}')
+                self._log.append(('买入: 日期=%s, 价格=%.2f, 止损=%.2f', (date, close, stop_price)))
                 
         else:  # 持有仓位
             # 更新止损价
             current_stop = self.entry_price - self.p.atr_multiplier * self.atr[0]
             
             # 判断是否触及止损或通道下轨
-            stop_triggered = self.data.close[0] < current_stop
+            stop_triggered = close < current_stop
             channel_break_down = (self.ema_fast[0] < self.ema_mid1[0] and 
                                 self.ema_fast[0] < self.ema_mid2[0])
             
@@ -77,15 +93,18 @@ class VegasStrategy(bt.Strategy):
                 self.close()  # 平仓
                 
                 # 记录交易
+                date = self.data.datetime.date()
                 self.trades.append({
-                    'date': self.data.datetime.date(),
+                    'date': date,
                     'type': '卖出',
-                    'price': self.data.close[0]
+                    'price': close
                 })
-                print(f'卖出: 日期={self.data.datetime.date()}, 价格={self.data.close[0]:.2f}')
+                self._log.append(('卖出: 日期=%s, 价格=%.2f', (date, close)))
                 self.entry_price = None
 
     def stop(self):
+        for fmt, args in self._log:
+            print(fmt % args)
         # 策略结束时打印交易汇总
         print('\n====== 交易记录 ======')
         for trade in self.trades:
@@ -95,6 +114,27 @@ class VegasStrategy(bt.Strategy):
             else:
                 print(f"卖出: 日期={trade['date']}, 价格={trade['price']:.2f}")
 
+def vectorized_backtest(df, ema_fast=12, ema_mid1=144, ema_mid2=169, ema_slow=576, atr_period=14,
+                        risk_pct=0.02, atr_multiplier=2, cash=100000.0):
+    """
+    编译执行的Vegas通道回测，与VegasStrategy逻辑一致（不经过backtrader事件循环）
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_, high, low, close = (df[c].to_numpy(dtype=np.float64) for c in ('open', 'high', 'low', 'close'))
+    equity, trades = backtest_vegas(open_, low, close, _ema(close, ema_fast), _ema(close, ema_mid1),
+                                    _ema(close, ema_mid2), _ema(close, ema_slow),
+                                    atr_wilder(high, low, close, atr_period), cash, risk_pct, atr_multiplier)
+    
+    dates = df.index.to_numpy()
+    exit_idx = trades[:, 1].astype(np.int64)
+    trades = pd.DataFrame({
+        'entry_date': dates[trades[:, 0].astype(np.int64)],
+        'exit_date': np.where(exit_idx >= 0, dates[exit_idx], np.datetime64('NaT')),
+        'size': trades[:, 2],
+        'pnl': trades[:, 3]
+    })
+    return {'trades': trades, 'equity': pd.Series(equity, index=df.index)}
+
 # 运行回测
 cerebro = bt.Cerebro()
 df = get_stock_data()  # 获取股票数据
@@ -124,4 +164,10 @@ print('年化收益率: %.2f%%' % (returns['rnorm100']))
 print('夏普比率: %.2f' % sharpe['sharperatio'])
 print('最终资金: %.2f' % cerebro.broker.getvalue())
 
+# 编译执行的回测结果（用于快速对照）
+vec = vectorized_backtest(df)
+print('\n====== 向量化回测 ======')
+print('交易次数: %d' % len(vec['trades']))
+print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
 cerebro.plot(style='candlestick')
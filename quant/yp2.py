@@ -1,6 +1,48 @@
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
 import backtrader as bt
+import numpy as np
 import pandas as pd
 from data.get2 import get_stock_data
+from _kernels import backtest_ma5, sweep_ma5, sma_fsum
+from sweep import add_analyzers, summarize
+
+logger = logging.getLogger(__name__)
+
+TRADE_TYPES = ('买入', '卖出')  # 交易记录type字段的编码
+TRADE_DTYPE = [('date', 'datetime64[D]'), ('type', 'i1'), ('price', 'f8'), ('ma5', 'f8'), ('size', 'i8')]
+SIGNAL_BUY, SIGNAL_SELL = 1, 2  # 信号数组的位标志
+
+def _precompute_signals(close, ma, up_pct):
+    """
+    一次性计算整段行情的买卖信号，编码在一个int8数组中，next()中按K线下标取位
+    - SIGNAL_BUY: 收盘价高于均线up_pct以上
+    - SIGNAL_SELL: 收盘价低于均线
+    up_pct为负时两个条件可能同时成立，所以用位标志而不是正负号
+    均线为NaN时两个比较都为False，没有信号
+    """
+    close = np.asarray(close, dtype=np.float64)
+    signal = (close > ma * (1 + up_pct)).view(np.int8)  # bool数组直接按字节视为0/1
+    signal |= (close < ma).view(np.int8) << 1
+    return signal
+
+def _sma_grid(close, periods):
+    """
+    计算整段行情多个周期的简单移动平均，每个窗口单独精确求和（与backtrader的SMA一致）
+    不用整段累加和差分：累加和的舍入误差会让价格平台上的均线与收盘价不相等，误触发买卖
+    :return: (周期数, N)的numpy数组，每行前period-1个为NaN
+    """
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    return np.vstack([sma_fsum(close, period) for period in periods])
+
+def _sma(close, period):
+    """
+    计算整段行情的简单移动平均
+    :return: 长度N的numpy数组，前period-1个为NaN
+    """
+    return sma_fsum(np.ascontiguousarray(close, dtype=np.float64), period)
 
 class MA5Strategy(bt.Strategy):
     """
@@ -11,101 +53,211 @@ class MA5Strategy(bt.Strategy):
     params = (
         ('ma_period', 5),     # 均线周期
         ('up_pct', 0.01),     # 上涨比例
+        ('printlog', True),   # 是否在stop()中输出交易记录，多只股票并行回测时关闭
     )
 
     def __init__(self):
-        # 计算5日均线
-        self.ma5 = bt.indicators.SMA(period=self.p.ma_period)
+        # 数据已预加载，直接在整段收盘价上计算均线，next()中按K线下标取值
+        close = np.asarray(self.data.close.array)
+        self.ma5 = _sma(close, self.p.ma_period)
+        self.signal = _precompute_signals(close, self.ma5, self.p.up_pct)
         
-        # 记录交易
-        self.trades = []
+        # 记录交易：按K线数预分配结构化数组，每根K线最多一笔，按下标写入（卖出记录的size为0）
+        self.trades = np.zeros(self.data.buflen(), dtype=TRADE_DTYPE)
+        self._ntrades = 0
         self.entry_price = None
 
+    def _record(self, kind, date, close, ma5, size=0):
+        """写入一笔交易记录，kind为TRADE_TYPES下标"""
+        self.trades[self._ntrades] = (date, kind, close, ma5, size)
+        self._ntrades += 1
+
     def next(self):
+        # 当前K线下标，每根K线只做一次数组取值
+        i = len(self.data) - 1
+        signal = self.signal[i]
+        
         if not self.position:  # 没有持仓
             # 如果价格高出五日均线1%，则买入
-            if self.data.close[0] > self.ma5[0] * (1 + self.p.up_pct):
+            if signal & SIGNAL_BUY:
+                close = self.data.close[0]
+                ma5 = self.ma5[i]
                 # 计算购买数量
-                size = int(self.broker.getcash() / self.data.close[0])
+                size = int(self.broker.getcash() / close)
                 self.buy(size=size)
                 
-                # 记录买入信息
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '买入',
-                    'price': self.data.close[0],
-                    'ma5': self.ma5[0],
-                    'size': size
-                })
-                print(f'买入: 日期={self.data.datetime.date()}, '
-                      f'价格={self.data.close[0]:.2f}, '
-                      f'MA5={self.ma5[0]:.2f}, '
-                      f'数量={size}')
+                # 记录买入信息，日期只在成交的K线上计算一次
+                date = self.data.datetime.date()
+                self._record(0, date, close, ma5, size)
+                logger.info('买入: 日期=%s, 价格=%.2f, MA5=%.2f, 数量=%d', date, close, ma5, size)
                 
         else:  # 持有仓位
             # 如果价格低于五日均线，则卖出
-            if self.data.close[0] < self.ma5[0]:
+            if signal & SIGNAL_SELL:
+                close = self.data.close[0]
+                ma5 = self.ma5[i]
                 self.close()  # 清仓
                 
                 # 记录卖出信息
-                self.trades.append({
-                    'date': self.data.datetime.date(),
-                    'type': '卖出',
-                    'price': self.data.close[0],
-                    'ma5': self.ma5[0]
-                })
-                print(f'卖出: 日期={self.data.datetime.date()}, '
-                      f'价格={self.data.close[0]:.2f}, '
-                      f'MA5={self.ma5[0]:.2f}')
+                date = self.data.datetime.date()
+                self._record(1, date, close, ma5)
+                logger.info('卖出: 日期=%s, 价格=%.2f, MA5=%.2f', date, close, ma5)
 
     def stop(self):
-        # 策略结束时打印交易汇总
-        print('\n====== 交易记录 ======')
-        for trade in self.trades:
-            if trade['type'] == '买入':
-                print(f"买入: 日期={trade['date']}, 价格={trade['price']:.2f}, "
-                      f"MA5={trade['ma5']:.2f}, 数量={trade['size']}")
+        if not self.p.printlog:
+            return
+        # 策略结束时打印交易汇总，所有记录拼接后一次输出
+        lines = ['\n====== 交易记录 ======']
+        for trade in self.trades[:self._ntrades]:
+            if trade['type'] == 0:
+                lines.append(f"买入: 日期={trade['date']}, 价格={trade['price']:.2f}, "
+                             f"MA5={trade['ma5']:.2f}, 数量={trade['size']}")
             else:
-                print(f"卖出: 日期={trade['date']}, 价格={trade['price']:.2f}, "
-                      f"MA5={trade['ma5']:.2f}")
-
-# 运行回测
-cerebro = bt.Cerebro()
-df = get_stock_data()  # 获取股票数据
-data = bt.feeds.PandasData(dataname=df)
-cerebro.adddata(data)
-cerebro.addstrategy(MA5Strategy)
-cerebro.broker.setcash(100000.0)  # 设置初始资金
-
-# 添加分析器
-cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
-cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
-cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
-cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
-
-print('初始资金: %.2f' % cerebro.broker.getvalue())
-results = cerebro.run()
-strat = results[0]
-
-# 获取回测结果
-drawdown = strat.analyzers.drawdown.get_analysis()
-returns = strat.analyzers.returns.get_analysis()
-sharpe = strat.analyzers.sharpe.get_analysis()
-trades = strat.analyzers.trades.get_analysis()
-
-print('\n======= 核心指标 =======')
-print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
-print('回撤周期: %d 天' % drawdown['max']['len'])
-print('年化收益率: %.2f%%' % (returns['rnorm100']))
-print('夏普比率: %.2f' % sharpe['sharperatio'])
-print('最终资金: %.2f' % cerebro.broker.getvalue())
-
-# 输出交易统计
-print('\n======= 交易统计 =======')
-print('总交易次数: %d' % trades['total']['total'])
-if trades['total']['total'] > 0:
-    print('盈利交易: %d' % trades['won']['total'])
-    print('亏损交易: %d' % trades['lost']['total'])
-    print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
-
-cerebro.plot(style='candlestick')
\ No newline at end of file
+                lines.append(f"卖出: 日期={trade['date']}, 价格={trade['price']:.2f}, "
+                             f"MA5={trade['ma5']:.2f}")
+        print('\n'.join(lines))
+
+def vectorized_backtest(df, ma_period=5, up_pct=0.01, cash=100000.0):
+    """
+    编译执行的均线策略回测，与MA5Strategy逻辑一致（不经过backtrader事件循环）
+    :return: {'trades': 交易明细DataFrame, 'equity': 资金曲线Series}
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    ma = _sma(close, ma_period)
+    equity, trades = backtest_ma5(open_, close, ma, up_pct, cash)
+    
+    dates = df.index.to_numpy()
+    exit_idx = trades[:, 1].astype(np.int64)
+    trades = pd.DataFrame({
+        'entry_date': dates[trades[:, 0].astype(np.int64)],
+        'exit_date': np.where(exit_idx >= 0, dates[exit_idx], np.datetime64('NaT')),
+        'size': trades[:, 2],
+        'pnl': trades[:, 3]
+    })
+    return {'trades': trades, 'equity': pd.Series(equity, index=df.index)}
+
+def vectorized_sweep(df, ma_periods=(3, 5, 10, 20), up_pcts=(0.0, 0.005, 0.01, 0.02), cash=100000.0):
+    """
+    编译执行的参数网格回测：各均线周期的均线计算一次，所有参数组合在一次编译调用中完成
+    :return: 每组参数及其指标的DataFrame，按最终资金降序
+    """
+    open_ = df['open'].to_numpy(dtype=np.float64)
+    close = df['close'].to_numpy(dtype=np.float64)
+    up_pcts = np.asarray(up_pcts, dtype=np.float64)
+    final, max_dd, n_trades = sweep_ma5(open_, close, _sma_grid(close, ma_periods), up_pcts, cash)
+    
+    results = pd.DataFrame({
+        'ma_period': np.repeat(ma_periods, len(up_pcts)),
+        'up_pct': np.tile(up_pcts, len(ma_periods)),
+        'final_value': final.ravel(),
+        'max_drawdown': max_dd.ravel(),
+        'trades': n_trades.ravel()
+    })
+    return results.sort_values('final_value', ascending=False, ignore_index=True)
+
+def run_single(df, cash=100000.0):
+    """
+    单只股票运行一次回测，只返回核心指标（供多只股票并行回测时在子进程中调用）
+    :return: {'sharpe', 'max_drawdown', 'annual_return', 'final_value'}
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(bt.feeds.PandasData(dataname=df))
+    cerebro.addstrategy(MA5Strategy, printlog=False)
+    cerebro.broker.setcash(cash)
+    add_analyzers(cerebro)
+    strat = cerebro.run()[0]
+    return summarize(cerebro, strat)
+
+def _run_symbol(symbol):
+    """获取一只股票的行情并回测，获取失败时返回None"""
+    df = get_stock_data(symbol)
+    return None if df is None else run_single(df)
+
+def run_symbols(symbols, max_workers=None):
+    """
+    多进程并行回测多只股票，每个子进程各自获取行情并运行独立的Cerebro
+    :param max_workers: 进程数，默认CPU核数
+    :return: 每只股票及其指标的DataFrame，按夏普比率降序（行情获取失败的股票不在其中）
+    """
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_symbol, symbol): symbol for symbol in symbols}
+        for done, future in enumerate(as_completed(futures), 1):
+            symbol = futures[future]
+            metrics = future.result()
+            print(f"回测进度: {done}/{len(futures)} {symbol}")
+            if metrics is not None:
+                rows.append({'symbol': symbol, **metrics})
+    results = pd.DataFrame(rows, columns=['symbol', 'sharpe', 'max_drawdown', 'annual_return', 'final_value'])
+    return results.sort_values('sharpe', ascending=False, ignore_index=True)
+
+def run_backtest(plot=False):
+    # 运行回测
+    cerebro = bt.Cerebro()
+    df = get_stock_data()  # 获取股票数据
+    data = bt.feeds.PandasData(dataname=df)
+    cerebro.adddata(data)
+    cerebro.addstrategy(MA5Strategy)
+    cerebro.broker.setcash(100000.0)  # 设置初始资金
+
+    # 添加分析器
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')  # 回撤分析器
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')    # 收益分析器
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name='sharpe') # 夏普比率分析器
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades') # 交易分析器
+
+    print('初始资金: %.2f' % cerebro.broker.getvalue())
+    results = cerebro.run()
+    strat = results[0]
+
+    # 获取回测结果
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    returns = strat.analyzers.returns.get_analysis()
+    sharpe = strat.analyzers.sharpe.get_analysis()
+    trades = strat.analyzers.trades.get_analysis()
+
+    print('\n======= 核心指标 =======')
+    print('最大回撤: %.2f%%' % (drawdown['max']['drawdown'] * 100))
+    print('回撤周期: %d 天' % drawdown['max']['len'])
+    print('年化收益率: %.2f%%' % (returns['rnorm100']))
+    print('夏普比率: %.2f' % sharpe['sharperatio'])
+    print('最终资金: %.2f' % cerebro.broker.getvalue())
+
+    # 输出交易统计
+    print('\n======= 交易统计 =======')
+    print('总交易次数: %d' % trades['total']['total'])
+    if trades['total']['total'] > 0:
+        print('盈利交易: %d' % trades['won']['total'])
+        print('亏损交易: %d' % trades['lost']['total'])
+        print('胜率: %.2f%%' % (trades['won']['total'] / trades['total']['total'] * 100))
+
+    # 编译执行的回测结果（用于快速对照）
+    vec = vectorized_backtest(df)
+    print('\n====== 向量化回测 ======')
+    print('交易次数: %d' % len(vec['trades']))
+    print('最终资金: %.2f' % vec['equity'].iloc[-1])
+
+    if plot:
+        cerebro.plot(style='candlestick')
+
+def main():
+    """命令行入口：默认回测单只股票，也可以并行回测多只股票或扫描参数网格"""
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')  # 改为INFO可查看逐笔交易
+    parser = argparse.ArgumentParser(description='5日均线策略回测')
+    parser.add_argument('--plot', action='store_true', help='回测结束后绘制K线和交易图')
+    parser.add_argument('--symbols', nargs='+', help='多进程并行回测的股票代码，不指定时回测默认股票')
+    parser.add_argument('--sweep', action='store_true', help='编译执行的均线周期和突破比例参数网格回测')
+    parser.add_argument('--workers', type=int, default=None, help='并行回测的进程数，默认CPU核数')
+    args = parser.parse_args()
+    if not args.plot:
+        matplotlib.use('Agg')  # 不绘图时跳过GUI后端初始化
+    if args.sweep:
+        print(vectorized_sweep(get_stock_data()).to_string())
+    elif args.symbols:
+        print(run_symbols(args.symbols, max_workers=args.workers).to_string())
+    else:
+        run_backtest(plot=args.plot)
+
+if __name__ == "__main__":
+    main()